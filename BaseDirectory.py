@@ -19,6 +19,7 @@
 """BaseDirectory
 """
 
+import md5
 import logging
 import csv
 from StringIO import StringIO
@@ -32,8 +33,10 @@ from AccessControl import ClassSecurityInfo
 from AccessControl import getSecurityManager
 from AccessControl import Unauthorized
 from AccessControl import ModuleSecurityInfo
+from App.Common import rfc1123_date
 from DateTime.DateTime import DateTime
 from OFS.Image import File, Image
+from zExceptions import BadRequest
 
 from Products.PageTemplates.Expressions import SecureModuleImporter
 from Products.CMFCore.utils import getToolByName
@@ -48,11 +51,24 @@ from Products.CPSSchemas.DataModel import DataModel
 from Products.CPSSchemas.DataStructure import DataStructure
 from Products.CPSSchemas.Field import ReadAccessError
 from Products.CPSSchemas.Field import WriteAccessError
+from Products.CPSDirectory.utils import titleSortKey
+from Products.CPSDirectory.utils import LazyValue
+from Products.CPSDirectory.utils import isNotModified
+from Products.CPSDirectory.thumbnails import getThumbnailCache
+from Products.CPSDirectory.thumbnails import makeThumbnail
+from Products.CPSDirectory.thumbnails import MAX_THUMBNAIL_SIZE
 
 logger = logging.getLogger(__name__)
 
 _marker = []
 
+# Default number of entries fetched at a time by iterSearchEntries
+SEARCH_BATCH_SIZE = 500
+
+# Time (in seconds) during which browsers may reuse binary field data
+# without revalidating it
+RAW_DATA_MAX_AGE = 3600
+
 
 class AuthenticationFailed(Exception):
     """Raised when authentication fails."""
@@ -360,6 +376,29 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
             res = [(id, entry[title_field]) for id, entry in results]
         return res
 
+    security.declarePrivate('listSortedEntryIdsAndTitles')
+    def listSortedEntryIdsAndTitles(self, prefix='', start=0, limit=None):
+        """List the entry ids and titles, sorted by title.
+
+        Titles are compared without case nor accents. Only titles starting
+        with prefix are returned, skipping the first start ones, and at
+        most limit of them.
+
+        Returns a list of tuples (id, title).
+        """
+        prefix = titleSortKey(prefix)
+        items = []
+        for id, title in self.listEntryIdsAndTitles():
+            key = titleSortKey(title)
+            if key.startswith(prefix):
+                items.append(((key, id), title))
+        items.sort()
+        if limit is None:
+            items = items[start:]
+        else:
+            items = items[start:start+limit]
+        return [(key[1], title) for key, title in items]
+
     security.declarePublic('hasEntry')
     def hasEntry(self, id):
         """Does the directory have a given entry?"""
@@ -382,7 +421,9 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
         or None.
         """
         self.checkCreateEntryAllowed(entry=entry)
-        return self._createEntry(entry)
+        new_id = self._createEntry(entry)
+        self._invalidateCreatedThumbnails(entry, new_id)
+        return new_id
 
     security.declarePrivate('_createEntry')
     def _createEntry(self, entry):
@@ -393,6 +434,30 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
         """
         raise NotImplementedError
 
+    security.declarePublic('createEntries')
+    def createEntries(self, entries):
+        """Create several entries in the directory.
+
+        Returns the list of what createEntry returns for each entry.
+        """
+        entries = list(entries)
+        for entry in entries:
+            self.checkCreateEntryAllowed(entry=entry)
+        new_ids = self._createEntries(entries)
+        for entry, new_id in zip(entries, new_ids):
+            self._invalidateCreatedThumbnails(entry, new_id)
+        return new_ids
+
+    security.declarePrivate('_createEntries')
+    def _createEntries(self, entries):
+        """Create several entries in the directory, unrestricted.
+
+        Returns the list of what _createEntry returns for each entry.
+        Directories may override it to create them more efficiently than
+        one by one.
+        """
+        return [self._createEntry(entry) for entry in entries]
+
     security.declarePublic('getEntry')
     def getEntry(self, id, default=_marker):
         """Get entry filtered by acls and processes.
@@ -507,6 +572,37 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
         """
         raise NotImplementedError
 
+    security.declarePublic('iterSearchEntries')
+    def iterSearchEntries(self, return_fields=None,
+                          batch_size=SEARCH_BATCH_SIZE, **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        Same as searchEntries(), but returns an iterator. Directories
+        that support it fetch the results batch_size entries at a time,
+        so that searches on big directories, for exports or batch jobs,
+        don't need to hold all the results in memory.
+
+        Callers that stop before the end should call the close() method
+        of the iterator if it has one, so that resources it holds, such
+        as LDAP connections, are given back at once.
+        """
+        self.checkSearchEntriesAllowed()
+        return self._iterSearchEntries(return_fields=return_fields,
+                                       batch_size=batch_size, **kw)
+
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, **kw):
+        """Search for entries in the directory, iterating, unrestricted.
+
+        See documentation on iterSearchEntries().
+        This private method does not do ACL checks.
+
+        The default implementation iterates over the results of
+        _searchEntries().
+        """
+        return iter(self._searchEntries(return_fields=return_fields, **kw))
+
     security.declarePublic('editEntry')
     def editEntry(self, entry):
         """Edit an entry in the directory.
@@ -539,7 +635,7 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
                 dm[key] = toset
             except WriteAccessError:
                 pass
-        dm._commit()
+        self._commitDataModel(dm, id)
 
     security.declarePublic('deleteEntry')
     def deleteEntry(self, id, REQUEST=None):
@@ -550,6 +646,7 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
         self.checkDeleteEntryAllowed(id=id)
         users_directory_id = self.acl_users.getProperty('users_dir')
         self._deleteEntry(id)
+        self._invalidateThumbnails(id)
         if self.getId() == users_directory_id:
             mtool = getToolByName(self, 'portal_membership')
             mtool.deleteMembers([id], check_permission=0)
@@ -590,28 +687,120 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
     # Rendering API
     #
 
-    def _getRawFieldData(self, bin_cls, entry_id, field_id, REQUEST, RESPONSE):
+    def _getRawFieldData(self, bin_cls, entry_id, field_id, REQUEST, RESPONSE,
+                         size=None):
         """Serve the raw data from a binary field.
 
         Useful for images, or any attachment (X509 certificates...)
         bin_cls is the class to use.
         Some may perform interesting treatment, like automatic content
         recognition and that may turn crucial for proper serving.
+
+        If size is given, the image is served resized to fit in a square
+        of that size. Resized images are kept in the thumbnail cache,
+        along with the digest of the image they come from.
+        Sizes that are not positive integers are refused with BadRequest.
+
+        The data is served with an ETag computed from its content, and
+        conditional requests get a 304 response if it didn't change. The
+        digest of the content is kept in the thumbnail cache, so that
+        they are answered without reading the data from the backend.
         """
         entry = self.getEntry(entry_id) # goes through ACL check
+        # Fields that can't be read are not in the entry. Check it before
+        # using the digest or thumbnail kept for someone allowed to read it.
         value = entry[field_id]
+        if size:
+            try:
+                size = int(size)
+            except (ValueError, TypeError):
+                size = 0
+            if size <= 0:
+                raise BadRequest("Invalid thumbnail size")
+            size = min(size, MAX_THUMBNAIL_SIZE)
+        else:
+            size = None
+
+        # Answer conditional requests without reading the data
+        cache = getThumbnailCache()
+        dir_path = '/'.join(self.getPhysicalPath())
+        thumbnail_id = self._getThumbnailEntryId(entry_id)
+        known_digest = cache.getDigest(dir_path, thumbnail_id, field_id)
+        if known_digest is not None:
+            etag = self._getRawDataETag(known_digest, size)
+            if isNotModified(REQUEST, etag):
+                self._setRawDataHeaders(etag, None, RESPONSE)
+                RESPONSE.setStatus(304)
+                return ''
+
+        if isinstance(value, LazyValue):
+            value = value.getValue()
         if value is None:
             return ''
 
         if isinstance(value, str):
-            value = bin_cls(field_id, value, '')
+            data = value
+            value = bin_cls(field_id, '', data)
+            mtime = None
+        else:
+            data = str(value.data)
+            mtime = getattr(value, '_p_mtime', None)
+        digest = md5.new(data).hexdigest()
+        if digest != known_digest:
+            cache.setDigest(dir_path, thumbnail_id, field_id, digest)
+        if size is not None:
+            # Thumbnails are only used for the image they were made from
+            thumbnail_key = (dir_path, thumbnail_id, field_id, size, digest)
+            thumbnail = cache.get(thumbnail_key)
+            if thumbnail is None:
+                thumbnail = makeThumbnail(data, size)
+                if thumbnail is not None:
+                    cache.set(thumbnail_key, thumbnail)
+            if thumbnail is not None:
+                value = bin_cls(field_id, '', thumbnail)
+            mtime = None
+        etag = self._getRawDataETag(digest, size)
+        return self._serveRawData(value, etag, mtime, REQUEST, RESPONSE)
+
+    def _getRawDataETag(self, digest, size=None):
+        """Get the ETag of raw data, or of its thumbnail of the given size.
+
+        It only depends on the digest of the data, so that it is known
+        without reading it.
+        """
+        if size is None:
+            return '"%s"' % digest
+        return '"%s-%s"' % (digest, size)
+
+    def _setRawDataHeaders(self, etag, mtime, RESPONSE):
+        """Set the HTTP cache validators of raw data."""
+        RESPONSE.setHeader('ETag', etag)
+        RESPONSE.setHeader('Cache-Control',
+                           'private, max-age=%d' % RAW_DATA_MAX_AGE)
+        if mtime is not None:
+            RESPONSE.setHeader('Last-Modified', rfc1123_date(mtime))
+
+    def _serveRawData(self, value, etag, mtime, REQUEST, RESPONSE):
+        """Serve a File or Image object, with HTTP cache validators.
+
+        mtime is the modification time of the data, if known.
+        """
+        self._setRawDataHeaders(etag, mtime, RESPONSE)
+        if isNotModified(REQUEST, etag, mtime):
+            RESPONSE.setStatus(304)
+            return ''
         return value.index_html(REQUEST, RESPONSE)
 
     security.declarePublic('getImageFieldData')
-    def getImageFieldData(self, entry_id, field_id, REQUEST, RESPONSE):
-        """Serve an image from an entry field."""
+    def getImageFieldData(self, entry_id, field_id, REQUEST, RESPONSE,
+                          size=None):
+        """Serve an image from an entry field.
+
+        If size is given, a thumbnail fitting in a square of that size is
+        served.
+        """
         return self._getRawFieldData(Image, entry_id, field_id, REQUEST,
-                                     RESPONSE)
+                                     RESPONSE, size=size)
 
     security.declarePublic('getFileFieldData')
     def getFileFieldData(self, entry_id, field_id, REQUEST, RESPONSE):
@@ -619,6 +808,34 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
         return self._getRawFieldData(File, entry_id, field_id, REQUEST,
                                      RESPONSE)
 
+    security.declarePrivate('_commitDataModel')
+    def _commitDataModel(self, dm, id):
+        """Write the changes of the datamodel of an entry.
+
+        The entry edits go through here, so that its thumbnails are
+        removed from the cache.
+        """
+        dm._commit()
+        self._invalidateThumbnails(id)
+
+    def _getThumbnailEntryId(self, entry_id):
+        """Get the id under which the thumbnails of an entry are kept."""
+        return entry_id
+
+    def _invalidateThumbnails(self, entry_id):
+        """Remove the thumbnails of an entry from the cache."""
+        getThumbnailCache().invalidate('/'.join(self.getPhysicalPath()),
+                                       self._getThumbnailEntryId(entry_id))
+
+    def _invalidateCreatedThumbnails(self, entry, new_id):
+        """Remove the thumbnails of a created entry from the cache.
+
+        The id may be the one of a deleted entry.
+        """
+        id = new_id or entry.get(self.id_field)
+        if id:
+            self._invalidateThumbnails(id)
+
     security.declarePublic('renderEntryDetailed')
     def renderEntryDetailed(self, id, layout_mode='view', **kw):
         """Render the entry.
@@ -678,7 +895,7 @@ class BaseDirectory(PropertiesPostProcessor, SimpleItemWithProperties):
                 ds.setError(id_field, 'cpsschemas_err_readonly')
                 ok = 0
             if ok:
-                dm._commit()
+                self._commitDataModel(dm, id)
             else:
                 layout_mode = layout_mode_err
         else:
@@ -145,6 +145,19 @@ class DirectoryVocabulary(SimpleItemWithProperties):
                 res.append(v)
         return res
 
+    security.declareProtected(View, 'sortedItems')
+    def sortedItems(self, prefix='', start=0, limit=None):
+        """Get (key, value) items sorted by value, for instance for
+        completion or paged select widgets.
+
+        Only values starting with prefix (compared without case nor
+        accents) are returned, skipping the first start ones, and at most
+        limit of them. The empty key is never included.
+        """
+        dir = self._getDirectory()
+        return dir.listSortedEntryIdsAndTitles(prefix=prefix, start=start,
+                                               limit=limit)
+
     security.declareProtected(View, 'values')
     def values(self):
         return [t[1] for t in self.items()]
@@ -28,14 +28,18 @@ from logging import getLogger
 
 import re
 import sys
+import time
+import heapq
 from urllib import urlencode
 
 from Globals import InitializeClass
+from Globals import DTMLFile
 from AccessControl import ClassSecurityInfo
 from OFS.Image import Image
 from OFS.Cache import Cacheable
 
 from Products.CMFCore.utils import getToolByName
+from Products.CMFCore.permissions import ManagePortal
 
 from Products.CPSUtil.ssha import sshaDigest
 from Products.CPSUtil.testing.environment import isTestingEnvironment
@@ -50,13 +54,72 @@ from Products.CPSDirectory.BaseDirectory import BaseDirectoryStorageMixin
 from Products.CPSDirectory.BaseDirectory import AuthenticationFailed
 from Products.CPSDirectory.BaseDirectory import ConfigurationError
 from Products.CPSDirectory.BaseDirectory import _replaceProperty
+from Products.CPSDirectory.BaseDirectory import SEARCH_BATCH_SIZE
+from Products.CPSDirectory.utils import iterBatches
+from Products.CPSDirectory.utils import LazyValue
+from Products.CPSDirectory.cache import LRUCache
+from Products.CPSDirectory.cache import getExistenceCache
+from Products.CPSDirectory.cache import getCacheTracker
+from Products.CPSDirectory.changefeed import ChangeFeedError
+from Products.CPSDirectory.changefeed import LogFileFeed
+from Products.CPSDirectory.changefeed import getChangeListener
+from Products.CPSDirectory.changefeed import startChangeListener
+from Products.CPSDirectory.changefeed import stopChangeListener
+from Products.CPSDirectory.ldappool import closeConnection
+from Products.CPSDirectory.ldapcontrols import SORT_REQUEST_OID
+from Products.CPSDirectory.ldapcontrols import SORT_RESPONSE_OID
+from Products.CPSDirectory.ldapcontrols import VLV_REQUEST_OID
+from Products.CPSDirectory.ldapcontrols import VLV_RESPONSE_OID
+from Products.CPSDirectory.ldapcontrols import encodeSortRequest
+from Products.CPSDirectory.ldapcontrols import decodeSortResponse
+from Products.CPSDirectory.ldapcontrols import encodeVLVRequest
+from Products.CPSDirectory.ldapcontrols import decodeVLVResponse
+from Products.CPSDirectory.ldapcontrols import PSEARCH_OID
+from Products.CPSDirectory.ldapcontrols import ENTRY_CHANGE_OID
+from Products.CPSDirectory.ldapcontrols import SYNC_REQUEST_OID
+from Products.CPSDirectory.ldapcontrols import SYNC_STATE_OID
+from Products.CPSDirectory.ldapcontrols import CHANGE_ADD
+from Products.CPSDirectory.ldapcontrols import CHANGE_DELETE
+from Products.CPSDirectory.ldapcontrols import CHANGE_MODIFY
+from Products.CPSDirectory.ldapcontrols import CHANGE_MODDN
+from Products.CPSDirectory.ldapcontrols import SYNC_ADD
+from Products.CPSDirectory.ldapcontrols import SYNC_MODIFY
+from Products.CPSDirectory.ldapcontrols import SYNC_DELETE
+from Products.CPSDirectory.ldapcontrols import encodePersistentSearch
+from Products.CPSDirectory.ldapcontrols import decodeEntryChange
+from Products.CPSDirectory.ldapcontrols import encodeSyncRequest
+from Products.CPSDirectory.ldapcontrols import decodeSyncState
+from Products.CPSDirectory.ldapfilter import FilterError
+from Products.CPSDirectory.ldapfilter import parseFilter
+from Products.CPSDirectory.ldapfilter import removeTerm
+from Products.CPSDirectory.replica import LDAPReplica
+from Products.CPSDirectory.replica import beginSync
+from Products.CPSDirectory.replica import endSync
+from Products.CPSDirectory.replica import getWatermarkStart
+from Products.CPSDirectory.thumbnails import getThumbnailCache
 
 from Products.CPSDirectory.interfaces import IDirectory
+from Products.CPSDirectory.interfaces import IBatchable
+from Products.CPSDirectory.interfaces import IOrderable
 
 from zope.interface import implements
 
 logger = getLogger('CPSDirectory.LDAPBackingDirectory')
 
+# Number of additions sent before waiting for their results
+ADD_PIPELINE_SIZE = 100
+
+# Number of compiled search filters kept per directory and connection
+FILTER_CACHE_SIZE = 200
+
+# Time in seconds a change feed waits for a change before checking
+# whether it has been stopped
+CHANGE_FEED_POLL_INTERVAL = 1.0
+
+# Time in seconds before the watermark of a replica from which changed
+# entries are read again, for changes committed late
+REPLICA_SYNC_OVERLAP = 300
+
 def md5Digest(s):
     """make a LDAP-ready MD5 digest.
 
@@ -81,6 +144,7 @@ if not isTestingEnvironment():
     import ldap
     import ldap.ldapobject
     import ldap.filter
+    import ldap.controls
 else:
     from Products.CPSDirectory.tests import ldap
 
@@ -147,6 +211,448 @@ def implodeRDN(avas):
     """Implode a sequence of avas into a rdn."""
     return '+'.join(avas)
 
+#
+# Connections
+#
+
+def openConnection(url, bind_dn, bind_password,
+                   retry_max=1, retry_delay=60.0, timeout=0):
+    """Open a connection to an LDAP server and bind it.
+
+    If bind_dn is None, the connection isn't bound.
+    """
+    logger.log(5, 'openConnection: initialize url=%s', url)
+    conn = ldap.ldapobject.ReconnectLDAPObject(
+        url, retry_max=retry_max, retry_delay=retry_delay)
+    if timeout > 0:
+        conn.timeout = timeout
+    try:
+        conn.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
+    except ldap.LDAPError:
+        conn.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION2)
+
+    # Auto-chase referrals.
+    try:
+        conn.set_option(ldap.OPT_REFERRALS, 1)
+    except ldap.LDAPError:
+        # Forget about it.
+        logger.debug('openConnection: No referrals')
+        pass
+
+    #conn.manage_dsa_it(0)
+
+    if bind_dn is not None:
+        logger.log(5, 'openConnection: bind_s dn=%s', bind_dn)
+        conn.simple_bind_s(bind_dn, bind_password)
+    return conn
+
+def checkConnection(conn):
+    """Check that a connection still works, by reading the root DSE."""
+    conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['1.1'])
+
+#
+# Paged results (RFC 2696)
+#
+
+def makePagedResultsControl(size, cookie=''):
+    """Make a paged results control.
+
+    The control isn't critical: servers that don't support it return
+    all the results at once.
+    """
+    cls = ldap.controls.SimplePagedResultsControl
+    if getattr(cls, 'controlType', None) is not None:
+        # python-ldap >= 2.4
+        return cls(False, size=size, cookie=cookie)
+    return cls(ldap.LDAP_CONTROL_PAGE_OID, False, (size, cookie))
+
+def getPagedResultsCookie(serverctrls):
+    """Get the cookie of the paged results control sent by the server.
+
+    An empty cookie means that there are no more results.
+    """
+    for ctrl in serverctrls:
+        if ctrl.controlType != ldap.LDAP_CONTROL_PAGE_OID:
+            continue
+        cookie = getattr(ctrl, 'cookie', None)
+        if cookie is None:
+            # python-ldap < 2.4
+            size, cookie = ctrl.controlValue
+        return cookie
+    return ''
+
+def searchPage(conn, base, scope, filter, attrs, size, cookie=''):
+    """Search one page of results.
+
+    Returns the results and the cookie to get the next page.
+    """
+    ctrl = makePagedResultsControl(size, cookie)
+    msgid = conn.search_ext(base, scope, filter, attrs, serverctrls=[ctrl])
+    rtype, results, rmsgid, serverctrls = conn.result3(msgid)
+    return results, getPagedResultsCookie(serverctrls)
+
+
+class PagedSearch(object):
+    """Iterator over the results of an LDAP search, as (dn, entry).
+
+    Results are fetched by pages of page_size entries, or all at once if
+    page_size is 0. When all the results have been read, or when the
+    iterator is closed, the connection is given back by calling
+    release(conn). Callers that stop reading before the end must call
+    close().
+    """
+
+    def __init__(self, conn, base, scope, filter, attrs, page_size,
+                 release=None):
+        self._conn = conn
+        self._args = (base, scope, filter, attrs)
+        self._page_size = page_size
+        self._release = release
+        self._results = []
+        self._pos = 0
+        self._cookie = ''
+        self._more = True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._pos >= len(self._results):
+            if not self._more:
+                raise StopIteration
+            self._fetch()
+        res = self._results[self._pos]
+        self._pos += 1
+        return res
+
+    def _fetch(self):
+        base, scope, filter, attrs = self._args
+        try:
+            if self._page_size > 0:
+                logger.log(5, 'PagedSearch: search_ext base=%s scope=%s '
+                           'filter=%s attrs=%s', base, scope, filter, attrs)
+                results, cookie = searchPage(self._conn, base, scope, filter,
+                                             attrs, self._page_size,
+                                             self._cookie)
+            else:
+                results = self._conn.search_s(base, scope, filter, attrs)
+                cookie = ''
+        except:
+            self._cookie = ''
+            self.close()
+            raise
+        self._cookie = cookie
+        if not cookie:
+            # Last page
+            self.close()
+        self._results = results
+        self._pos = 0
+
+    def close(self):
+        """Stop the search and give back the connection."""
+        self._more = False
+        self._results = []
+        self._pos = 0
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        if self._cookie:
+            # Tell the server to forget the search
+            base, scope, filter, attrs = self._args
+            try:
+                searchPage(conn, base, scope, filter, attrs, 0, self._cookie)
+            except ldap.LDAPError, e:
+                logger.debug("Error abandoning paged search: %s", e)
+            self._cookie = ''
+        if self._release is not None:
+            self._release(conn)
+
+    def __del__(self):
+        # Iterators dropped without being closed. Finalizers may run in
+        # any thread, possibly one holding the pool lock, so there is no
+        # network I/O nor locking here: pooled connections are queued
+        # for the pool to close them.
+        conn = self._conn
+        if conn is None or self._release is None:
+            return
+        self._conn = None
+        logger.warning("PagedSearch on %s was not closed", self._args[0])
+        pool = getattr(conn, '_cps_pool', None)
+        if pool is not None:
+            pool.abandon(conn)
+
+
+class ClosingIterator(object):
+    """Iterator over the items of another one, passed through convert.
+
+    close() closes the underlying iterator if it has a close() method.
+    It is also closed when it or convert raise an exception, so that a
+    PagedSearch gives back its connection.
+    """
+
+    def __init__(self, iterable, convert=None):
+        self._it = iter(iterable)
+        self._convert = convert
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            item = self._it.next()
+            if self._convert is not None:
+                item = self._convert(item)
+        except StopIteration:
+            raise
+        except:
+            self.close()
+            raise
+        return item
+
+    def close(self):
+        """Close the underlying iterator."""
+        close = getattr(self._it, 'close', None)
+        if close is not None:
+            close()
+
+#
+# Sorting (RFC 2891) and virtual list views
+#
+
+def getSupportedControls(conn):
+    """Get the OIDs of the controls supported by the server.
+
+    They are read from the root DSE.
+    """
+    try:
+        res = conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                            ['supportedControl'])
+    except ldap.NO_SUCH_OBJECT:
+        return ()
+    if not res:
+        return ()
+    return tuple(res[0][1].get('supportedControl', ()))
+
+def makeControl(oid, value, critical=False):
+    """Make a control from its BER encoded value."""
+    return ldap.controls.LDAPControl(oid, critical, None, value)
+
+def getControlValue(serverctrls, oid):
+    """Get the BER encoded value of a control sent by the server, or None.
+    """
+    for ctrl in serverctrls:
+        if ctrl.controlType == oid:
+            return ctrl.encodedControlValue
+    return None
+
+def searchSorted(conn, base, scope, filter, attrs, order_by, reverse=False,
+                 offset=0, limit=None, vlv=False):
+    """Search with the server side sort control.
+
+    If vlv is true and limit is not None, the virtual list view control
+    is used so that the server only returns limit results from offset.
+
+    Returns the results, whether the server sorted them, and whether it
+    only returned the requested batch.
+    """
+    keys = [(attr, reverse) for attr in order_by]
+    ctrls = [makeControl(SORT_REQUEST_OID, encodeSortRequest(keys))]
+    vlv = vlv and limit is not None
+    if vlv:
+        # Offsets start at 1, a content count of 0 means unknown
+        value = encodeVLVRequest(0, limit - 1, offset + 1, 0)
+        ctrls.append(makeControl(VLV_REQUEST_OID, value))
+    msgid = conn.search_ext(base, scope, filter, attrs, serverctrls=ctrls)
+    if getattr(ldap.controls, 'KNOWN_RESPONSE_CONTROLS', None) is not None:
+        # python-ldap >= 2.4 drops the response controls it doesn't know
+        classes = {SORT_RESPONSE_OID: ldap.controls.LDAPControl,
+                   VLV_RESPONSE_OID: ldap.controls.LDAPControl}
+        rtype, results, rmsgid, serverctrls = conn.result3(
+            msgid, resp_ctrl_classes=classes)
+    else:
+        rtype, results, rmsgid, serverctrls = conn.result3(msgid)
+    value = getControlValue(serverctrls, SORT_RESPONSE_OID)
+    is_sorted = value is not None and decodeSortResponse(value)[0] == 0
+    is_batch = False
+    if vlv and is_sorted:
+        value = getControlValue(serverctrls, VLV_RESPONSE_OID)
+        is_batch = value is not None and decodeVLVResponse(value)[2] == 0
+    return results, is_sorted, is_batch
+
+def sortKey(dn, ldap_entry, order_by):
+    """Compute the key to sort an LDAP result on some attributes.
+
+    Values are compared ignoring case, like most LDAP ordering rules.
+    Entries without a value sort last.
+    """
+    key = []
+    for attr in order_by:
+        if attr == 'dn':
+            values = [dn]
+        else:
+            values = ldap_entry.get(attr)
+        if not values:
+            key.append((1,))
+        else:
+            key.append((0, min([v.decode('utf-8', 'replace').lower()
+                                for v in values])))
+    return tuple(key)
+
+def sortResults(results, order_by, reverse=False, offset=0, limit=None):
+    """Sort LDAP results, keeping limit of them from offset.
+
+    Entries without a value sort last, or first in reverse order. When
+    there is a limit, only offset+limit results are kept while reading
+    the results, which may be an iterator.
+    """
+    decorated = ((sortKey(dn, ldap_entry, order_by), i, (dn, ldap_entry))
+                 for i, (dn, ldap_entry) in enumerate(results))
+    if limit is None:
+        decorated = sorted(decorated, reverse=reverse)
+    elif reverse:
+        decorated = heapq.nlargest(offset + limit, decorated)
+    else:
+        decorated = heapq.nsmallest(offset + limit, decorated)
+    return [res for key, i, res in decorated[offset:]]
+
+#
+# Change feeds
+#
+
+def getChangeKey(dn):
+    """Get the key identifying a dn in the change events.
+
+    It's the tuple of its rdns, lowercased, so that it's easy to find
+    whether it's in the scope of a search.
+    """
+    return tuple([rdn.lower() for rdn in explodeDN(dn)])
+
+def isInSearchScope(key, base_key, scope):
+    """Tell whether an entry is in the scope of a search.
+
+    key and base_key are the change keys of the entry and the search
+    base.
+    """
+    if scope == ldap.SCOPE_BASE:
+        return key == base_key
+    depth = len(key) - len(base_key)
+    if depth < 0 or key[depth:] != base_key:
+        return False
+    if scope == ldap.SCOPE_ONELEVEL:
+        return depth == 1
+    return True
+
+_entry_change_types = {
+    CHANGE_ADD: 'add',
+    CHANGE_DELETE: 'delete',
+    CHANGE_MODIFY: 'modify',
+    CHANGE_MODDN: 'modrdn',
+    }
+
+_sync_change_types = {
+    SYNC_ADD: 'add',
+    SYNC_MODIFY: 'modify',
+    SYNC_DELETE: 'delete',
+    }
+
+
+class LDAPChangeFeed(object):
+    """Changes of the entries under a base, reported by an LDAP server.
+
+    A persistent search is used, or if sync is true a content
+    synchronization search (RFC 4533) in refreshAndPersist mode. The
+    latter first reports all the existing entries as added.
+
+    Change types and previous dns of renamed entries are only known with
+    python-ldap >= 2.4, that returns the controls of each entry. The
+    connection is closed when the feed is closed. See the changefeed
+    module.
+    """
+
+    def __init__(self, conn, base, sync=False,
+                 poll_interval=CHANGE_FEED_POLL_INTERVAL):
+        self._conn = conn
+        self._base = base
+        self._sync = sync
+        self._poll_interval = poll_interval
+        self._msgid = None
+
+    def __iter__(self):
+        if self._sync:
+            ctrl = makeControl(SYNC_REQUEST_OID, encodeSyncRequest(), True)
+            entry_oid = SYNC_STATE_OID
+        else:
+            ctrl = makeControl(PSEARCH_OID, encodePersistentSearch(), True)
+            entry_oid = ENTRY_CHANGE_OID
+        conn = self._conn
+        self._msgid = conn.search_ext(self._base, ldap.SCOPE_SUBTREE,
+                                      '(objectClass=*)', ['1.1'],
+                                      serverctrls=[ctrl])
+        while self._conn is not None:
+            try:
+                rtype, data = self._result(entry_oid)
+            except ldap.TIMEOUT:
+                rtype = data = None
+            if rtype is None:
+                yield None
+                continue
+            if rtype == ldap.RES_SEARCH_RESULT:
+                self._msgid = None
+                raise ChangeFeedError("The LDAP server ended the change "
+                                      "feed search")
+            if rtype != ldap.RES_SEARCH_ENTRY:
+                # Search references, synchronization messages
+                continue
+            for item in data:
+                if len(item) > 2:
+                    ctrls = item[2]
+                else:
+                    ctrls = ()
+                yield self._getChange(item[0], getControlValue(ctrls,
+                                                               entry_oid))
+
+    def _result(self, entry_oid):
+        conn = self._conn
+        if getattr(conn, 'result4', None) is not None:
+            # python-ldap >= 2.4 drops the controls it doesn't know
+            res = conn.result4(self._msgid, all=0,
+                               timeout=self._poll_interval, add_ctrls=1,
+                               resp_ctrl_classes={
+                                   entry_oid: ldap.controls.LDAPControl})
+        else:
+            res = conn.result3(self._msgid, all=0,
+                               timeout=self._poll_interval)
+        return res[0], res[1]
+
+    def _getChange(self, dn, value):
+        if value is None:
+            return 'modify', dn, None
+        if self._sync:
+            state, entry_uuid, cookie = decodeSyncState(value)
+            change_type = _sync_change_types.get(state)
+            if change_type is None:
+                # Present entries are unchanged
+                return None
+            return change_type, dn, None
+        change_type, previous_dn, number = decodeEntryChange(value)
+        return _entry_change_types.get(change_type, 'modify'), dn, previous_dn
+
+    def close(self):
+        """Stop the search and close the connection."""
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        if self._msgid is not None:
+            try:
+                conn.abandon(self._msgid)
+            except ldap.LDAPError, e:
+                logger.debug("Error abandoning change feed search: %s", e)
+            self._msgid = None
+        closeConnection(conn)
+
+
 class LDAPBackingDirectory(BaseDirectory, Cacheable):
     """LDAP Backing Directory.
 
@@ -167,14 +673,16 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
     list of children can be a list of 'cn' instead of 'dn', this can be set
     using the children_id_attr property.
     """
-    implements(IDirectory)
+    implements(IDirectory, IBatchable, IOrderable)
 
     meta_type = 'CPS LDAP Backing Directory'
 
     manage_options = (
         BaseDirectory.manage_options +
-        Cacheable.manage_options
-        )
+        Cacheable.manage_options + (
+        {'label': 'Cache Statistics', 'action': 'manage_cacheStatistics'},
+        {'label': 'Replica', 'action': 'manage_replica'},
+        ))
 
     security = ClassSecurityInfo()
 
@@ -211,8 +719,38 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
          'label': 'LDAP auto reconnect feature: delay in seconds before retrying'},
         {'id': 'ldap_timeout', 'type': 'float', 'mode': 'w',
          'label': 'LDAP network timeout in seconds for any request (0 means no limit)'},
+        {'id': 'ldap_page_size', 'type': 'int', 'mode': 'w',
+         'label': 'LDAP page size for searches (0 means no paging)'},
         {'id': 'ldap_case_sensitive', 'type': 'boolean', 'mode': 'w',
          'label': "Is the underlying LDAP sensitive regarding its id field"},
+        {'id': 'ldap_optimistic_writes', 'type': 'boolean', 'mode': 'w',
+         'label': "Create and delete entries without checking first "
+                  "whether they exist"},
+        {'id': 'ldap_exists_cache_ttl', 'type': 'float', 'mode': 'w',
+         'label': "Time in seconds during which the existence of an entry "
+                  "is cached (0 means no caching)"},
+        {'id': 'ldap_missing_cache_ttl', 'type': 'float', 'mode': 'w',
+         'label': "Time in seconds during which the absence of an entry "
+                  "is cached (0 means no caching)"},
+        {'id': 'ldap_lazy_fields', 'type': 'tokens', 'mode': 'w',
+         'label': "Fields read only when used (large binary attributes)"},
+        {'id': 'ldap_change_feed', 'type': 'selection', 'mode': 'w',
+         'select_variable': 'all_ldap_change_feeds',
+         'label': "Change feed evicting the cached results changed by "
+                  "other applications"},
+        {'id': 'ldap_change_log', 'type': 'string', 'mode': 'w',
+         'label': "LDIF change log file (for the 'log' change feed)"},
+        {'id': 'ldap_replica', 'type': 'boolean', 'mode': 'w',
+         'label': "Serve reads and searches from a local replica"},
+        {'id': 'ldap_replica_watermark_attr', 'type': 'selection', 'mode': 'w',
+         'select_variable': 'all_ldap_replica_watermark_attrs',
+         'label': "Attribute telling which entries changed since the last "
+                  "sync of the replica"},
+        {'id': 'ldap_replica_sync_interval', 'type': 'float', 'mode': 'w',
+         'label': "Time in seconds after the last sync of the replica "
+                  "when reads go back to LDAP (0 means never)"},
+        {'id': 'ldap_replica_indexed_attrs', 'type': 'tokens', 'mode': 'w',
+         'label': "Attributes indexed in the replica"},
         )
 
     implemented_encryptions = ('SSHA', 'SHA', 'MD5', 'none')
@@ -242,16 +780,30 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
     ldap_scope_c = ldap.SCOPE_SUBTREE
     ldap_search_classes_c = ['person']
     ldap_search_classes_filter = '(objectClass=person)'
+    ldap_search_filter_c = None
     ldap_object_classes_c = ['top', 'person']
     ldap_retry_max = 1
     ldap_retry_delay = 60.0
     ldap_timeout = 0
+    ldap_page_size = 0
     ldap_case_sensitive = True
+    ldap_optimistic_writes = False
+    ldap_exists_cache_ttl = 0.0
+    ldap_missing_cache_ttl = 0.0
+    ldap_lazy_fields = ()
+    ldap_change_feed = ''
+    ldap_change_log = ''
+    ldap_replica = False
+    ldap_replica_watermark_attr = 'modifyTimestamp'
+    ldap_replica_sync_interval = 0.0
+    ldap_replica_indexed_attrs = ()
+
+    _replica = None
 
     all_password_encryptions = ('none',)
     all_ldap_scopes = ('ONELEVEL', 'SUBTREE')
-
-    _v_conn = None
+    all_ldap_change_feeds = ('', 'psearch', 'syncrepl', 'log')
+    all_ldap_replica_watermark_attrs = ('modifyTimestamp', 'entryCSN')
 
     def __init__(self, id, **kw):
         BaseDirectory.__init__(self, id, **kw)
@@ -286,9 +838,167 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         else:
             filt = '(objectClass=*)'
         self.ldap_search_classes_filter = filt
-        # Reset connection (XXX problems with multiple threads)
-        self._v_conn = None
+        self.ldap_search_filter_c = self._makeSearchFilter()
+        self._getFilterCache().clear()
+        self._getExistenceCache().clear()
         self.ZCacheable_invalidate()
+        # Restarted with the new settings by the next search
+        stopChangeListener(self.getPhysicalPath())
+        if not self.ldap_replica and self._replica is not None:
+            # It wouldn't be kept up to date anymore
+            self._replica = None
+
+    #
+    # ZMI
+    #
+
+    security.declareProtected(ManagePortal, 'manage_cacheStatistics')
+    manage_cacheStatistics = DTMLFile(
+        'zmi/ldapbackingdirectory_cache_statistics', globals())
+
+    security.declareProtected(ManagePortal, 'getCacheStatistics')
+    def getCacheStatistics(self):
+        """Get the statistics of the cache of existing and missing entries.
+
+        Returns a dict with the numbers of hits on existing and missing
+        entries, misses, expired answers, and of answers kept.
+        """
+        return self._getExistenceCache().getStatistics()
+
+    security.declareProtected(ManagePortal, 'manage_resetCacheStatistics')
+    def manage_resetCacheStatistics(self, REQUEST=None):
+        """Reset the statistics of the existence and search caches (ZMI).
+        """
+        self._getExistenceCache().resetCounters()
+        self._getCacheTracker().resetCounters()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_cacheStatistics?manage_tabs_message=Reset.')
+
+    security.declareProtected(ManagePortal, 'manage_clearExistenceCache')
+    def manage_clearExistenceCache(self, REQUEST=None):
+        """Forget the cached existing and missing entries (ZMI)."""
+        self._getExistenceCache().clear()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_cacheStatistics?manage_tabs_message=Cleared.')
+
+    security.declareProtected(ManagePortal, 'getChangeFeedStatistics')
+    def getChangeFeedStatistics(self):
+        """Get the status of the change feed and of the search cache.
+
+        Returns a dict with the hits, misses and evictions of the cached
+        search results, the number of change events kept, and the status
+        of the change feed listener of this process: whether it runs and
+        is connected, the numbers of changes and errors, and the time of
+        the last ones.
+        """
+        stats = self._getCacheTracker().getStatistics()
+        listener = getChangeListener(self.getPhysicalPath())
+        if listener is not None:
+            stats.update(listener.getStatistics())
+        else:
+            stats.update({
+                'running': False,
+                'connected': False,
+                'changes': 0,
+                'errors': 0,
+                'last_change': None,
+                'last_error': None,
+                })
+        return stats
+
+    security.declareProtected(ManagePortal, 'manage_restartChangeFeed')
+    def manage_restartChangeFeed(self, REQUEST=None):
+        """Restart the change feed listener of this process (ZMI)."""
+        stopChangeListener(self.getPhysicalPath())
+        self._checkChangeListener()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_cacheStatistics?manage_tabs_message=Restarted.')
+
+    security.declareProtected(ManagePortal, 'manage_replica')
+    manage_replica = DTMLFile('zmi/ldapbackingdirectory_replica', globals())
+
+    security.declareProtected(ManagePortal, 'getReplicaStatus')
+    def getReplicaStatus(self):
+        """Get the status of the local replica.
+
+        Returns a dict telling whether the replica is enabled, loaded with
+        the current settings, and usable (not synced too long ago), with
+        its number of entries, its watermark, the start times of the last
+        sync and of the last full load, the duration and the numbers of
+        changed and removed entries of the last sync, and the lag: the
+        time in seconds since the data was read from LDAP (None if it
+        never was).
+        """
+        status = {
+            'enabled': bool(self.ldap_replica),
+            'loaded': False,
+            'usable': False,
+            'entries': 0,
+            'watermark': None,
+            'last_sync': None,
+            'last_full_sync': None,
+            'last_duration': None,
+            'last_changes': 0,
+            'last_removals': 0,
+            'lag': None,
+            }
+        replica = self._replica
+        if replica is None:
+            return status
+        status.update({
+            'loaded': (status['enabled']
+                       and replica.source == self._getReplicaSource()),
+            'usable': self._getUsableReplica() is not None,
+            'entries': len(replica),
+            'watermark': replica.watermark,
+            'last_sync': replica.last_sync,
+            'last_full_sync': replica.last_full_sync,
+            'last_duration': replica.last_duration,
+            'last_changes': replica.last_changes,
+            'last_removals': replica.last_removals,
+            })
+        if replica.last_sync is not None:
+            status['lag'] = time.time() - replica.last_sync
+        return status
+
+    security.declareProtected(ManagePortal, 'manage_syncReplica')
+    def manage_syncReplica(self, full=False, REQUEST=None):
+        """Sync the local replica now (ZMI)."""
+        res = self.syncReplica(full=full)
+        if REQUEST is not None:
+            if res is None:
+                message = 'A sync is already running.'
+            else:
+                message = 'Synced: %s changed, %s removed.' % res
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_replica?'+urlencode({'manage_tabs_message': message}))
+
+    security.declareProtected(ManagePortal, 'syncReplica')
+    def syncReplica(self, full=False):
+        """Bring the local replica up to date with LDAP.
+
+        Only the entries whose watermark attribute changed since the last
+        sync are read, unless full is true or the settings changed: the
+        replica is then loaded again from scratch. Removed entries are
+        found by listing the dns of all the entries. Without watermark
+        (the server doesn't provide the attribute), all the entries are
+        read, and only the changes are applied.
+
+        Reads never sync the replica: call this regularly (cron), more
+        often than ldap_replica_sync_interval if it is set. Returns the
+        numbers of changed and removed entries, or None if another thread
+        of this process is already syncing.
+        """
+        key = self.getPhysicalPath()
+        if not beginSync(key):
+            return None
+        try:
+            return self._syncReplica(full)
+        finally:
+            endSync(key)
 
     security.declarePrivate('_getAdapters')
     def _getAdapters(self, id, search=0, **kw):
@@ -320,7 +1030,7 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         return self._searchEntries()
 
     security.declarePrivate('_searchEntries')
-    def _searchEntries(self, return_fields=None, **kw):
+    def _searchEntries(self, return_fields=None, query_options=None, **kw):
         """Search for entries in the directory.
 
         See API in the base class.
@@ -329,6 +1039,18 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         - Returns all entries if query is empty.
         - Keys with empty values are removed.
         - Keys with value '*' search for an existing field.
+
+        Extension: query_options is a mapping containing one or several of:
+        - limit: for batching
+        - offset: for batching
+        - count: for batching (return just a count of entries)
+        - order_by: for batching (is a basestring or a tuple)
+        - reverse: for batching (reversed order)
+
+        Sorting is done by the server when it supports the server side
+        sort control, and batches are then fetched using virtual list
+        views if it supports them too. Otherwise the results are sorted
+        here, keeping only the requested batch.
         """
         # Find attrs needed to compute returned fields.
         attrs, return_fields = self._getSearchFields(return_fields)
@@ -337,9 +1059,63 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
 
         # Build filter
         filter = self._buildFilter(kw)
+        if query_options:
+            return self._searchEntriesBatched(filter, attrs, query_options)
         res = self._searchEntriesFiltered(filter, attrs)
         return res
 
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, query_options=None,
+                           **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        See API in the base class.
+
+        Results are fetched by pages of batch_size entries using the
+        paged results control. The cache isn't used. With query_options,
+        results are those of _searchEntries.
+
+        The iterator holds an LDAP connection until all the results have
+        been read: callers that stop before must call its close() method.
+        """
+        if query_options:
+            return ClosingIterator(self._searchEntries(
+                return_fields=return_fields, query_options=query_options,
+                **kw))
+        attrs, return_fields = self._getSearchFields(return_fields)
+        if return_fields is None:
+            attrs = ['dn']
+        filter = self._buildFilter(kw)
+        results = self.iterSearchLDAP(self.ldap_base, self.ldap_scope_c,
+                                      filter, self._getFetchedAttrs(attrs),
+                                      page_size=batch_size)
+        if return_fields is None:
+            return ClosingIterator(results, lambda result: result[0])
+        return self._iterConvertResults(results, attrs)
+
+    def _iterConvertResults(self, results, return_attrs):
+        """Iterate over the converted (dn, entry) of LDAP results.
+
+        Returns a ClosingIterator, closing results when closed.
+        """
+        adapter = self._getAdapterForPartialData(return_attrs)
+        converters = self._getLDAPConverters(adapter._schema)
+        def convert(result):
+            dn, ldap_entry = result
+            return dn, self._convertSearchResult(adapter, dn, ldap_entry,
+                                                 converters)
+        return ClosingIterator(results, convert)
+
+    def _convertSearchResult(self, adapter, dn, ldap_entry, converters=None):
+        """Compute the entry returned by a search from LDAP data."""
+        entry = self.convertDataFromLDAP(dn, ldap_entry, converters)
+        # We must compute a partial datamodel for each result,
+        # to get correct computed fields.
+        data = adapter._getData(entry=entry)
+        adapter.finalizeDefaults(data)
+        return data
+
     security.declarePrivate('_hasEntry')
     def _hasEntry(self, id):
         """Does the directory have a given entry?"""
@@ -391,6 +1167,7 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         except ldap.INVALID_CREDENTIALS:
             logger.log(5, 'searchLDAP: Invalid credentials for %s', id)
             raise AuthenticationFailed
+        self.releaseLDAP(conn)
         # Caller is responsible for providing a valid dn. We don't catch errors
         return prefetched
 
@@ -398,6 +1175,33 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
     security.declarePrivate('_createEntry')
     def _createEntry(self, entry):
         """Create an entry in the directory."""
+        dn, ldap_attrs = self._makeLDAPEntry(entry)
+        if not self.ldap_optimistic_writes and self._hasEntry(dn):
+            raise KeyError("Entry '%s' already exists" % dn)
+        self.insertLDAP(dn, ldap_attrs)
+        return dn
+
+    security.declarePrivate('_createEntries')
+    def _createEntries(self, entries):
+        """Create several entries in the directory.
+
+        The additions are sent on one connection without waiting for each
+        result. If some entries already exist, KeyError is raised once
+        the others have been created.
+        """
+        items = []
+        for entry in entries:
+            dn, ldap_attrs = self._makeLDAPEntry(entry)
+            if not self.ldap_optimistic_writes and self._hasEntry(dn):
+                raise KeyError("Entry '%s' already exists" % dn)
+            items.append((dn, ldap_attrs))
+        existing = self.insertManyLDAP(items)
+        if existing:
+            raise KeyError("Entries already exist: %s" % ', '.join(existing))
+        return [dn for dn, ldap_attrs in items]
+
+    def _makeLDAPEntry(self, entry):
+        """Compute the dn and the LDAP attributes of an entry to create."""
         ldap_attrs = self.convertDataToLDAP(entry)
         if entry.get('dn'):
             dn = entry['dn']
@@ -424,18 +1228,18 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
                     raise ValueError("base_dn '%s' must be under base '%s'" %
                                      (base_dn, self.ldap_base))
             dn = implodeDN((ava, base_dn))
-
-        if self._hasEntry(dn):
-            raise KeyError("Entry '%s' already exists" % dn)
-
         ldap_attrs['objectClass'] = list(self.ldap_object_classes_c)
-        self.insertLDAP(dn, ldap_attrs)
-        return dn
+        return dn, ldap_attrs
 
     security.declarePrivate('_deleteEntry')
     def _deleteEntry(self, id):
         """Delete an entry in the directory."""
-        if not self._hasEntry(id):
+        if self.ldap_optimistic_writes:
+            try:
+                self.checkUnderBase(id)
+            except ValueError:
+                raise KeyError("No entry '%s'" % id)
+        elif not self._hasEntry(id):
             raise KeyError("No entry '%s'" % id)
         self.deleteLDAP(id)
 
@@ -526,14 +1330,35 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
 
         Returns converted values.
         """
+        dn, ldap_entry = self._getLDAPEntry(id, field_ids, password=password)
+        return self.convertDataFromLDAP(dn, ldap_entry)
+
+    def _getLDAPEntry(self, id, field_ids, password=None):
+        """Get the LDAP values of an entry, as (dn, ldap_entry).
+
+        Lazy fields are not read.
+        """
+        dn, ldap_entry, fresh = self._readLDAPEntry(id, field_ids,
+                                                    password=password)
+        return dn, ldap_entry
+
+    def _readLDAPEntry(self, id, field_ids, password=None):
+        """Get the LDAP values of an entry, as (dn, ldap_entry, fresh).
+
+        fresh is true if the values were just read from the server, and
+        not from the cache or the replica.
+        """
         try:
             self.checkUnderBase(id)
         except ValueError:
             raise KeyError(id)
+        if password is None and self._getCachedExistence(id) is False:
+            raise KeyError("No entry '%s'" % id)
         filter = self.searchFilter()
         try:
-            results = self.searchLDAP(id, ldap.SCOPE_BASE, filter,
-                                      field_ids, password=password)
+            results, fresh = self._searchLDAP(
+                id, ldap.SCOPE_BASE, filter, self._getFetchedAttrs(field_ids),
+                password=password)
         except (ldap.INVALID_CREDENTIALS,
                 ldap.INAPPROPRIATE_AUTH,
                 ldap.UNWILLING_TO_PERFORM):
@@ -547,21 +1372,82 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             else:
                 logger.log(5, '_getEntryFromLDAP: Invalid credentials for %s', id)
                 raise AuthenticationFailed
+        if password is None:
+            self._setCachedExistence(id, not not results)
         if not results:
             raise KeyError("No entry '%s'" % id)
         dn, ldap_entry = results[0]
-        entry = self.convertDataFromLDAP(dn, ldap_entry)
-        return entry
+        return dn, ldap_entry, fresh
 
     def _buildFilter(self, query):
         """Build an LDAP filter from a query.
 
         Returns a non-encoded LDAP filter. It will have to be UTF-8
         encoded before being passed to LDAP.
+
+        The filter is compiled once for each query shape (see
+        _getQueryShape) into a template, kept in an LRU cache, that
+        only has to be filled with the escaped values.
         """
-        all_field_ids = self._getFieldIds()
-        filter_elems = [self.searchFilter()]
+        shape = self._getQueryShape(query)
+        cache = self._getFilterCache()
+        compiled = cache.get(shape)
+        if compiled is None:
+            compiled = self._compileFilter(shape, query)
+            cache.set(shape, compiled)
+        template, args_keys = compiled
+        escape = ldap.filter.escape_filter_chars
+        args = []
+        for key, kind in args_keys:
+            value = query[key]
+            if kind == 'seq':
+                args.extend([escape(v) for v in value if v])
+            elif kind == 'int':
+                args.append(str(value))
+            else:
+                args.append(escape(value))
+        return template % tuple(args)
+
+    def _getQueryShape(self, query):
+        """Get the shape of a query, what its filter depends on.
+
+        It's a sorted tuple of (key, kind, substring) for the non empty
+        values of the query, kind depending on the type of the value
+        (and on the value itself for '*' and booleans, or the number of
+        non empty items for sequences).
+        """
+        substring_fields = self.search_substring_fields
+        shape = []
         for key, value in query.items():
+            if not value and not value is False:
+                continue
+            if isinstance(value, basestring):
+                if value == '*':
+                    kind = ('present',)
+                else:
+                    kind = ('str',)
+            elif isinstance(value, bool):
+                kind = ('bool', value)
+            elif isinstance(value, int):
+                kind = ('int',)
+            elif isinstance(value, (list, tuple)):
+                kind = ('seq', len([v for v in value if v]))
+            else:
+                kind = ('other',)
+            shape.append((key, kind, key in substring_fields))
+        shape.sort()
+        return tuple(shape)
+
+    def _compileFilter(self, shape, query):
+        """Compile the filter for a query shape.
+
+        Returns a (template, args_keys) tuple, args_keys being the
+        sequence of (key, kind) whose escaped values fill the template.
+        """
+        all_field_ids = self._getFieldIds()
+        filter_elems = [self.searchFilter().replace('%', '%%')]
+        args_keys = []
+        for key, kind, substring in shape:
             if not key in all_field_ids:
                 continue
             if key == 'dn': # XXX treat it
@@ -572,38 +1458,64 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
                 # Invalid attribute for LDAP (Bad search filter (87)).
                 logger.error("_buildFilter: Invalid LDAP attribute '%s', ignored", key)
                 continue
-            if not value and not value is False:
-                continue
-            if key in self.search_substring_fields:
-                fmt = '(%s=*%s*)'
+            attr = ldap.filter.escape_filter_chars(key).replace('%', '%%')
+            if substring:
+                fmt = '(%s=*%%s*)' % attr
             else:
-                fmt = '(%s=%s)'
-            if isinstance(value, basestring):
-                if value == '*':
-                    f = ldap.filter.filter_format('(%s=*)', (key,))
-                else:
-                    f = ldap.filter.filter_format(fmt, (key, value))
-            elif isinstance(value, bool):
-                f = ldap.filter.filter_format(
-                    fmt, (key, value and LDAP_TRUE or LDAP_FALSE))
-            elif isinstance(value, int):
-                f = ldap.filter.filter_format(fmt, (key, str(value)))
-            elif isinstance(value, (list, tuple)):
+                fmt = '(%s=%%s)' % attr
+            if kind[0] == 'present':
+                f = '(%s=*)' % attr
+            elif kind[0] == 'bool':
+                f = fmt % (kind[1] and LDAP_TRUE or LDAP_FALSE)
+            elif kind[0] in ('str', 'int'):
+                f = fmt
+                args_keys.append((key, kind[0]))
+            elif kind[0] == 'seq':
                 # Always use exact match if a sequence is passed
-                fl = [ldap.filter.filter_format('(%s=%s)', (key, v))
-                      for v in value if v]
-                f = ''.join(fl)
-                if len(fl) > 1:
+                n = kind[1]
+                f = '(%s=%%s)' % attr * n
+                if n > 1:
                     f = '(|%s)' % f
+                if n:
+                    args_keys.append((key, kind[0]))
             else:
-                raise ValueError("Bad value %s for '%s'" % (`value`, key))
+                raise ValueError("Bad value %s for '%s'" % (`query[key]`, key))
             if f:
                 filter_elems.append(f)
-        filter_elems.sort()
         filter = ''.join(filter_elems)
         if len(filter_elems) > 1:
             filter = '(&%s)' % filter
-        return filter
+        return filter, tuple(args_keys)
+
+    def _getFilterCache(self):
+        """Get the LRU cache of compiled filters.
+
+        It's volatile: it's per ZODB connection, and dropped when the
+        directory changes.
+        """
+        cache = getattr(self, '_v_filter_cache', None)
+        if cache is None:
+            cache = self._v_filter_cache = LRUCache(FILTER_CACHE_SIZE)
+        return cache
+
+    security.declareProtected(ManagePortal, 'explainFilter')
+    def explainFilter(self, **kw):
+        """Explain the LDAP filter built for a query.
+
+        Returns a dict with the filter, the query shape it is compiled
+        for, whether the compiled filter was already cached, and the
+        statistics of the cache.
+        """
+        shape = self._getQueryShape(kw)
+        cache = self._getFilterCache()
+        cached = shape in cache
+        filter = self._buildFilter(kw)
+        return {
+            'filter': filter,
+            'shape': shape,
+            'cached': cached,
+            'statistics': cache.getStatistics(),
+            }
 
     def _searchEntriesFiltered(self, filter, return_attrs):
         """Search entries according to filter."""
@@ -613,24 +1525,57 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             attrs = return_attrs
 
         results = self.searchLDAP(self.ldap_base, self.ldap_scope_c,
-                                  filter, attrs)
+                                  filter, self._getFetchedAttrs(attrs))
 
         if return_attrs is None:
             return [dn for dn, e in results]
         else:
-            adapter = self._getAdapterForPartialData(return_attrs)
-            res = []
-            for dn, ldap_entry in results:
-                entry = self.convertDataFromLDAP(dn, ldap_entry)
-                # We must compute a partial datamodel for each result,
-                # to get correct computed fields.
-                data = adapter._getData(entry=entry)
-                adapter.finalizeDefaults(data)
-                res.append((dn, data))
-            return res
+            return list(self._iterConvertResults(results, return_attrs))
+
+    def _searchEntriesBatched(self, filter, return_attrs, query_options):
+        """Search entries according to filter and query options."""
+        if query_options.get('count'):
+            return [len(self._searchEntriesFiltered(filter, None))]
+        order_by = query_options.get('order_by') or ()
+        if isinstance(order_by, basestring):
+            order_by = (order_by,)
+        reverse = query_options.get('reverse')
+        offset = query_options.get('offset') or 0
+        limit = query_options.get('limit') or None
+        if return_attrs is None:
+            attrs = ['dn']
+        else:
+            attrs = self._getFetchedAttrs(return_attrs)
+
+        if order_by:
+            results = self.sortedSearchLDAP(self.ldap_base, self.ldap_scope_c,
+                                            filter, attrs, order_by,
+                                            reverse=reverse, offset=offset,
+                                            limit=limit)
+        else:
+            results = self.searchLDAP(self.ldap_base, self.ldap_scope_c,
+                                      filter, attrs)
+            if reverse:
+                results = list(results)
+                results.reverse()
+            if limit is not None:
+                results = results[offset:offset+limit]
+            elif offset:
+                results = results[offset:]
+
+        if return_attrs is None:
+            return [dn for dn, e in results]
+        return list(self._iterConvertResults(results, return_attrs))
 
     security.declarePrivate('searchFilter')
     def searchFilter(self):
+        """Get the search filter for the entries."""
+        filter = self.ldap_search_filter_c
+        if filter is None:
+            filter = self._makeSearchFilter()
+        return filter
+
+    def _makeSearchFilter(self):
         """Build the search filter for the entries."""
         filter = self.ldap_search_classes_filter
         other = self.ldap_search_filter.strip()
@@ -674,6 +1619,9 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             if not data.has_key(field_id):
                 continue
             value = data[field_id]
+            if isinstance(value, LazyValue) and not value.isLoaded():
+                # Unchanged lazy field
+                continue
             if not value and not value is False and not keep_empty:
                 continue
             if field_id == self.password_field:
@@ -696,27 +1644,70 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             ldap_attrs[field_id] = values
         return ldap_attrs
 
+    security.declarePrivate('_getLDAPConverters')
+    def _getLDAPConverters(self, schema=None):
+        """Get the table of the fields converting LDAP attributes.
+
+        Maps each attribute name to its field. The password field is
+        left out, passwords are never read, and so is the dn.
+
+        Optional schema is used, otherwise directory global schemas are.
+        """
+        if schema is None:
+            schema = self._getUniqueSchema()
+        converters = dict(schema.items())
+        converters.pop('dn', None)
+        if self.password_field:
+            converters.pop(self.password_field, None)
+        return converters
+
     security.declarePrivate('convertDataFromLDAP')
-    def convertDataFromLDAP(self, dn, ldap_entry):
-        """Convert LDAP values to a user data mapping."""
+    def convertDataFromLDAP(self, dn, ldap_entry, converters=None):
+        """Convert LDAP values to a user data mapping.
+
+        Only the attributes present in ldap_entry are converted, using
+        the table of converters if it is passed. Lazy fields that were
+        not read get a value reading them when used.
+        """
+        if converters is None:
+            converters = self._getLDAPConverters()
         entry = {}
-        for field_id, field in self._getFieldItems():
-            if not ldap_entry.has_key(field_id):
-                continue
-            # don't get passwords - ever
-            if field_id == self.password_field:
-                value = ''
+        for field_id, values in ldap_entry.items():
+            field = converters.get(field_id)
+            if field is None:
                 continue
-            values = ldap_entry[field_id]
             try:
                 value = field.convertFromLDAP(values)
             except ValidationError:
                 # XXX
                 raise
             entry[field_id] = value
+        for field_id in self.ldap_lazy_fields:
+            if field_id not in entry and field_id in converters:
+                entry[field_id] = LazyValue(self._readLazyField, dn,
+                                            field_id, converters[field_id])
         entry['dn'] = dn # Not converted, still UTF-8
         return entry
 
+    def _getFetchedAttrs(self, attrs):
+        """Get the attributes to read from LDAP, leaving out lazy fields.
+        """
+        lazy = self.ldap_lazy_fields
+        if not lazy or attrs is None:
+            return attrs
+        fetched = [attr for attr in attrs if attr not in lazy]
+        if not fetched:
+            # An empty list would mean all the attributes
+            fetched = ['dn']
+        return fetched
+
+    def _readLazyField(self, dn, field_id, field):
+        """Read the value of a lazy field of an entry."""
+        values = self.getAttributeLDAP(dn, field_id)
+        if not values:
+            return field.getDefault()
+        return field.convertFromLDAP(values)
+
     security.declarePrivate('checkUnderBase')
     def checkUnderBase(self, dn):
         """Check that dn is under the base."""
@@ -735,97 +1726,462 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         pass
 
     security.declarePrivate('connectLDAP')
-    def connectLDAP(self, bind_dn=None, bind_password=None, retrying=False):
-        """Get or initialize a connection to the LDAP server.
-
-        If bind_dn and bind_password are provided, bind using them.
-        Otherwise bind using the global bind dn and password.
+    def connectLDAP(self, bind_dn=None, bind_password=None):
+        """Get a connection to the LDAP server.
+
+        If bind_dn and bind_password are provided, the connection is
+        borrowed from the pool used to check user credentials, and bound
+        using them. Otherwise the connection is borrowed from the pool
+        of connections bound using the global bind dn and password. Both
+        pools are shared by all the directories using the same LDAP
+        Server Access.
+
+        In both cases the connection must be given back using
+        releaseLDAP.
         """
-        conn = self._v_conn
-
         self.setupSpecificOptions()
+        # Pools are shared between threads: the factory must only use
+        # plain values, not this persistent object
+        options = {
+            'retry_max': self.ldap_retry_max,
+            'retry_delay': self.ldap_retry_delay,
+            'timeout': self.ldap_timeout,
+            }
+        # Directories with other options get their own pools
+        pool_options = tuple(sorted(options.items()))
         server_access = self._getLdapServerAccess()
+        def factory(url, bind_dn, bind_password):
+            return openConnection(url, bind_dn, bind_password, **options)
+        if bind_dn is None:
+            pool = server_access.getConnectionPool(factory, checkConnection,
+                                                   options=pool_options)
+            try:
+                return pool.borrow()
+            except ldap.SERVER_DOWN, exception:
+                raise ConfigurationError("Directory '%s': LDAP server is "
+                                         "down: %s" % (self.getId(),
+                                                       str(exception)))
+            except ldap.INVALID_CREDENTIALS:
+                raise ConfigurationError("Directory '%s': Invalid credentials"
+                                         % self.getId())
+        # User credentials check: service connections are never rebound
+        pool = server_access.getAuthConnectionPool(factory,
+                                                   options=pool_options)
+        try:
+            conn = pool.borrow()
+        except ldap.SERVER_DOWN, exception:
+            raise ConfigurationError("Directory '%s': LDAP server is down: %s"
+                                     % (self.getId(), str(exception)))
+        logger.log(5, 'connectLDAP: bind_s dn=%s', bind_dn)
+        try:
+            conn.simple_bind_s(bind_dn, bind_password)
+        except ldap.SERVER_DOWN, exception:
+            self.releaseLDAP(conn, broken=True)
+            raise ConfigurationError("Directory '%s': LDAP server is down: %s"
+                                     % (self.getId(), str(exception)))
+        except:
+            self.releaseLDAP(conn)
+            raise
+        return conn
 
-        # Saving for retrying
-        bind_dn_orig = bind_dn
-        bind_password_orig = bind_password
+    security.declarePrivate('releaseLDAP')
+    def releaseLDAP(self, conn, broken=False):
+        """Give back a connection obtained from connectLDAP.
 
-        if conn is None:
-            conn_str = server_access.getLdapUrl()
-            logger.log(5, 'connectLDAP: initialize conn_str=%s', conn_str)
-            conn = ldap.ldapobject.ReconnectLDAPObject(
-                conn_str, retry_max=self.ldap_retry_max,
-                retry_delay=self.ldap_retry_delay)
-            if self.ldap_timeout > 0:
-                conn.timeout = self.ldap_timeout
-            try:
-                conn.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
-            except ldap.LDAPError:
-                conn.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION2)
+        Connections that are broken or not pooled are closed.
+        """
+        pool = getattr(conn, '_cps_pool', None)
+        if pool is None:
+            closeConnection(conn)
+        else:
+            pool.release(conn, broken=broken)
 
-            # Auto-chase referrals.
+    security.declarePrivate('existsLDAP')
+    def existsLDAP(self, dn):
+        """Return true if the entry exists.
+
+        The answer is cached if ldap_exists_cache_ttl or
+        ldap_missing_cache_ttl is set. It comes from the local replica
+        if there is one.
+        """
+        exists = self._getCachedExistence(dn)
+        if exists is not None:
+            return exists
+        filter = self.searchFilter()
+        res = self._searchReplica(dn, ldap.SCOPE_BASE, filter, ['dn'])
+        if res is None:
+            conn = self.connectLDAP()
             try:
-                conn.set_option(ldap.OPT_REFERRALS, 1)
-            except ldap.LDAPError:
-                # Forget about it.
-                logger.debug('connectLDAP: No referrals')
-                pass
+                try:
+                    logger.log(5, 'existsLDAP: search_s dn=%s', dn)
+                    res = conn.search_s(dn, ldap.SCOPE_BASE, filter, ['dn'])
+                    logger.log(5, 'existsLDAP: -> results=%s', res)
+                except ldap.NO_SUCH_OBJECT:
+                    res = ()
+            finally:
+                self.releaseLDAP(conn)
+        exists = len(res) != 0
+        self._setCachedExistence(dn, exists)
+        return exists
+
+    def _getExistenceCache(self):
+        """Get the cache of existing and missing entries."""
+        return getExistenceCache(self.getPhysicalPath())
+
+    def _getExistenceKey(self, dn):
+        if self.ldap_case_sensitive:
+            return dn
+        return dn.lower()
+
+    def _getThumbnailEntryId(self, dn):
+        """Get the id under which the thumbnails of an entry are kept.
+
+        It is the one the change feed gives.
+        """
+        return self._getExistenceKey(dn)
 
-            #conn.manage_dsa_it(0)
+    def _getCachedExistence(self, dn):
+        """Get whether an entry is known to exist.
 
-            conn._cps_bound_dn = None
-            conn._cps_bound_password = None
+        Returns True or False, or None if it isn't known.
+        """
+        ttl = self.ldap_exists_cache_ttl
+        negative_ttl = self.ldap_missing_cache_ttl
+        if ttl <= 0 and negative_ttl <= 0:
+            return None
+        return self._getExistenceCache().get(self._getExistenceKey(dn),
+                                             ttl, negative_ttl)
 
-            self._v_conn = conn
+    def _setCachedExistence(self, dn, exists):
+        """Record whether an entry exists.
 
-        # Check how to bind
-        if bind_dn is None:
-            bind_dn, bind_password = server_access.getBindParameters()
-            using_config_bind = True
+        If that answer isn't cached, the previous one is forgotten.
+        """
+        max_age = max(self.ldap_exists_cache_ttl, self.ldap_missing_cache_ttl)
+        if max_age <= 0:
+            return
+        if exists:
+            ttl = self.ldap_exists_cache_ttl
         else:
-            using_config_bind = False
+            ttl = self.ldap_missing_cache_ttl
+        cache = self._getExistenceCache()
+        if ttl <= 0:
+            cache.invalidate(self._getExistenceKey(dn))
+        else:
+            cache.set(self._getExistenceKey(dn), exists, max_age=max_age)
 
-        if (conn._cps_bound_dn == bind_dn and
-            conn._cps_bound_password == bind_password):
-            return conn
+    def _invalidateCachedExistence(self, dn):
+        """Forget whether an entry exists."""
+        self._getExistenceCache().invalidate(self._getExistenceKey(dn))
 
-        # Bind with authentication
-        conn._cps_bound_dn = None
-        conn._cps_bound_password = None
-        logger.log(5, 'connectLDAP: bind_s dn=%s', bind_dn)
+    security.declarePrivate('_getCacheTracker')
+    def _getCacheTracker(self):
+        """Get the tracker of the changes, for cache validation."""
+        return getCacheTracker(self.getPhysicalPath())
+
+    security.declarePrivate('_checkChangeListener')
+    def _checkChangeListener(self):
+        """Start the change feed listener of this process, if needed.
+
+        The listener is restarted if the settings changed, possibly in
+        another process. It records the changed dns in the cache
+        tracker, and forgets whether they exist and their thumbnails.
+
+        Returns the listener, or None if there is no change feed.
+        """
+        key = self.getPhysicalPath()
+        kind = self.ldap_change_feed
+        if not kind or (kind == 'log' and not self.ldap_change_log):
+            if getChangeListener(key) is not None:
+                stopChangeListener(key)
+            return None
+        case_sensitive = self.ldap_case_sensitive
+        # The listener runs in its own thread: the factory and callbacks
+        # must only use plain values, not this persistent object
+        if kind == 'log':
+            path = self.ldap_change_log
+            config = (kind, case_sensitive, path)
+            def feed_factory():
+                return LogFileFeed(path)
+        else:
+            server_access = self._getLdapServerAccess()
+            url = server_access.getLdapUrl()
+            bind_dn, bind_password = server_access.getBindParameters()
+            base = self.ldap_base
+            sync = kind == 'syncrepl'
+            options = {
+                'retry_max': self.ldap_retry_max,
+                'retry_delay': self.ldap_retry_delay,
+                'timeout': self.ldap_timeout,
+                }
+            config = (kind, case_sensitive, url, bind_dn, bind_password,
+                      base)
+            def feed_factory():
+                conn = openConnection(url, bind_dn, bind_password, **options)
+                return LDAPChangeFeed(conn, base, sync=sync)
+        tracker = self._getCacheTracker()
+        existence = self._getExistenceCache()
+        thumbnails = getThumbnailCache()
+        dir_path = '/'.join(key)
+        def on_change(change_type, dn, previous_dn):
+            for changed in (dn, previous_dn):
+                if changed is None:
+                    continue
+                tracker.recordChange(getChangeKey(changed))
+                if not case_sensitive:
+                    changed = changed.lower()
+                existence.invalidate(changed)
+                # see _getThumbnailEntryId
+                thumbnails.invalidate(dir_path, changed)
+        def on_reset():
+            tracker.recordFlush()
+            existence.clear()
+        return startChangeListener(key, config, feed_factory, on_change,
+                                   on_reset)
+
+    security.declarePrivate('_isCachedSearchValid')
+    def _isCachedSearchValid(self, stamp, base, scope, listener=None):
+        """Check that a cached search result is still valid.
+
+        It's not valid anymore if an entry in the scope of the search
+        changed since, or if the change feed listener is disconnected.
+        """
+        if listener is not None and not listener.connected:
+            # Changes can't be known
+            return False
+        events = self._getCacheTracker().getEventsSince(stamp)
+        if events is None:
+            return False
+        if not events:
+            return True
+        base_key = getChangeKey(base)
+        for serial, key, old, new in events:
+            if isInSearchScope(key, base_key, scope):
+                return False
+        return True
+
+    def _getReplicaAttrs(self):
+        """Get the attributes kept in the replica.
+
+        They are those of the fields, except the lazy ones, plus the
+        object classes and the watermark attribute.
+        """
+        ignored = ['dn', 'base_dn'] + list(self.ldap_lazy_fields)
+        attrs = []
+        for attr in (self._getFieldIds() + self._getFieldIds(search=True)
+                     + ['objectClass', self.ldap_replica_watermark_attr]):
+            if attr not in ignored and attr not in attrs:
+                attrs.append(attr)
+        return attrs
+
+    def _getReplicaSource(self):
+        """Get the settings the replica depends on, as a tuple."""
+        return (self.ldap_base, self.ldap_scope_c, self.searchFilter(),
+                self.ldap_replica_watermark_attr,
+                tuple(self._getReplicaAttrs()),
+                tuple(self.ldap_replica_indexed_attrs))
+
+    def _syncReplica(self, full):
+        start = time.time()
+        source = self._getReplicaSource()
+        base, scope, filter, wm_attr, attrs, indexed_attrs = source
+        replica = self._replica
+        if full or replica is None or replica.source != source:
+            replica = LDAPReplica(source, getChangeKey(base), scope, attrs,
+                                  indexed_attrs)
+            full = True
+        watermark = replica.watermark
+        sync_filter = filter
+        if not full and watermark:
+            since = getWatermarkStart(watermark, REPLICA_SYNC_OVERLAP)
+            if since is not None:
+                sync_filter = '(&%s(%s>=%s))' % (filter, wm_attr, since)
+        logger.debug("syncReplica: reading entries matching %s", sync_filter)
+        wm_attr = wm_attr.lower()
+        changed = []
+        removed = []
+        conn = self.connectLDAP()
+        broken = False
         try:
-            conn.simple_bind_s(bind_dn, bind_password)
-        except ldap.SERVER_DOWN, exception:
-            # retry with an empty connection only once
-            self._v_conn = None
-            if retrying:
-                raise ConfigurationError("Directory '%s': LDAP server is down: %s"
-                                         % (self.getId(), str(exception)))
-            else:
-                return self.connectLDAP(bind_dn=bind_dn_orig,
-                        bind_password=bind_password_orig, retrying=True)
-        except ldap.INVALID_CREDENTIALS:
-            if not using_config_bind:
-                raise
-            raise ConfigurationError("Directory '%s': Invalid credentials"
-                                     % self.getId())
-        conn._cps_bound_dn = bind_dn
-        conn._cps_bound_password = bind_password
+            try:
+                for dn, ldap_entry in PagedSearch(conn, base, scope,
+                                                  toUTF8(sync_filter),
+                                                  list(attrs),
+                                                  self.ldap_page_size):
+                    change_key = getChangeKey(dn)
+                    if replica.setEntry(change_key, dn, ldap_entry):
+                        changed.append((change_key, dn))
+                    for attr, values in ldap_entry.items():
+                        if attr.lower() == wm_attr and values:
+                            watermark = max([watermark] + list(values))
+                if not full:
+                    # Entries deleted, or not matching the filter anymore
+                    existing = set()
+                    for dn, ldap_entry in PagedSearch(conn, base, scope,
+                                                      toUTF8(filter), ['1.1'],
+                                                      self.ldap_page_size):
+                        existing.add(getChangeKey(dn))
+                    for change_key in replica.keys():
+                        if change_key not in existing:
+                            dn = replica.getEntry(change_key)[0]
+                            replica.removeEntry(change_key)
+                            removed.append((change_key, dn))
+            except ldap.NO_SUCH_OBJECT:
+                raise ConfigurationError("Directory '%s': Invalid search "
+                                         "base '%s'" % (self.getId(), base))
+            except ldap.SERVER_DOWN, exception:
+                broken = True
+                raise ConfigurationError("Directory '%s': LDAP server is "
+                                         "down: %s" % (self.getId(),
+                                                       str(exception)))
+        finally:
+            self.releaseLDAP(conn, broken=broken)
+
+        replica.watermark = watermark
+        replica.last_sync = start
+        if full:
+            replica.last_full_sync = start
+        replica.last_duration = time.time() - start
+        replica.last_changes = len(changed)
+        replica.last_removals = len(removed)
+        if replica is not self._replica:
+            self._replica = replica
+        # Evict the cached results and existence answers that changed
+        tracker = self._getCacheTracker()
+        if full:
+            tracker.recordFlush()
+            self._getExistenceCache().clear()
+        else:
+            for change_key, dn in changed + removed:
+                tracker.recordChange(change_key)
+                self._invalidateCachedExistence(dn)
+        logger.debug("syncReplica: %s entries changed, %s removed in %.3fs",
+                     len(changed), len(removed), replica.last_duration)
+        return len(changed), len(removed)
+
+    def _getUsableReplica(self):
+        """Get the replica to read from, or None.
+
+        Reads never sync the replica: this is done by syncReplica, called
+        from the ZMI or regularly (cron), so that requests don't write to
+        the ZODB. Until the replica is loaded with the current settings,
+        or when it wasn't synced for more than ldap_replica_sync_interval
+        seconds (if not 0), reads go to LDAP.
+        """
+        if not self.ldap_replica:
+            return None
+        replica = self._replica
+        if replica is None or replica.source != self._getReplicaSource():
+            return None
+        interval = self.ldap_replica_sync_interval
+        if interval > 0 and (replica.last_sync is None
+                             or time.time() - replica.last_sync > interval):
+            logger.debug("Directory '%s': replica not synced for more than "
+                         "%ss, reading from LDAP", self.getId(), interval)
+            return None
+        return replica
+
+    def _parseReplicaFilter(self, filter):
+        """Parse a filter to evaluate it on the replica.
+
+        The search filter of the directory, that all the replicated
+        entries match, is removed from it. Returns None for a filter
+        matching all the entries, and False if it can't be evaluated.
+        Parsed filters are kept in the cache of compiled filters.
+        """
+        search_filter = self.searchFilter()
+        key = ('replica', search_filter, filter)
+        cache = self._getFilterCache()
+        if key in cache:
+            return cache.get(key)
+        try:
+            node = removeTerm(parseFilter(toUTF8(filter)),
+                              parseFilter(toUTF8(search_filter)))
+        except FilterError, e:
+            logger.debug("_parseReplicaFilter: %s", e)
+            node = False
+        cache.set(key, node)
+        return node
+
+    security.declarePrivate('_searchReplica')
+    def _searchReplica(self, base, scope, filter, attrs):
+        """Search in the local replica.
+
+        Returns a sequence of (dn, entry), or None if the replica can't
+        answer: it's disabled or doesn't match the settings, or the
+        search is outside of the replicated entries, uses attributes that
+        aren't replicated or a filter that isn't supported.
+        """
+        replica = self._getUsableReplica()
+        if replica is None:
+            return None
+        base_key = getChangeKey(base)
+        if (not replica.covers(base_key, scope)
+            or not replica.hasAttributes(attrs)):
+            return None
+        node = self._parseReplicaFilter(filter)
+        if node is False:
+            return None
+        logger.log(5, '_searchReplica: base=%s scope=%s filter=%s attrs=%s',
+                   base, scope, filter, attrs)
+        return replica.search(base_key, scope, node, attrs)
+
+    def _refreshReplica(self, dns):
+        """Read again from LDAP some entries of the replica just written.
+
+        The watermark doesn't change: if the transaction is aborted, the
+        writes are still seen by the next sync.
+        """
+        replica = self._replica
+        if (not self.ldap_replica or replica is None
+            or replica.source != self._getReplicaSource()):
+            return
+        filter = toUTF8(self.searchFilter())
+        attrs = list(replica.attrs)
+        conn = self.connectLDAP()
+        try:
+            for dn in dns:
+                change_key = getChangeKey(dn)
+                if not replica.covers(change_key, ldap.SCOPE_BASE):
+                    continue
+                logger.log(5, '_refreshReplica: search_s dn=%s', dn)
+                try:
+                    res = conn.search_s(dn, ldap.SCOPE_BASE, filter, attrs)
+                except ldap.NO_SUCH_OBJECT:
+                    res = ()
+                if res:
+                    replica.setEntry(change_key, res[0][0], res[0][1])
+                else:
+                    replica.removeEntry(change_key)
+        finally:
+            self.releaseLDAP(conn)
 
-        return conn
+    def _removeFromReplica(self, dn):
+        """Remove a deleted entry from the replica."""
+        if self._replica is not None:
+            self._replica.removeEntry(getChangeKey(dn))
 
-    security.declarePrivate('existsLDAP')
-    def existsLDAP(self, dn):
-        """Return true if the entry exists."""
+    security.declarePrivate('getAttributeLDAP')
+    def getAttributeLDAP(self, dn, attr):
+        """Get the values of one attribute of an entry.
+
+        The search results cache isn't used, this is meant for large
+        values. Returns None if the entry doesn't have the attribute.
+        """
+        conn = self.connectLDAP()
         try:
-            conn = self.connectLDAP()
-            logger.log(5, 'existsLDAP: search_s dn=%s', dn)
-            filter = self.searchFilter()
-            res = conn.search_s(dn, ldap.SCOPE_BASE, filter, ['dn'])
-            logger.log(5, 'existsLDAP: -> results=%s', res)
-        except ldap.NO_SUCH_OBJECT:
-            return 0
-        return len(res) != 0
+            logger.log(5, 'getAttributeLDAP: search_s dn=%s attr=%s',
+                       dn, attr)
+            try:
+                res = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                                    [attr])
+            except ldap.NO_SUCH_OBJECT:
+                res = ()
+        finally:
+            self.releaseLDAP(conn)
+        if not res:
+            raise KeyError("No entry '%s'" % dn)
+        return res[0][1].get(attr)
 
     security.declarePrivate('searchLDAP')
     def searchLDAP(self, base, scope, filter, attrs, password=None):
@@ -834,7 +2190,18 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         Returns a sequence of (dn, entry).
         entry's values are already converted from LDAP format.
 
-        If password is provided, attempt to bind using it.
+        If password is provided, attempt to bind using it. Otherwise the
+        local replica is searched if there is one and it can answer.
+        """
+        return self._searchLDAP(base, scope, filter, attrs,
+                                password=password)[0]
+
+    def _searchLDAP(self, base, scope, filter, attrs, password=None):
+        """Search in LDAP, telling where the results come from.
+
+        Returns (results, fresh) where results are those of searchLDAP,
+        and fresh is true if they were just read from the server, false
+        if they come from the cache or the replica.
         """
         if self.ZCacheable_isCachingEnabled():
             attrs = list(attrs)
@@ -848,14 +2215,38 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             if password is not None:
                 keyset['password'] = password
             logger.log(5, 'searchLDAP: Searching cache for %s', keyset)
-            ldap_entries = self.ZCacheable_get(keywords=keyset)
-            if ldap_entries is not None:
-                logger.log(5, 'searchLDAP: -> results=%s', ldap_entries[:20])
-                return ldap_entries
+            tracker = self._getCacheTracker()
+            stamp = tracker.getStamp()
+            listener = self._checkChangeListener()
+            from_cache = self.ZCacheable_get(keywords=keyset)
+            if from_cache is None:
+                tracker.miss()
+            else:
+                cached_stamp, ldap_entries = from_cache
+                if self._isCachedSearchValid(cached_stamp, base, scope,
+                                             listener):
+                    logger.log(5, 'searchLDAP: -> results=%s',
+                               ldap_entries[:20])
+                    tracker.hit()
+                    if cached_stamp != stamp:
+                        # Don't check the same changes again next time
+                        self.ZCacheable_set((stamp, ldap_entries),
+                                            keywords=keyset)
+                    return ldap_entries, False
+                logger.log(5, 'searchLDAP: -> stale')
+                tracker.evict()
         else:
             keyset = None
 
         if password is None:
+            ldap_entries = self._searchReplica(base, scope, filter, attrs)
+            if ldap_entries is not None:
+                logger.log(5, 'searchLDAP: -> results from replica=%s',
+                           ldap_entries[:20])
+                if keyset is not None:
+                    self.ZCacheable_set((stamp, ldap_entries),
+                                        keywords=keyset)
+                return ldap_entries, False
             conn = self.connectLDAP()
         else:
             if scope != ldap.SCOPE_BASE:
@@ -868,7 +2259,7 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
             except ldap.INVALID_DN_SYNTAX:
                 logger.log(5, 'searchLDAP: Invalid credentials (dn syntax) for'
                            ' %s', base)
-                return []
+                return [], False
             except ldap.INVALID_CREDENTIALS:
                 logger.log(5, 'searchLDAP: Invalid credentials for %s', base)
                 raise AuthenticationFailed
@@ -876,25 +2267,134 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         logger.log(5, 'searchLDAP: search_s base=%s scope=%s filter=%s '
                    'attrs=%s', base, scope, filter, attrs)
 
+        broken = False
         try:
-            ldap_entries = conn.search_s(base, scope, toUTF8(filter), attrs)
-        except ldap.NO_SUCH_OBJECT:
-            raise ConfigurationError("Directory '%s': Invalid search base "
-                                     "'%s'" % (self.getId(), base))
-        except ldap.SERVER_DOWN, exception:
-            raise ConfigurationError("Directory '%s': LDAP server is down: %s"
-                                     % (self.getId(), str(exception)))
+            try:
+                if (password is None and scope != ldap.SCOPE_BASE
+                    and self.ldap_page_size > 0):
+                    ldap_entries = list(PagedSearch(conn, base, scope,
+                                                    toUTF8(filter), attrs,
+                                                    self.ldap_page_size))
+                else:
+                    ldap_entries = conn.search_s(base, scope, toUTF8(filter),
+                                                 attrs)
+            except ldap.NO_SUCH_OBJECT:
+                raise ConfigurationError("Directory '%s': Invalid search "
+                                         "base '%s'" % (self.getId(), base))
+            except ldap.SERVER_DOWN, exception:
+                broken = True
+                raise ConfigurationError("Directory '%s': LDAP server is "
+                                         "down: %s" % (self.getId(),
+                                                       str(exception)))
+        finally:
+            self.releaseLDAP(conn, broken=broken)
         logger.log(5, 'searchLDAP: -> results=%s', ldap_entries[:20])
-        #except ldap.NO_SUCH_OBJECT:
-        #except ldap.SIZELIMIT_EXCEEDED:
-        # XXX: might try to fetch partial results with ldap.async:
-        # http://python-ldap.sourceforge.net/doc/python-ldap/ldap.async-example.List.html
 
         if keyset is not None:
             logger.log(5, 'searchLDAP: Putting in cache')
-            self.ZCacheable_set(ldap_entries, keywords=keyset)
+            self.ZCacheable_set((stamp, ldap_entries), keywords=keyset)
+
+        return ldap_entries, True
+
+    def _getSupportedControls(self, conn):
+        """Get the OIDs of the controls supported by the server.
 
-        return ldap_entries
+        They are kept with the connection pool, so that the root DSE is
+        only read once.
+        """
+        pool = getattr(conn, '_cps_pool', None)
+        if pool is None:
+            return getSupportedControls(conn)
+        controls = pool.server_info.get('supportedControl')
+        if controls is None:
+            controls = getSupportedControls(conn)
+            pool.server_info['supportedControl'] = controls
+        return controls
+
+    security.declarePrivate('sortedSearchLDAP')
+    def sortedSearchLDAP(self, base, scope, filter, attrs, order_by,
+                         reverse=False, offset=0, limit=None):
+        """Search in LDAP, sorting the results on some attributes.
+
+        Returns a sequence of (dn, entry), keeping limit of them from
+        offset if limit is not None. Entries without a value sort last,
+        or first in reverse order. The cache isn't used.
+
+        If the server advertises the server side sort control, it sorts
+        the results, and if it also advertises the virtual list view
+        control, only the requested results are fetched. Otherwise the
+        results are read page by page and sorted here, only keeping the
+        best offset+limit of them. The local replica is sorted the same
+        way.
+        """
+        filter = toUTF8(filter)
+        attrs = list(attrs)
+        for attr in order_by:
+            if attr not in attrs and attr != 'dn':
+                attrs.append(attr)
+        results = self._searchReplica(base, scope, filter, attrs)
+        if results is not None:
+            return sortResults(results, order_by, reverse, offset, limit)
+        conn = self.connectLDAP()
+        logger.log(5, 'sortedSearchLDAP: base=%s scope=%s filter=%s '
+                   'attrs=%s order_by=%s', base, scope, filter, attrs,
+                   order_by)
+        broken = False
+        try:
+            try:
+                supported = self._getSupportedControls(conn)
+                if SORT_REQUEST_OID in supported and 'dn' not in order_by:
+                    vlv = VLV_REQUEST_OID in supported
+                    results, is_sorted, is_batch = searchSorted(
+                        conn, base, scope, filter, attrs, order_by,
+                        reverse=reverse, offset=offset, limit=limit, vlv=vlv)
+                    if is_batch:
+                        return results
+                    if not is_sorted:
+                        logger.debug('sortedSearchLDAP: server did not sort '
+                                     'on %s', order_by)
+                        return sortResults(results, order_by, reverse,
+                                           offset, limit)
+                    if limit is not None:
+                        return results[offset:offset+limit]
+                    return results[offset:]
+                results = PagedSearch(conn, base, scope, filter, attrs,
+                                      self.ldap_page_size)
+                return sortResults(results, order_by, reverse, offset, limit)
+            except ldap.NO_SUCH_OBJECT:
+                raise ConfigurationError("Directory '%s': Invalid search "
+                                         "base '%s'" % (self.getId(), base))
+            except ldap.SERVER_DOWN, exception:
+                broken = True
+                raise ConfigurationError("Directory '%s': LDAP server is "
+                                         "down: %s" % (self.getId(),
+                                                       str(exception)))
+        finally:
+            self.releaseLDAP(conn, broken=broken)
+
+    security.declarePrivate('iterSearchLDAP')
+    def iterSearchLDAP(self, base, scope, filter, attrs, page_size=None):
+        """Search in LDAP, iterating over the results.
+
+        Returns an iterator of (dn, entry), fetching the results by pages
+        of page_size entries (ldap_page_size by default), so that large
+        searches don't have to be kept in memory. The cache isn't used.
+
+        The iterator uses a connection until all the results have been
+        read or it is closed: callers that stop before the end must call
+        its close() method. Results from the local replica are all read
+        at once.
+        """
+        results = self._searchReplica(base, scope, filter, attrs)
+        if results is not None:
+            return ClosingIterator(results)
+        conn = self.connectLDAP()
+        logger.log(5, 'iterSearchLDAP: base=%s scope=%s filter=%s attrs=%s',
+                   base, scope, filter, attrs)
+        if page_size is None:
+            page_size = self.ldap_page_size
+        return PagedSearch(conn, base, scope, toUTF8(filter), attrs,
+                           page_size, release=self.releaseLDAP)
 
     def _insufficientAccess(self, e):
         try:
@@ -911,11 +2411,20 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         """Delete an entry from LDAP."""
         # maybe check read_only
         conn = self.connectLDAP()
-        logger.log(5, 'deleteLDAP: delete_s dn=%s', dn)
         try:
-            conn.delete_s(dn)
-        except ldap.INSUFFICIENT_ACCESS, e:
-            raise self._insufficientAccess(e)
+            logger.log(5, 'deleteLDAP: delete_s dn=%s', dn)
+            try:
+                conn.delete_s(dn)
+            except ldap.NO_SUCH_OBJECT:
+                self._setCachedExistence(dn, False)
+                self._removeFromReplica(dn)
+                raise KeyError("No entry '%s'" % dn)
+            except ldap.INSUFFICIENT_ACCESS, e:
+                raise self._insufficientAccess(e)
+        finally:
+            self.releaseLDAP(conn)
+        self._setCachedExistence(dn, False)
+        self._removeFromReplica(dn)
         self.ZCacheable_invalidate()
 
     security.declarePrivate('insertLDAP')
@@ -924,63 +2433,152 @@ class LDAPBackingDirectory(BaseDirectory, Cacheable):
         # maybe check read_only
         attrs_list = [(k, v) for k, v in ldap_attrs.items()]
         conn = self.connectLDAP()
-        logger.log(5, 'insertLDAP: add_s dn=%s attrs=%s', dn, attrs_list)
         try:
-            conn.add_s(dn, attrs_list)
-        except ldap.INSUFFICIENT_ACCESS, e:
-            raise self._insufficientAccess(e)
+            logger.log(5, 'insertLDAP: add_s dn=%s attrs=%s', dn, attrs_list)
+            try:
+                conn.add_s(dn, attrs_list)
+            except ldap.ALREADY_EXISTS:
+                self._setCachedExistence(dn, True)
+                raise KeyError("Entry '%s' already exists" % dn)
+            except ldap.INSUFFICIENT_ACCESS, e:
+                raise self._insufficientAccess(e)
+        finally:
+            self.releaseLDAP(conn)
+        self._setCachedExistence(dn, True)
+        self._refreshReplica([dn])
         self.ZCacheable_invalidate()
         # FIXME: except ldap.OBJECT_CLASS_VIOLATION:
         # {'info': "unrecognized objectClass 'evolutionPerson'", ...}
 
+    security.declarePrivate('insertManyLDAP')
+    def insertManyLDAP(self, items):
+        """Insert several new entries in LDAP.
+
+        items is a sequence of (dn, ldap_attrs). Additions are sent by
+        batches of ADD_PIPELINE_SIZE, without waiting for each result.
+
+        Returns the dns of the entries that already existed. Other errors
+        are raised once the results of all the additions have been read.
+        """
+        existing = []
+        written = []
+        error = None
+        broken = False
+        conn = self.connectLDAP()
+        try:
+            try:
+                for batch in iterBatches(items, ADD_PIPELINE_SIZE):
+                    msgids = []
+                    for dn, ldap_attrs in batch:
+                        written.append(dn)
+                        attrs_list = ldap_attrs.items()
+                        logger.log(5, 'insertManyLDAP: add_ext dn=%s attrs=%s',
+                                   dn, attrs_list)
+                        msgids.append((dn, conn.add_ext(dn, attrs_list)))
+                    for dn, msgid in msgids:
+                        try:
+                            conn.result(msgid)
+                            self._setCachedExistence(dn, True)
+                        except ldap.ALREADY_EXISTS:
+                            existing.append(dn)
+                            self._setCachedExistence(dn, True)
+                        except ldap.SERVER_DOWN:
+                            raise
+                        except ldap.INSUFFICIENT_ACCESS, e:
+                            if error is None:
+                                error = (ConfigurationError,
+                                         self._insufficientAccess(e), None)
+                        except:
+                            self._invalidateCachedExistence(dn)
+                            if error is None:
+                                error = sys.exc_info()
+            except ldap.SERVER_DOWN, exception:
+                broken = True
+                raise ConfigurationError("Directory '%s': LDAP server is "
+                                         "down: %s" % (self.getId(),
+                                                       str(exception)))
+        finally:
+            self.releaseLDAP(conn, broken=broken)
+            self.ZCacheable_invalidate()
+        self._refreshReplica(written)
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return existing
+
     security.declarePrivate('modifyLDAP')
-    def modifyLDAP(self, dn, ldap_attrs):
-        """Modify an entry in LDAP."""
-        if not ldap_attrs:
+    def modifyLDAP(self, dn, ldap_attrs, current=None):
+        """Modify an entry in LDAP.
+
+        current maps attributes to their LDAP values as just read from
+        the server by the caller, None meaning that the attribute is
+        absent: values from the cache or the replica may be behind LDAP,
+        and a change back to them would be lost. Only the other modified
+        attributes are read before the modification.
+        """
+        # No way to changed dn like that
+        # Do it through modrdn XXX
+        keys = [key for key in ldap_attrs.keys() if key != 'dn']
+        if not keys:
             # nothing to change
             return
         # maybe check read_only
-        conn = self.connectLDAP()
-
         rdn = explodeDN(dn)[0]
         rdn_split = explodeRDN(rdn)
         rdn_attrs = [ava.split('=')[0] for ava in rdn_split]
+        if current is None:
+            current = {}
 
-        # Get current entry
-        logger.log(5, 'modifyLDAP: search_s base dn=%s', dn)
-        # (use objectClass=* because dn is already assumed valid
-        #  and also we'd like the *LDAP methods to be generic)
-        res = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)')
-        logger.log(5, 'modifyLDAP: -> results=%s', res)
-        if not res:
-            raise KeyError("No entry '%s'" % dn)
-        cur_dn, cur_ldap_entry = res[0]
-
-        # Find modifications
-        mod_list = []
-        for key, values in ldap_attrs.items():
-            if key == 'dn':
-                # No way to changed dn like that
-                # Do it through modrdn XXX
-                continue
-            if cur_ldap_entry.has_key(key):
+        conn = self.connectLDAP()
+        try:
+            # Get current values of the attributes that are not known
+            cur_ldap_entry = {}
+            unknown = []
+            for key in keys:
+                if not current.has_key(key):
+                    unknown.append(key)
+                elif current[key] is not None:
+                    cur_ldap_entry[key] = current[key]
+            if unknown:
+                logger.log(5, 'modifyLDAP: search_s base dn=%s attrs=%s',
+                           dn, unknown)
+                # (use objectClass=* because dn is already assumed valid
+                #  and also we'd like the *LDAP methods to be generic)
+                res = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                                    unknown)
+                logger.log(5, 'modifyLDAP: -> results=%s', res)
+                if not res:
+                    raise KeyError("No entry '%s'" % dn)
+                cur_ldap_entry.update(res[0][1])
+
+            # Find modifications
+            mod_list = []
+            for key in keys:
+                values = ldap_attrs[key]
                 if values == ['']:
-                    if key in rdn_attrs:
-                        raise ValueError("Cannot delete rdn attribute '%s'"
-                                         % key)
-                    mod_list.append((ldap.MOD_DELETE, key, None))
-                elif cur_ldap_entry[key] != values:
-                    if key in rdn_attrs:
+                    if cur_ldap_entry.has_key(key):
+                        if key in rdn_attrs:
+                            raise ValueError("Cannot delete rdn attribute "
+                                             "'%s'" % key)
+                        mod_list.append((ldap.MOD_DELETE, key, None))
+                elif cur_ldap_entry.get(key) != values:
+                    if cur_ldap_entry.has_key(key) and key in rdn_attrs:
                         raise ValueError("Modrdn not implemented")
+                    # Also adds the attribute if it is absent
                     mod_list.append((ldap.MOD_REPLACE, key, values))
-            else:
-                if values != ['']:
-                    mod_list.append((ldap.MOD_ADD, key, values))
-        if not mod_list:
-            return
+            if not mod_list:
+                return
 
-        logger.log(5, 'modifyLDAP: modify_s dn=%s mod_list=%s', dn, mod_list)
-        conn.modify_s(dn, mod_list)
+            logger.log(5, 'modifyLDAP: modify_s dn=%s mod_list=%s',
+                       dn, mod_list)
+            try:
+                conn.modify_s(dn, mod_list)
+            except ldap.NO_SUCH_OBJECT:
+                self._setCachedExistence(dn, False)
+                self._removeFromReplica(dn)
+                raise KeyError("No entry '%s'" % dn)
+        finally:
+            self.releaseLDAP(conn)
+        self._refreshReplica([dn])
         self.ZCacheable_invalidate()
 
 
@@ -998,6 +2596,8 @@ class LDAPBackingStorageAdapter(BaseDirectoryStorageMixin, BaseStorageAdapter):
         self._id = id
         self._dir = dir
         self._password = password
+        # LDAP values read by getData, reused to compute modifications
+        self._ldap_snapshot = None
         BaseStorageAdapter.__init__(self, schema, **kw)
 
     def getMandatoryFieldIds(self):
@@ -1014,8 +2614,18 @@ class LDAPBackingStorageAdapter(BaseDirectoryStorageMixin, BaseStorageAdapter):
             return self.getDefaultData()
 
         field_ids = self.getReadableFieldIds()
-        entry = self._dir._getEntryFromLDAP(id, field_ids,
-                                            password=self._password)
+        dir = self._dir
+        dn, ldap_entry, fresh = dir._readLDAPEntry(id, field_ids,
+                                                   password=self._password)
+        if fresh:
+            self._ldap_snapshot = dict([(field_id, ldap_entry.get(field_id))
+                                        for field_id in
+                                        dir._getFetchedAttrs(field_ids)])
+        else:
+            # Cached values may be behind LDAP, modifyLDAP reads them again
+            self._ldap_snapshot = None
+        entry = dir.convertDataFromLDAP(
+            dn, ldap_entry, dir._getLDAPConverters(self._schema))
         return self._getData(entry=entry)
 
     def _getFieldData(self, field_id, field, entry=None):
@@ -1045,7 +2655,9 @@ class LDAPBackingStorageAdapter(BaseDirectoryStorageMixin, BaseStorageAdapter):
         dir = self._dir
         ldap_attrs = dir.convertDataToLDAP(data, keep_empty=1,
                                            schema=self._schema)
-        dir.modifyLDAP(dn, ldap_attrs)
+        dir.modifyLDAP(dn, ldap_attrs, current=self._ldap_snapshot)
+        # The entry changed, don't reuse the values read
+        self._ldap_snapshot = None
 
     def _getContentUrl(self, entry_id, field_id):
         deprecate_getContentUrl()
@@ -22,16 +22,23 @@
 from logging import getLogger
 
 from Globals import InitializeClass
+from Globals import DTMLFile
 from AccessControl import ClassSecurityInfo
 
+from Products.CMFCore.permissions import ManagePortal
+
 from Products.CMFCore.utils import SimpleItemWithProperties
 from Products.CPSUtil.property import PropertiesPostProcessor
 from Products.CPSDirectory.interfaces import ILDAPServerAccess
+from Products.CPSDirectory import ldappool
 
 from zope.interface import implements
 
 logger = getLogger('CPSDirectory.LDAPServerAccess')
 
+# Connections used to check user credentials are closed sooner
+AUTH_POOL_IDLE_TIMEOUT = 60.0
+
 class LDAPServerAccess(PropertiesPostProcessor, SimpleItemWithProperties):
     """LDAP Server Access.
 
@@ -49,6 +56,9 @@ class LDAPServerAccess(PropertiesPostProcessor, SimpleItemWithProperties):
         {'label': 'Export',
          'action': 'manage_genericSetupExport.html',
          },
+        {'label': 'Connection Pool',
+         'action': 'manage_connectionPool',
+         },
         )
 
     security = ClassSecurityInfo()
@@ -65,6 +75,13 @@ class LDAPServerAccess(PropertiesPostProcessor, SimpleItemWithProperties):
          'label': 'LDAP bind dn'},
         {'id': 'bind_password', 'type': 'string', 'mode': 'w',
          'label': 'LDAP bind password'},
+        {'id': 'pool_min_size', 'type': 'int', 'mode': 'w',
+         'label': 'Connection pool: idle connections always kept'},
+        {'id': 'pool_max_size', 'type': 'int', 'mode': 'w',
+         'label': 'Connection pool: maximum number of connections'},
+        {'id': 'pool_idle_timeout', 'type': 'float', 'mode': 'w',
+         'label': 'Connection pool: delay in seconds before closing '
+                  'idle connections'},
         )
 
     # same defaults as customary in CPSLDAPSetup
@@ -73,6 +90,9 @@ class LDAPServerAccess(PropertiesPostProcessor, SimpleItemWithProperties):
     use_ssl = 0
     bind_dn = 'cn=cps,ou=applications,dc=mysite,dc=net'
     bind_password = 'changeme'
+    pool_min_size = ldappool.DEFAULT_MIN_SIZE
+    pool_max_size = ldappool.DEFAULT_MAX_SIZE
+    pool_idle_timeout = ldappool.DEFAULT_IDLE_TIMEOUT
     url = None
 
     def __init__(self, id, **kw):
@@ -115,4 +135,89 @@ class LDAPServerAccess(PropertiesPostProcessor, SimpleItemWithProperties):
     def getBindParameters(self):
         return self.bind_dn, self.bind_password
 
+    def _getPoolKey(self, auth=False):
+        if auth:
+            return (self.getLdapUrl(), 'auth')
+        bind_dn, bind_password = self.getBindParameters()
+        return (self.getLdapUrl(), bind_dn, bind_password)
+
+    security.declarePrivate('getConnectionPool')
+    def getConnectionPool(self, factory, check=None, options=()):
+        """Get the pool of connections bound with the bind parameters.
+
+        The pool is shared by all the users of the same server,
+        credentials and options in the process. factory(url, bind_dn,
+        bind_password) opens and binds a connection, check(conn) raises
+        an exception if a connection is broken. They are only used by
+        the first caller, that creates the pool. options is a hashable
+        description of how factory opens connections (retries,
+        timeout): users with different options get different pools.
+        """
+        url, bind_dn, bind_password = self._getPoolKey()
+        key = (url, bind_dn, bind_password, options)
+        def openConnection():
+            return factory(url, bind_dn, bind_password)
+        return ldappool.getPool(key, openConnection, check=check,
+                                min_size=self.pool_min_size,
+                                max_size=self.pool_max_size,
+                                idle_timeout=self.pool_idle_timeout)
+
+    security.declarePrivate('getAuthConnectionPool')
+    def getAuthConnectionPool(self, factory, options=()):
+        """Get the pool of connections used to check user credentials.
+
+        These connections are only used to bind as users, so that the
+        connections bound with the bind parameters never change
+        identity. factory(url, None, None) opens a connection without
+        binding it. options is as for getConnectionPool.
+        """
+        url = self.getLdapUrl()
+        def openConnection():
+            return factory(url, None, None)
+        key = self._getPoolKey(auth=True) + (options,)
+        return ldappool.getPool(key, openConnection,
+                                min_size=0,
+                                max_size=self.pool_max_size,
+                                idle_timeout=AUTH_POOL_IDLE_TIMEOUT)
+
+    #
+    # ZMI
+    #
+
+    security.declareProtected(ManagePortal, 'manage_connectionPool')
+    manage_connectionPool = DTMLFile('zmi/ldapserveraccess_pool', globals())
+
+    security.declareProtected(ManagePortal, 'getConnectionPoolStatistics')
+    def getConnectionPoolStatistics(self, auth=False):
+        """Get the statistics of the connection pools, or None.
+
+        The counters of the pools of the different options are added.
+        If auth is true, get those of the pools used to check user
+        credentials.
+        """
+        pools = ldappool.listPools(self._getPoolKey(auth=auth))
+        if not pools:
+            return None
+        total = None
+        for pool in pools:
+            stats = pool.getStatistics()
+            if total is None:
+                total = stats
+                continue
+            for key, value in stats.items():
+                if key not in ('min_size', 'max_size'):
+                    total[key] += value
+        return total
+
+    security.declareProtected(ManagePortal, 'manage_resetConnectionPool')
+    def manage_resetConnectionPool(self, REQUEST=None):
+        """Close the idle connections and reset the statistics."""
+        for auth in (False, True):
+            for pool in ldappool.listPools(self._getPoolKey(auth=auth)):
+                pool.closeIdle()
+                pool.resetCounters()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url() +
+                                      '/manage_connectionPool')
+
 InitializeClass(LDAPServerAccess)
@@ -197,7 +197,7 @@ class MembersDirectory(BaseDirectory):
             if not entry.has_key(key):
                 continue
             dm[key] = entry[key]
-        dm._commit()
+        self._commitDataModel(dm, id)
 
 
     security.declarePrivate('_deleteEntry')
@@ -39,11 +39,13 @@ from Products.CPSSchemas.StorageAdapter import BaseStorageAdapter
 from Products.CPSSchemas.StorageAdapter import deprecate_getContentUrl
 
 from Products.CPSDirectory.utils import QueryMatcher
+from Products.CPSDirectory.utils import iterBatches
 
 from Products.CPSDirectory.BaseDirectory import BaseDirectory
 from Products.CPSDirectory.BaseDirectory import BaseDirectoryStorageMixin
 from Products.CPSDirectory.BaseDirectory import AuthenticationFailed
 from Products.CPSDirectory.BaseDirectory import ConfigurationError
+from Products.CPSDirectory.BaseDirectory import SEARCH_BATCH_SIZE
 
 from Products.CPSDirectory.interfaces import IMetaDirectory
 
@@ -291,7 +293,7 @@ class MetaDirectory(BaseDirectory):
         # XXX Should use better API
         for adapter in dm._adapters:
             adapter.setContextObject(id)
-        dm._commit()
+        self._commitDataModel(dm, id)
 
     security.declarePrivate('_deleteEntry')
     def _deleteEntry(self, id):
@@ -315,6 +317,101 @@ class MetaDirectory(BaseDirectory):
 
         See API in the base class.
         """
+        b_queries = self._getBackingQueries(return_fields, kw)
+
+        # Do searches
+        acc_res = None
+        for info, b_return_fields, b_query, b_matched in b_queries:
+            b_dir = info['dir']
+
+            # Do query
+            #print ' subquery dir=%s rf=%s query=%s' % ( # XXX
+            #    info['dir_id'], b_return_fields, b_query)
+            b_res = b_dir._searchEntries(return_fields=b_return_fields,
+                                        **b_query)
+            #print ' res=%s' % `b_res`
+            res = self._convertBackingResults(b_res, info, return_fields)
+
+            # Accumulate res into acc_res
+            #print ' accumulating %s into %s' % (res, acc_res)
+            if not acc_res:
+                acc_res = res
+            else:
+                if not b_matched:
+                    # We don't care about ordering, let's prepare for
+                    # quickest intersection by making acc_res the smaller one
+                    if len(acc_res) > len(res):
+                        acc_res, res = res, acc_res
+                acc_res = self._intersectResults(acc_res, res, info,
+                                                 b_matched, return_fields)
+
+        if acc_res is None:
+            # No directories entries contributed at all...
+            # Get all entries, with no information
+            ids = self.listEntryIds()
+            if return_fields is None:
+                acc_res = ids
+            else:
+                acc_res = [(id, {}) for id in ids]
+
+        self._addIdToResults(acc_res, return_fields)
+
+        #print '-> %s' % `acc_res`
+        #LOG('searchEntries', DEBUG, 'rf=%s idf=%s sidf=%s res=%s' % (return_fields, id_field, self.id_field, acc_res))
+        return acc_res
+
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        See API in the base class.
+
+        The first backing directory searched is iterated over by batches
+        of batch_size entries. The other ones are searched for the
+        entries of each batch only, restricting their query on their id
+        field, so only one batch of results is kept at a time.
+        """
+        b_queries = self._getBackingQueries(return_fields, kw)
+        if not b_queries:
+            return iter(self._searchEntries(return_fields=return_fields,
+                                            **kw))
+        return self._iterMergedResults(b_queries, return_fields, batch_size)
+
+    def _iterMergedResults(self, b_queries, return_fields, batch_size):
+        base_info, b_return_fields, b_query, b_matched = b_queries[0]
+        b_res = base_info['dir']._iterSearchEntries(
+            return_fields=b_return_fields, batch_size=batch_size, **b_query)
+        for batch in iterBatches(b_res, batch_size):
+            acc_res = self._convertBackingResults(batch, base_info,
+                                                  return_fields)
+            if return_fields is None:
+                ids = list(acc_res)
+            else:
+                ids = [id for id, entry in acc_res]
+            for info, b_return_fields, b_query, b_matched in b_queries[1:]:
+                if not acc_res:
+                    break
+                b_dir = info['dir']
+                b_query = b_query.copy()
+                if b_dir.id_field not in b_query:
+                    # Only the entries of the batch are needed
+                    b_query[b_dir.id_field] = ids
+                b_res = b_dir._searchEntries(return_fields=b_return_fields,
+                                            **b_query)
+                res = self._convertBackingResults(b_res, info, return_fields)
+                acc_res = self._intersectResults(acc_res, res, info,
+                                                 b_matched, return_fields)
+            self._addIdToResults(acc_res, return_fields)
+            for result in acc_res:
+                yield result
+
+    def _getBackingQueries(self, return_fields, kw):
+        """Get the searches to do in the backing directories.
+
+        Returns a list of (info, b_return_fields, b_query, b_matched),
+        in the order in which to do them.
+        """
         # This search method has to take into account backing directories
         # that have a missing_entry property. There are several problems:
         # 1. generating missing entries in the result set when intersecting
@@ -425,90 +522,67 @@ class MetaDirectory(BaseDirectory):
             qs.append(qt)
         b_queries = qs
 
-        # Do searches
-        acc_res = None
-        for info, b_return_fields, b_query, b_matched in b_queries:
-            b_dir = info['dir']
-            missing_entry = info['missing_entry']
-            b_field_rename = info['field_rename']
-            has_missing_entries = missing_entry is not None
+        return b_queries
 
-            # Do query
-            #print ' subquery dir=%s rf=%s query=%s' % ( # XXX
-            #    info['dir_id'], b_return_fields, b_query)
-            b_res = b_dir._searchEntries(return_fields=b_return_fields,
-                                        **b_query)
-            #print ' res=%s' % `b_res`
-
-            # Back-convert fields in query
-            if return_fields is None:
-                res = b_res
-            else:
-                res = []
-                for id, b_entry in b_res:
-                    entry = {}
-                    for b_fid, value in b_entry.items():
-                        fid = b_field_rename.get(b_fid, b_fid)
-                        entry[fid] = value
-                    res.append((id, entry))
-
-            # Accumulate res into acc_res
-            #print ' accumulating %s into %s' % (res, acc_res)
-            if not acc_res:
-                acc_res = res
+    def _convertBackingResults(self, b_res, info, return_fields):
+        """Back-convert the fields of the results of a backing directory.
+        """
+        if return_fields is None:
+            return b_res
+        b_field_rename = info['field_rename']
+        res = []
+        for id, b_entry in b_res:
+            entry = {}
+            for b_fid, value in b_entry.items():
+                fid = b_field_rename.get(b_fid, b_fid)
+                entry[fid] = value
+            res.append((id, entry))
+        return res
+
+    def _intersectResults(self, acc_res, res, info, b_matched,
+                          return_fields):
+        """Intersect accumulated results with those of a backing directory.
+
+        Values of the entries are merged.
+        """
+        b_dir = info['dir']
+        missing_entry = info['missing_entry']
+        if return_fields is None:
+            res_set = set(res)
+            if b_matched:
+                # previous results that matched the query or aren't in
+                # current backing
+                acc_res = [id for id in acc_res
+                           if id in res_set or not b_dir._hasEntry(id)]
             else:
-                if not b_matched:
-                    # We don't care about ordering, let's prepare for
-                    # quickest intersection by making acc_res the smaller one
-                    if len(acc_res) > len(res):
-                        acc_res, res = res, acc_res
-                
-                resids_d = {}
-                if return_fields is None:
-                    res_set = set(res)
-                    if b_matched:
-                        # previous results that matched the query or aren't in
-                        # current backing 
-                        acc_res = [id for id in acc_res
-                                   if id in res_set or not b_dir._hasEntry(id)]
-                    else:
-                        acc_res = [id for id in acc_res if id in res_set]
-                else:
-                    # Intersect and merge values for matching
-                    res_d = dict(res)
-                    if b_matched:
-                        # previous results that matched the query or aren't in
-                        # current backing
-                        acc_res = [(id,d) \
-                                    for (id,d) in acc_res
-                                    if id in res_d or not b_dir._hasEntry(id)]
-                        for (id,d) in acc_res:
-                            d.update(res_d.get(id, missing_entry))
-                    else:
-                        acc_res = [(id,d)
-                                   for (id,d) in acc_res
-                                   if id in res_d]
-                        for (id,d) in acc_res:
-                            d.update(res_d[id])
-
-        if acc_res is None:
-            # No directories entries contributed at all...
-            # Get all entries, with no information
-            ids = self.listEntryIds()
-            if return_fields is None:
-                acc_res = ids
+                acc_res = [id for id in acc_res if id in res_set]
+        else:
+            # Intersect and merge values for matching
+            res_d = dict(res)
+            if b_matched:
+                # previous results that matched the query or aren't in
+                # current backing
+                acc_res = [(id,d) \
+                            for (id,d) in acc_res
+                            if id in res_d or not b_dir._hasEntry(id)]
+                for (id,d) in acc_res:
+                    d.update(res_d.get(id, missing_entry))
             else:
-                acc_res = [(id, {}) for id in ids]
+                acc_res = [(id,d)
+                           for (id,d) in acc_res
+                           if id in res_d]
+                for (id,d) in acc_res:
+                    d.update(res_d[id])
+        return acc_res
 
+    def _addIdToResults(self, acc_res, return_fields):
+        """Re-add the id to the results if requested in return_fields."""
+        id_field = self.id_field
         if (return_fields is not None and
             (return_fields == ['*'] or id_field in return_fields)):
-            # Re-add id if requested in return_fields
             for id, entry in acc_res:
                 entry[id_field] = id
 
-        #print '-> %s' % `acc_res`
-        #LOG('searchEntries', DEBUG, 'rf=%s idf=%s sidf=%s res=%s' % (return_fields, id_field, self.id_field, acc_res))
-        return acc_res
 
 
     #
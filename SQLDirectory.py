@@ -40,6 +40,7 @@ from Products.CPSDirectory.BaseDirectory import BaseDirectory
 from Products.CPSDirectory.BaseDirectory import BaseDirectoryStorageMixin
 from Products.CPSDirectory.BaseDirectory import ConfigurationError
 from Products.CPSDirectory.BaseDirectory import AuthenticationFailed
+from Products.CPSDirectory.BaseDirectory import SEARCH_BATCH_SIZE
 
 from Products.CPSDirectory.interfaces import IDirectory
 from Products.CPSDirectory.interfaces import IBatchable
@@ -330,7 +331,6 @@ class SQLDirectory(BaseDirectory, Cacheable):
         - foo={'query': [v1,v2], 'range': 'min:max'}
             Range query
         """
-        all_field_ids = self._getFieldIds()
         query_options = query_options or {}
         count = query_options.pop('count', False)
 
@@ -347,17 +347,7 @@ class SQLDirectory(BaseDirectory, Cacheable):
         sql = 'SELECT %s FROM %s' % (columns, self.sql_table)
 
         # Where clause
-        clauses = []
-        quoter = self._getSQLQuoter()
-        for key, value in kw.items():
-            if key not in all_field_ids:
-                continue
-            clause = self._makeClause(key, value, quoter)
-            if clause is not None:
-                clauses.append(clause)
-        clause = self._getMethodClause()
-        if clause:
-            clauses.append(clause)
+        clauses = self._makeSearchClauses(kw)
         if clauses:
             sql = sql + " WHERE " + " AND ".join(clauses)
 
@@ -381,11 +371,90 @@ class SQLDirectory(BaseDirectory, Cacheable):
 
         # Build results
         items, data = self._execute(sql)
-        res = []
 
         if count:
             return [data[0][0]]
 
+        res = self._makeSearchResults(data, field_ids, return_fields)
+
+        # Now we must compute a partial datamodel for each result,
+        # to get correct computed fields.
+        # XXX FIXME: do it!
+        # XXX this should be factored out in a common implementation
+        #     as LDAPBackingDirectory also does it
+        # Note: search should be done on computed fields!
+        #       That's what ZODBDirectory correctly does, but not LDAP.
+        #       This needs a second pass of search on partial datamodel.
+
+        return res
+
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, query_options=None,
+                           **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        See API in the base class.
+
+        Rows are fetched by batches of batch_size, ordered by id, each
+        batch starting after the last id of the previous one. This
+        doesn't depend on the cursor support of the database adapter.
+        The cache isn't used. With query_options, results are those of
+        _searchEntries.
+        """
+        if query_options:
+            return iter(self._searchEntries(return_fields=return_fields,
+                                            query_options=query_options,
+                                            **kw))
+        field_ids, return_fields = self._getSearchFields(return_fields)
+        field_ids = list(field_ids)
+        field_ids.sort()
+        clauses = self._makeSearchClauses(kw)
+        return self._iterSearchBatches(field_ids, return_fields, clauses,
+                                       batch_size)
+
+    def _iterSearchBatches(self, field_ids, return_fields, clauses,
+                           batch_size):
+        columns = ', '.join([self.getSQLField(fid) for fid in field_ids])
+        id_column = self.getSQLField(self.id_field)
+        idix = field_ids.index(self.id_field)
+        last_id = None
+        while True:
+            where = list(clauses)
+            if last_id is not None:
+                where.append('%s > %s' % (id_column,
+                                          self.getSQLValue(last_id)))
+            sql = 'SELECT %s FROM %s' % (columns, self.sql_table)
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            sql += ' ORDER BY %s LIMIT %d' % (id_column, batch_size)
+            items, data = self._execute(sql, use_cache=False)
+            for result in self._makeSearchResults(data, field_ids,
+                                                  return_fields):
+                yield result
+            if len(data) < batch_size:
+                break
+            last_id = data[-1][idix]
+
+    def _makeSearchClauses(self, kw):
+        """Get the clauses of the where clause for a search."""
+        all_field_ids = self._getFieldIds()
+        clauses = []
+        quoter = self._getSQLQuoter()
+        for key, value in kw.items():
+            if key not in all_field_ids:
+                continue
+            clause = self._makeClause(key, value, quoter)
+            if clause is not None:
+                clauses.append(clause)
+        clause = self._getMethodClause()
+        if clause:
+            clauses.append(clause)
+        return clauses
+
+    def _makeSearchResults(self, data, field_ids, return_fields):
+        """Get search results from rows of field_ids values."""
+        res = []
         idix = field_ids.index(self.id_field)
         for result in data:
             id = result[idix]
@@ -398,16 +467,6 @@ class SQLDirectory(BaseDirectory, Cacheable):
                     value = result.pop(0)
                     entry[field_id] = self.valueFromSQL(value)
                 res.append((id, entry))
-
-        # Now we must compute a partial datamodel for each result,
-        # to get correct computed fields.
-        # XXX FIXME: do it!
-        # XXX this should be factored out in a common implementation
-        #     as LDAPBackingDirectory also does it
-        # Note: search should be done on computed fields!
-        #       That's what ZODBDirectory correctly does, but not LDAP.
-        #       This needs a second pass of search on partial datamodel.
-
         return res
 
     #
@@ -443,20 +502,26 @@ class SQLDirectory(BaseDirectory, Cacheable):
         dbc = self._getDB()
         return dbc.sql_quote__
 
-    def _execute(self, sql):
+    def _execute(self, sql, use_cache=True):
         """Execute an SQL statement.
 
         Returns a tuple (items, data) or raises an exception.
+
+        If use_cache is false, results of a SELECT aren't looked up nor
+        stored in the cache.
         """
         keyset = None
         if self.ZCacheable_isCachingEnabled():
             if sql.startswith("SELECT"):
-                keyset = {'query': sql}
-                logger.log(TRACE, "_execute: Searching cache for %s", keyset)
-                res = self.ZCacheable_get(keywords=keyset)
-                if res is not None:
-                    logger.log(TRACE, "_execute: -> results=%s", res[:10])
-                    return res
+                if use_cache:
+                    keyset = {'query': sql}
+                    logger.log(TRACE, "_execute: Searching cache for %s",
+                               keyset)
+                    res = self.ZCacheable_get(keywords=keyset)
+                    if res is not None:
+                        logger.log(TRACE, "_execute: -> results=%s",
+                                   res[:10])
+                        return res
             else:
                 self.ZCacheable_invalidate()
 
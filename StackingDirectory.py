@@ -39,6 +39,8 @@ from Products.CPSDirectory.BaseDirectory import BaseDirectory
 from Products.CPSDirectory.BaseDirectory import BaseDirectoryStorageMixin
 from Products.CPSDirectory.BaseDirectory import AuthenticationFailed
 from Products.CPSDirectory.BaseDirectory import ConfigurationError
+from Products.CPSDirectory.BaseDirectory import SEARCH_BATCH_SIZE
+from Products.CPSDirectory.utils import iterBatches
 
 from Products.CPSDirectory.interfaces import IDirectory
 
@@ -192,33 +194,61 @@ class StackingDirectory(BaseDirectory):
     security.declarePrivate('_searchEntries')
     def _searchEntries(self, return_fields=None, **kw):
         """Search for entries in the directory."""
-        id_field = self.id_field
         ids_d = {}
         res = []
         for b_dir in self._getBackingDirs():
-            b_id_field = b_dir.id_field
-            if id_field == b_id_field:
-                b_return_fields = return_fields
-            elif return_fields == ['*']:
-                b_return_fields = return_fields
-            else:
-                b_return_fields = list(return_fields or ())
-                if id_field not in b_return_fields:
-                    b_return_fields.append(id_field)
-
+            b_return_fields = self._getBackingReturnFields(b_dir,
+                                                           return_fields)
             b_res = b_dir._searchEntries(return_fields=b_return_fields, **kw)
+            res.extend(self._uniqueResultsFromBacking(
+                b_res, ids_d, b_dir, b_return_fields, return_fields))
+        return res
 
-            if return_fields is None:
-                if b_return_fields is None:
-                    ids = b_res
-                else:
-                    ids = [b_entry[id_field] for primary_id, b_entry in b_res]
-                uids = self._uniqueIdsFromBacking(ids, ids_d)
-                res.extend(uids)
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        The results of each backing directory are iterated over in turn.
+        Only the ids already returned are kept, to remove duplicates.
+        """
+        ids_d = {}
+        for b_dir in self._getBackingDirs():
+            b_return_fields = self._getBackingReturnFields(b_dir,
+                                                           return_fields)
+            b_res = b_dir._iterSearchEntries(return_fields=b_return_fields,
+                                             batch_size=batch_size, **kw)
+            for batch in iterBatches(b_res, batch_size):
+                for result in self._uniqueResultsFromBacking(
+                    batch, ids_d, b_dir, b_return_fields, return_fields):
+                    yield result
+
+    def _getBackingReturnFields(self, b_dir, return_fields):
+        """Get the return fields to ask a backing directory for."""
+        id_field = self.id_field
+        if id_field == b_dir.id_field:
+            return return_fields
+        elif return_fields == ['*']:
+            return return_fields
+        b_return_fields = list(return_fields or ())
+        if id_field not in b_return_fields:
+            b_return_fields.append(id_field)
+        return b_return_fields
+
+    def _uniqueResultsFromBacking(self, b_res, ids_d, b_dir, b_return_fields,
+                                  return_fields):
+        """Return the back-converted results from a backing directory.
+
+        Ensures their ids are unique in dict ids_d.
+        """
+        if return_fields is None:
+            if b_return_fields is None:
+                ids = b_res
             else:
-                ures = self._uniqueEntriesFromBacking(b_res, ids_d, b_id_field)
-                res.extend(ures)
-        return res
+                id_field = self.id_field
+                ids = [b_entry[id_field] for primary_id, b_entry in b_res]
+            return self._uniqueIdsFromBacking(ids, ids_d)
+        return self._uniqueEntriesFromBacking(b_res, ids_d, b_dir.id_field)
 
     #
     # Hierarchical support
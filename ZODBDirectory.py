@@ -19,12 +19,15 @@
 """ZODBDirectory
 """
 
-from zLOG import LOG, DEBUG, TRACE, INFO
+from zLOG import LOG, DEBUG, TRACE, INFO, WARNING
 
+import heapq
+import operator
 from cgi import escape
-from copy import deepcopy
+import transaction
 from Globals import Persistent
 from Globals import InitializeClass
+from Globals import DTMLFile
 from Acquisition import Implicit
 from Acquisition import aq_base
 from AccessControl import ClassSecurityInfo
@@ -39,14 +42,37 @@ from Products.CPSUtil.property import PropertiesPostProcessor
 from Products.CPSSchemas.StorageAdapter import AttributeStorageAdapter
 
 from Products.CPSDirectory.utils import QueryMatcher
+from Products.CPSDirectory.utils import operator_in
+from Products.CPSDirectory.indexes import FieldIndex
+from Products.CPSDirectory.indexes import TrigramIndex
+from Products.CPSDirectory.indexes import TitleIndex
+from Products.CPSDirectory.indexes import intersectIds
+from Products.CPSDirectory.indexes import indexKeys
+from Products.CPSDirectory.indexes import sortKey
+from Products.CPSDirectory.cache import getCacheTracker
+from Products.CPSDirectory.cache import freezeEntry
+from Products.CPSDirectory.cache import freezeResults
+from Products.CPSDirectory.cache import thawResults
+from Products.CPSDirectory.cache import CopyOnWriteEntry
+from Products.CPSDirectory.compact import CompactEntryStore
 from Products.CPSDirectory.BaseDirectory import BaseDirectory
 from Products.CPSDirectory.BaseDirectory import BaseDirectoryStorageMixin
 from Products.CPSDirectory.BaseDirectory import AuthenticationFailed
+from Products.CPSDirectory.BaseDirectory import SEARCH_BATCH_SIZE
 
 from Products.CPSDirectory.interfaces import IContentishDirectory
+from Products.CPSDirectory.interfaces import IBatchable
+from Products.CPSDirectory.interfaces import IOrderable
 
 from zope.interface import implements
 
+_marker = []
+
+# Number of entries converted between savepoints
+CONVERSION_BATCH = 1000
+
+# Maximum number of entries loaded together during scans
+PREFETCH_BATCH = 100
 
 class ZODBDirectoryStorageAdapter(BaseDirectoryStorageMixin,
                                   AttributeStorageAdapter):
@@ -61,6 +87,13 @@ class ZODBDirectoryStorageAdapter(BaseDirectoryStorageMixin,
         else:
             self._id = getId()
 
+    def _setData(self, data, *args, **kw):
+        """Set data to the object, and notify the directory."""
+        old = self._dir._getEntrySnapshot(self._ob)
+        AttributeStorageAdapter._setData(self, data, *args, **kw)
+        if self._id is not None:
+            self._dir._entryChanged(self._id, self._ob, old)
+
 
 class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
                     BaseDirectory, Cacheable):
@@ -69,9 +102,10 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
     A directory that stores its data in the ZODB.
 
     The entries are individual subobjects where the values are stored as
-    simple attributes.
+    simple attributes, or, with compact_storage, records in a single
+    BTree.
     """
-    implements(IContentishDirectory)
+    implements(IContentishDirectory, IBatchable, IOrderable)
 
     meta_type = 'CPS ZODB Directory'
 
@@ -84,8 +118,27 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
     _properties = BaseDirectory._properties + (
         {'id': 'password_field', 'type': 'string', 'mode': 'w',
          'label': "Field for password (if authentication)"},
+        {'id': 'indexed_fields', 'type': 'tokens', 'mode': 'w',
+         'label': "Fields with a search index"},
+        {'id': 'index_substring_fields', 'type': 'boolean', 'mode': 'w',
+         'label': "Index fields with substring search"},
+        {'id': 'compact_storage', 'type': 'boolean', 'mode': 'w',
+         'label': "Compact storage (entries are not subobjects)"},
         )
     password_field = ''
+    indexed_fields = ()
+    index_substring_fields = False
+    compact_storage = False
+
+    # CompactEntryStore, if compact_storage
+    _compact_store = None
+
+    # field id -> FieldIndex
+    _indexes = {}
+    # field id -> TrigramIndex
+    _substring_indexes = {}
+    # TitleIndex, if title_field is not id_field
+    _title_index = None
 
     id_field = 'id'
     title_field = 'id'
@@ -101,7 +154,30 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
         BaseDirectory.manage_options[:1] + # Properties
         BTreeFolder2.manage_options[0:1] + # Contents
         BaseDirectory.manage_options[1:]
-        ) + Cacheable.manage_options
+        ) + Cacheable.manage_options + (
+        {'label': 'Cache Statistics', 'action': 'manage_cacheStatistics'},
+        )
+
+    security.declareProtected(ManagePortal, 'manage_cacheStatistics')
+    manage_cacheStatistics = DTMLFile('zmi/zodbdirectory_cache_statistics',
+                                      globals())
+
+    security.declareProtected(ManagePortal, 'getCacheStatistics')
+    def getCacheStatistics(self):
+        """Get the statistics of the search results cache.
+
+        Returns a dict with the numbers of hits, misses, evictions, and of
+        write events kept to validate the cached results.
+        """
+        return self._getCacheTracker().getStatistics()
+
+    security.declareProtected(ManagePortal, 'manage_resetCacheStatistics')
+    def manage_resetCacheStatistics(self, REQUEST=None):
+        """Reset the statistics of the search results cache (ZMI)."""
+        self._getCacheTracker().resetCounters()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_cacheStatistics?manage_tabs_message=Reset.')
 
     #
     # API
@@ -110,12 +186,14 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
     def _postProcessProperties(self):
         """Post-processing after properties change."""
         PropertiesPostProcessor._postProcessProperties(self)
+        self._updateStorage()
+        self._updateIndexes()
         self.ZCacheable_invalidate()
 
     security.declarePrivate('listEntryIds')
     def listEntryIds(self):
         """List all the entry ids."""
-        return list(self.objectIds())
+        return list(self._iterEntryIds())
 
     security.declarePrivate('listEntryIdsAndTitles')
     def listEntryIdsAndTitles(self):
@@ -123,30 +201,50 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
 
         Returns a list of tuples (id, title).
         """
-        title_field = self.title_field
-        if title_field == self.id_field:
-            return [(id, id) for id in self.objectIds()]
+        if self.title_field == self.id_field:
+            return [(id, id) for id in self._iterEntryIds()]
+        index = self._getTitleIndex()
+        if index is None:
+            return self._scanEntryIdsAndTitles()
+        return index.items()
 
-        # Get all the fields that title may depend on
-        field_ids_d = {title_field: None}
-        schema = self._getUniqueSchema()
-        dep_ids = schema[title_field].read_process_dependent_fields
-        for dep_id in dep_ids:
-            field_ids_d[dep_id] = None
-        field_ids = field_ids_d.keys()
-        adapter = ZODBDirectoryStorageAdapter(schema, None, self,
-                                              field_ids=field_ids)
+    security.declarePrivate('listSortedEntryIdsAndTitles')
+    def listSortedEntryIdsAndTitles(self, prefix='', start=0, limit=None):
+        """List the entry ids and titles, sorted by title.
+
+        Titles are compared without case nor accents. Only titles starting
+        with prefix are returned, skipping the first start ones, and at
+        most limit of them.
+
+        Returns a list of tuples (id, title).
+        """
+        index = None
+        if self.title_field != self.id_field:
+            index = self._getTitleIndex()
+        if index is None:
+            return BaseDirectory.listSortedEntryIdsAndTitles(
+                self, prefix=prefix, start=start, limit=limit)
+        return index.sortedItems(prefix=prefix, start=start, limit=limit)
+
+    security.declarePrivate('_scanEntryIdsAndTitles')
+    def _scanEntryIdsAndTitles(self):
+        """List all the entry ids and titles without the title index."""
+        title_field = self.title_field
+        adapter = self._getIndexingAdapter([title_field])
         res = []
-        for id, ob in self.objectItems():
+        for id, ob in self._scanEntryItems():
             adapter.setContextObject(ob)
             entry = adapter.getData()
             adapter.finalizeDefaults(entry)
-            res.append((id, entry[title_field]))
+            res.append((id, entry.get(title_field)))
         return res
 
     security.declarePrivate('_hasEntry')
     def _hasEntry(self, id):
         """Does the directory have a given entry?"""
+        store = self._compact_store
+        if store is not None:
+            return store.has_key(id)
         return self.hasObject(id)
 
     security.declarePublic('isAuthenticating')
@@ -194,16 +292,11 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
             raise KeyError("Entry data must have '%s' field" % self.id_field)
         if self._hasEntry(id):
             raise KeyError("Entry '%s' already exists" % id)
-        ob = ZODBDirectoryEntry()
-        ob._setId(id)
-        self._setObject(id, ob)
-        if hasattr(ob, '__ac_local_roles__'):
-            # Cleanup object for minimal memory usage.
-            try:
-                delattr(ob, '__ac_local_roles__')
-            except (AttributeError, KeyError):
-                # ExtensionClasses raise KeyError... duh.
-                pass
+        store = self._compact_store
+        if store is not None:
+            store.createRecord(id)
+        else:
+            self._addEntryObject(id, ZODBDirectoryEntry())
         self._editEntry(entry)
         if not self.isUserModified():
             self.setUserModified(True)
@@ -215,8 +308,8 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
             LOG('ZODBDirectory._editEntry', INFO,
                 'directory %s is readonly' % self.getId())
             return
+        # Cache and indexes are updated by the storage adapter
         BaseDirectory._editEntry(self, entry, check_acls)
-        self.ZCacheable_invalidate()
 
     security.declarePrivate('_deleteEntry')
     def _deleteEntry(self, id):
@@ -229,62 +322,738 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
         """
         if not self._hasEntry(id):
             raise KeyError("Entry '%s' does not exist" % id)
-        self._delObject(id)
+        self._delObject(id) # also unindexes and updates the cache
         if not self.isUserModified():
             self.setUserModified(True)
-        self.ZCacheable_invalidate()
 
     security.declarePrivate('_searchEntries')
-    def _searchEntries(self, return_fields=None, **kw):
+    def _searchEntries(self, return_fields=None, query_options=None, **kw):
         """Search for entries in the directory.
+
+        See API in the base class.
+
+        Extension: query_options is a mapping containing one or several of:
+        - limit: for batching
+        - offset: for batching
+        - count: for batching (return just a count of entries)
+        - order_by: for batching (is a basestring or a tuple)
+        - reverse: for batching (reversed order, ignored without
+          order_by as in SQLDirectory)
+
+        Ordering uses the field indexes when there are some, and only the
+        requested batch of entries is read to build the results.
         """
+        query_options = query_options or {}
         if self.ZCacheable_isCachingEnabled():
             keyset = {'return_fields' : return_fields}
             keyset.update(kw)
+            if query_options:
+                options = query_options.items()
+                options.sort()
+                keyset['query_options'] = tuple(options)
             LOG('ZODBDirectory._searchEntries', TRACE,
                 "Searching cache for %s" % (keyset,))
+            tracker = self._getCacheTracker()
+            stamp = tracker.getStamp()
             from_cache = self.ZCacheable_get(keywords=keyset)
-            if from_cache is not None:
-                LOG('ZODBDirectory._searchEntries', TRACE, " -> results=%s" %
-                    (from_cache[:20],))
-                return deepcopy(from_cache)
+            if from_cache is None:
+                tracker.miss()
+            else:
+                cached_stamp, cached = from_cache
+                if self._isCachedResultValid(cached_stamp, cached, kw,
+                                             return_fields):
+                    LOG('ZODBDirectory._searchEntries', TRACE,
+                        " -> results=%s" % (cached[:20],))
+                    tracker.hit()
+                    if cached_stamp != stamp:
+                        # Don't check the same writes again next time
+                        self.ZCacheable_set((stamp, cached), keywords=keyset)
+                    return thawResults(cached)
+                LOG('ZODBDirectory._searchEntries', TRACE, " -> stale")
+                tracker.evict()
         else:
             keyset = None
 
         matcher = QueryMatcher(kw, accepted_keys=self._getFieldIds(),
                                substring_keys=self.search_substring_fields)
 
+        # Restrict the candidates using indexes, only the remaining keys
+        # have to be checked on the entries themselves.
+        candidates, residual_keys = self._searchIndexes(matcher)
+        if candidates is not None:
+            matcher = QueryMatcher(kw, accepted_keys=residual_keys,
+                                   substring_keys=self.search_substring_fields)
+
         # Compute needed fields from object.
         # All fields we need to return.
         field_ids_d, return_fields = self._getSearchFields(return_fields)
-        # Add all fields the search is made on.
-        field_ids = matcher.getKeysSet().union(field_ids_d)
+
+        count = query_options.get('count')
+        order_by = query_options.get('order_by')
+        if isinstance(order_by, basestring):
+            order_by = (order_by,)
+        if order_by:
+            all_field_ids = self._getFieldIds()
+            for field_id in order_by:
+                if field_id not in all_field_ids:
+                    raise ValueError("Unknown field %r in order_by"
+                                     % field_id)
+        reverse = query_options.get('reverse')
+        offset = query_options.get('offset') or 0
+        limit = query_options.get('limit') or None
+        # When batching, entries are read only for the returned batch
+        batching = count or offset or limit
+
+        field_ids = set()
+        if return_fields is not None and not batching:
+            field_ids.update(field_ids_d)
+        if order_by:
+            # Sort values not found in the indexes are read from entries
+            field_ids.update(self._getDependentFieldIds(
+                [fid for fid in order_by if fid not in self._indexes]))
 
         # Do the search.
-        schema = self._getUniqueSchema()
-        adapter = ZODBDirectoryStorageAdapter(schema, None, self,
-                                          field_ids=list(field_ids))
+        matches = self._matchEntries(matcher, candidates, field_ids)
+
+        if count:
+            n = 0
+            for match in matches:
+                n += 1
+            res = [n]
+        else:
+            if order_by:
+                if limit is not None:
+                    nbest = offset + limit
+                else:
+                    nbest = None
+                matches = self._sortMatches(matches, order_by, reverse, nbest)
+            else:
+                # Like SQLDirectory, reverse only applies to order_by
+                matches = list(matches)
+            if limit is not None:
+                matches = matches[offset:offset+limit]
+            elif offset:
+                matches = matches[offset:]
+
+            # Compute result to return.
+            if return_fields is None:
+                res = [id for id, entry in matches]
+            elif batching:
+                res = self._getResultEntries([id for id, entry in matches],
+                                             field_ids_d, return_fields)
+            else:
+                res = []
+                for id, entry in matches:
+                    d = {}
+                    for key in return_fields:
+                        d[key] = entry[key]
+                    res.append((id, d))
+
+        if keyset is not None:
+            LOG('ZODBDirectory._searchEntries', TRACE, "Putting in cache")
+            res = freezeResults(res)
+            self.ZCacheable_set((stamp, res), keywords=keyset)
+
+        # Entries share values with the objects, callers get copies on write
+        return thawResults(res)
+
+    security.declarePrivate('_iterSearchEntries')
+    def _iterSearchEntries(self, return_fields=None,
+                           batch_size=SEARCH_BATCH_SIZE, query_options=None,
+                           **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        See API in the base class.
+
+        Entries are read lazily while iterating, and deactivated by
+        chunks, so memory use doesn't depend on the number of results.
+        The cache isn't used. With query_options, results are those of
+        _searchEntries.
+        """
+        if query_options:
+            return iter(self._searchEntries(return_fields=return_fields,
+                                            query_options=query_options,
+                                            **kw))
+        matcher = QueryMatcher(kw, accepted_keys=self._getFieldIds(),
+                               substring_keys=self.search_substring_fields)
+        candidates, residual_keys = self._searchIndexes(matcher)
+        if candidates is not None:
+            matcher = QueryMatcher(kw, accepted_keys=residual_keys,
+                                   substring_keys=self.search_substring_fields)
+        field_ids_d, return_fields = self._getSearchFields(return_fields)
+        if return_fields is None:
+            matches = self._matchEntries(matcher, candidates)
+            return (id for id, entry in matches)
+        matches = self._matchEntries(matcher, candidates, field_ids_d)
+        return self._iterResultEntries(matches, return_fields)
+
+    def _iterResultEntries(self, matches, return_fields):
+        for id, entry in matches:
+            d = {}
+            for key in return_fields:
+                d[key] = entry[key]
+            # Entries share values with the objects
+            yield id, CopyOnWriteEntry(d)
+
+    def _matchEntries(self, matcher, candidates, field_ids=()):
+        """Iterate over the (id, entry) of the entries matching a query.
+
+        candidates is the set of ids given by the indexes, or None, and
+        the matcher checks the remaining query keys. entry holds the
+        given fields and the ones checked by the matcher, or is None if
+        no entry had to be read.
+        """
+        match_keys = matcher.getKeysSet()
+        if not match_keys and not field_ids:
+            # The indexes fully answered the query
+            if candidates is None:
+                candidates = self._iterEntryIds()
+            for id in candidates:
+                yield id, None
+            return
+        if candidates is None:
+            items = self._scanEntryItems()
+        elif candidates:
+            items = self._scanEntryItems(candidates)
+        else:
+            return
+        field_ids = match_keys.union(field_ids)
+        adapter = ZODBDirectoryStorageAdapter(self._getUniqueSchema(),
+                                              None, self,
+                                              field_ids=list(field_ids))
+        for id, ob in items:
+            adapter.setContextObject(ob)
+            entry = adapter.getData()
+            adapter.finalizeDefaults(entry)
+            if matcher.match(entry):
+                yield id, entry
+
+    def _sortMatches(self, matches, order_by, reverse=False, nbest=None):
+        """Sort the (id, entry) of matching entries on some fields.
+
+        Values of indexed fields are taken from the indexes, the others
+        from the entries. Entries without a value come last, or first in
+        reverse order. Only the first nbest are returned if not None.
+        """
+        indexes = self._indexes
+        decorated = []
+        entries = {}
+        for id, entry in matches:
+            key = []
+            for field_id in order_by:
+                index = indexes.get(field_id)
+                if index is not None:
+                    keys = index.getKeys(id)
+                else:
+                    keys = indexKeys(entry.get(field_id))
+                key.append(sortKey(keys))
+            decorated.append((tuple(key), id))
+            entries[id] = entry
+        if nbest is None:
+            decorated.sort()
+            if reverse:
+                decorated.reverse()
+        elif reverse:
+            decorated = heapq.nlargest(nbest, decorated)
+        else:
+            decorated = heapq.nsmallest(nbest, decorated)
+        return [(id, entries[id]) for key, id in decorated]
+
+    def _getResultEntries(self, ids, field_ids, return_fields):
+        """Get the (id, entry) results for some entries."""
+        adapter = ZODBDirectoryStorageAdapter(self._getUniqueSchema(),
+                                              None, self,
+                                              field_ids=list(field_ids))
         res = []
-        for id, ob in self.objectItems():
+        for id, ob in self._scanEntryItems(ids):
             adapter.setContextObject(ob)
             entry = adapter.getData()
             adapter.finalizeDefaults(entry)
-            if not matcher.match(entry):
+            d = {}
+            for key in return_fields:
+                d[key] = entry[key]
+            res.append((id, d))
+        return res
+
+    #
+    # Cache
+    #
+
+    security.declarePrivate('_getCacheTracker')
+    def _getCacheTracker(self):
+        """Get the tracker of the writes, for cache validation."""
+        return getCacheTracker(self.getPhysicalPath())
+
+    security.declarePrivate('_getEntrySnapshot')
+    def _getEntrySnapshot(self, ob):
+        """Get a copy of all the values of an entry, for cache validation.
+
+        Returns None if caching is disabled.
+        """
+        if ob is None or not self.ZCacheable_isCachingEnabled():
+            return None
+        adapter = ZODBDirectoryStorageAdapter(self._getUniqueSchema(), ob,
+                                              self)
+        entry = adapter.getData()
+        adapter.finalizeDefaults(entry)
+        return freezeEntry(entry)
+
+    security.declarePrivate('_recordWrite')
+    def _recordWrite(self, id, old, new):
+        """Record a write so that the affected cached results get evicted.
+        """
+        tracker = self._getCacheTracker()
+        if self.ZCacheable_isCachingEnabled():
+            tracker.recordWrite(id, old, new)
+        else:
+            # No snapshot, results cached later on may not be trusted
+            tracker.recordFlush()
+
+    security.declarePrivate('_entryChanged')
+    def _entryChanged(self, id, ob, old):
+        """Update indexes and cache after an entry has been written.
+
+        old is the snapshot of the entry before the write.
+        """
+        self._indexEntry(id, ob)
+        self._recordWrite(id, old, self._getEntrySnapshot(ob))
+
+    security.declarePrivate('_isCachedResultValid')
+    def _isCachedResultValid(self, stamp, result, query, return_fields):
+        """Check that a cached search result is still valid.
+
+        It's not valid anymore if one of its entries has been written
+        since, or if the query matches the old or new values of a
+        written entry.
+        """
+        events = self._getCacheTracker().getEventsSince(stamp)
+        if events is None:
+            return False
+        if not events:
+            return True
+        if return_fields is None:
+            ids = set(result)
+        else:
+            ids = set([id for id, entry in result])
+        matcher = None
+        for serial, id, old, new in events:
+            if id in ids:
+                return False
+            if matcher is None:
+                matcher = QueryMatcher(query,
+                                   accepted_keys=self._getFieldIds(),
+                                   substring_keys=self.search_substring_fields)
+            for entry in (old, new):
+                if entry is not None and matcher.match(entry):
+                    return False
+        return True
+
+    #
+    # Indexes
+    #
+
+    security.declarePrivate('_updateIndexes')
+    def _updateIndexes(self):
+        """Create or drop indexes after a change of indexed_fields,
+        search_substring_fields or index_substring_fields.
+        """
+        created = []
+        indexes = self._updateIndexMapping(
+            self._indexes, self.indexed_fields, FieldIndex, created)
+        if indexes is not self._indexes:
+            self._indexes = indexes
+        if self.index_substring_fields:
+            wanted = self.search_substring_fields
+        else:
+            wanted = ()
+        indexes = self._updateIndexMapping(
+            self._substring_indexes, wanted, TrigramIndex, created)
+        if indexes is not self._substring_indexes:
+            self._substring_indexes = indexes
+        self._updateTitleIndex(created)
+        if created:
+            self._reindexEntries(indexes=created)
+
+    security.declarePrivate('_updateTitleIndex')
+    def _updateTitleIndex(self, created):
+        """Create the title index if it is missing or stale, or drop it.
+
+        The new index is appended to created, to be filled by the caller.
+        The index of an empty directory is only created by its first
+        write, as the schema may not be reachable yet.
+        """
+        if self.title_field == self.id_field:
+            if self._title_index is not None:
+                self._title_index = None
+            return
+        index = self._title_index
+        if index is None and not self._countEntries():
+            return
+        signature = self._getTitleSignature()
+        if index is None or index.signature != signature:
+            index = TitleIndex(self.title_field, signature)
+            self._title_index = index
+            self._v_title_index_warned = False
+            created.append(index)
+
+    def _updateIndexMapping(self, indexes, wanted, klass, created):
+        """Compute a mapping of indexes holding only the wanted ones.
+
+        Returns the original mapping if nothing changed. New indexes are
+        appended to created.
+        """
+        wanted = wanted or ()
+        new = {}
+        for field_id in wanted:
+            index = indexes.get(field_id)
+            if index is None:
+                index = klass(field_id)
+                created.append(index)
+            new[field_id] = index
+        if new == indexes:
+            return indexes
+        return new
+
+    security.declarePrivate('_getAllIndexes')
+    def _getAllIndexes(self):
+        """Get all the index objects."""
+        indexes = self._indexes.values() + self._substring_indexes.values()
+        if self._title_index is not None:
+            indexes.append(self._title_index)
+        return indexes
+
+    security.declarePrivate('_getTitleSignature')
+    def _getTitleSignature(self):
+        """Describe how the titles of the entries are computed.
+
+        The title index is rebuilt when this changes.
+        """
+        title_field = self.title_field
+        schema = self._getUniqueSchema()
+        if title_field not in schema.keys():
+            return (title_field,)
+        field = schema[title_field]
+        dep_ids = list(field.read_process_dependent_fields)
+        dep_ids.sort()
+        return (title_field, tuple(dep_ids),
+                getattr(field, 'read_process_expr', ''))
+
+    security.declarePrivate('_getTitleIndex')
+    def _getTitleIndex(self):
+        """Get the title index, or None if it is missing or stale.
+
+        It is not built here, as this is called when reading: reads would
+        then write to the ZODB, and conflict with each other. A stale
+        index is rebuilt by the next write, until then a warning is
+        logged once.
+        """
+        index = self._title_index
+        if index is None:
+            return None
+        if index.signature != self._getTitleSignature():
+            if not getattr(self, '_v_title_index_warned', False):
+                self._v_title_index_warned = True
+                LOG('ZODBDirectory._getTitleIndex', WARNING,
+                    "Title index of %s is stale, titles are read from the "
+                    "entries until the next write or manage_rebuildIndexes"
+                    % '/'.join(self.getPhysicalPath()))
+            return None
+        return index
+
+    security.declarePrivate('_getDependentFieldIds')
+    def _getDependentFieldIds(self, field_ids):
+        """Get the given schema fields and their read dependencies."""
+        schema = self._getUniqueSchema()
+        field_ids_d = {}
+        for field_id in field_ids:
+            if field_id not in schema.keys():
                 continue
-            # Compute result to return.
-            if return_fields is None:
-                res.append(id)
+            field_ids_d[field_id] = None
+            for dep_id in schema[field_id].read_process_dependent_fields:
+                field_ids_d[dep_id] = None
+        return field_ids_d.keys()
+
+    security.declarePrivate('_getIndexingAdapter')
+    def _getIndexingAdapter(self, field_ids):
+        """Get an adapter fetching the given fields and their dependencies.
+        """
+        return ZODBDirectoryStorageAdapter(
+            self._getUniqueSchema(), None, self,
+            field_ids=self._getDependentFieldIds(field_ids))
+
+    security.declarePrivate('_reindexEntries')
+    def _reindexEntries(self, indexes=None):
+        """Index all entries.
+
+        If indexes is None, all indexes are cleared and rebuilt.
+        """
+        if indexes is None:
+            indexes = self._getAllIndexes()
+        if not indexes:
+            return
+        for index in indexes:
+            index.clear()
+        if not self._countEntries():
+            return
+        field_ids = [index.id for index in indexes]
+        LOG('ZODBDirectory._reindexEntries', INFO,
+            "Indexing fields %s of directory %s" % (field_ids, self.getId()))
+        adapter = self._getIndexingAdapter(field_ids)
+        for id, ob in self._scanEntryItems():
+            adapter.setContextObject(ob)
+            entry = adapter.getData()
+            adapter.finalizeDefaults(entry)
+            for index in indexes:
+                index.indexEntry(id, entry.get(index.id))
+
+    security.declarePrivate('_indexEntry')
+    def _indexEntry(self, id, ob):
+        """Update the indexes for an entry.
+
+        A missing or stale title index is built first.
+        """
+        created = []
+        self._updateTitleIndex(created)
+        if created:
+            self._reindexEntries(indexes=created)
+        indexes = self._getAllIndexes()
+        if not indexes:
+            return
+        adapter = self._getIndexingAdapter([index.id for index in indexes])
+        adapter.setContextObject(ob)
+        entry = adapter.getData()
+        adapter.finalizeDefaults(entry)
+        for index in indexes:
+            index.indexEntry(id, entry.get(index.id))
+
+    security.declarePrivate('_unindexEntry')
+    def _unindexEntry(self, id):
+        """Remove an entry from the indexes."""
+        for index in self._getAllIndexes():
+            index.unindexEntry(id)
+
+    security.declarePrivate('_searchIndexes')
+    def _searchIndexes(self, matcher):
+        """Use the indexes to restrict the entries to check.
+
+        Exact, list and range searches are answered by the field
+        indexes, substring searches get candidates from the trigram
+        indexes.
+
+        Returns a tuple (candidates, residual_keys), where candidates is
+        an ordered set of ids, or None if all entries have to be
+        checked, and residual_keys is the set of query keys that still
+        have to be checked on the candidates.
+        """
+        indexes = self._indexes
+        substring_indexes = self._substring_indexes
+        residual_keys = matcher.getKeysSet()
+        if not indexes and not substring_indexes:
+            return None, residual_keys
+        sets = []
+        for key, value in matcher.query.items():
+            op = matcher.ops[key]
+            if op == 'substring':
+                index = substring_indexes.get(key)
+                if index is None:
+                    continue
+                ids, exact = index.search(value)
             else:
-                d = {}
-                for key in return_fields:
-                    d[key] = entry[key]
-                res.append((id, d))
+                index = indexes.get(key)
+                if index is None:
+                    continue
+                if op == 'range':
+                    low, high = value
+                    ids, exact = index.searchRange(low, high)
+                elif op is operator.eq:
+                    ids, exact = index.search((value,))
+                elif op is operator_in:
+                    ids, exact = index.search(value)
+                else:
+                    continue
+            if ids is None:
+                continue
+            sets.append(ids)
+            if exact:
+                residual_keys.discard(key)
+        if not sets:
+            return None, residual_keys
+        return intersectIds(sets), residual_keys
 
-        if keyset is not None:
-            LOG('ZODBDirectory._searchEntries', TRACE, "Putting in cache")
-            self.ZCacheable_set(res, keywords=keyset)
+    def _delObject(self, id, *args, **kw):
+        """Delete an entry object, unindex it and update the cache."""
+        old = self._getEntrySnapshot(self._getEntryObject(id, None))
+        store = self._compact_store
+        if store is not None:
+            store.deleteRecord(id)
+        else:
+            BTreeFolder2._delObject(self, id, *args, **kw)
+        self._unindexEntry(id)
+        self._recordWrite(id, old, None)
+
+    security.declareProtected(ManagePortal, 'manage_rebuildIndexes')
+    def manage_rebuildIndexes(self, REQUEST=None):
+        """Rebuild all the search indexes (ZMI)."""
+        self._updateTitleIndex([])
+        self._reindexEntries()
+        self.ZCacheable_invalidate()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+
+                '/manage_propertiesForm?manage_tabs_message=Indexes+rebuilt.')
+
+    #
+    # Storage
+    #
+
+    security.declarePrivate('_getEntryObject')
+    def _getEntryObject(self, id, default=_marker):
+        """Get the object holding the values of an entry.
+
+        Raises KeyError if there is no such entry and no default.
+        """
+        store = self._compact_store
+        if store is not None:
+            ob = store.getEntry(id)
+            if ob is None:
+                if default is _marker:
+                    raise KeyError(id)
+                return default
+            return ob
+        if default is _marker:
+            return self._getOb(id)
+        return self._getOb(id, default)
+
+    security.declarePrivate('_iterEntryIds')
+    def _iterEntryIds(self):
+        """Iterate over the entry ids, in order."""
+        store = self._compact_store
+        if store is not None:
+            return store.iterkeys()
+        return self._tree.iterkeys()
+
+    security.declarePrivate('_scanEntryItems')
+    def _scanEntryItems(self, ids=None):
+        """Iterate over the (id, object) of the entries, to scan them.
+
+        If ids is None, all the entries are scanned.
+
+        Entry objects are loaded by chunks, using the prefetch API of the
+        connection if there is one, and the ones that were ghosts are
+        deactivated once scanned, so that big scans don't fill the ZODB
+        cache.
+        """
+        if ids is None:
+            ids = self._iterEntryIds()
+        store = self._compact_store
+        if store is not None:
+            # Records are loaded by buckets anyway
+            for id in ids:
+                yield id, store.getEntry(id)
+            return
+        conn = self._p_jar
+        prefetch = getattr(conn, 'prefetch', None)
+        cache_size = getattr(getattr(conn, '_cache', None), 'cache_size', 0)
+        batch = PREFETCH_BATCH
+        if cache_size:
+            # Leave room in the cache for the objects used by the caller
+            batch = max(1, min(batch, cache_size // 4))
+        tree = self._tree
+        chunk = []
+        for id in ids:
+            chunk.append((id, tree[id]))
+            if len(chunk) >= batch:
+                for item in self._scanChunk(chunk, prefetch):
+                    yield item
+                chunk = []
+        if chunk:
+            for item in self._scanChunk(chunk, prefetch):
+                yield item
+
+    def _scanChunk(self, chunk, prefetch):
+        """Load a chunk of entry objects, yield them, then deactivate them.
+        """
+        ghosts = [ob for id, ob in chunk if ob._p_changed is None]
+        if ghosts:
+            if prefetch is not None:
+                prefetch(*ghosts)
+            for ob in ghosts:
+                ob._p_activate()
+        for id, ob in chunk:
+            yield id, ob.__of__(self)
+        for ob in ghosts:
+            # Not if modified meanwhile
+            if ob._p_changed is False:
+                ob._p_deactivate()
+
+    security.declarePrivate('_countEntries')
+    def _countEntries(self):
+        """Get the number of entries."""
+        store = self._compact_store
+        if store is not None:
+            return len(store)
+        return self.objectCount()
+
+    def _addEntryObject(self, id, ob):
+        """Add an entry subobject."""
+        ob._setId(id)
+        self._setObject(id, ob)
+        if hasattr(ob, '__ac_local_roles__'):
+            # Cleanup object for minimal memory usage.
+            try:
+                delattr(ob, '__ac_local_roles__')
+            except (AttributeError, KeyError):
+                # ExtensionClasses raise KeyError... duh.
+                pass
+
+    security.declarePrivate('_updateStorage')
+    def _updateStorage(self):
+        """Convert the entries after a change of compact_storage."""
+        if self.compact_storage:
+            if self._compact_store is None:
+                self._convertToCompactStorage()
+        elif self._compact_store is not None:
+            self._convertToObjectStorage()
+
+    security.declarePrivate('_convertToCompactStorage')
+    def _convertToCompactStorage(self):
+        """Move the values of all entry subobjects to compact records."""
+        store = CompactEntryStore(self._getUniqueSchema().keys())
+        LOG('ZODBDirectory._convertToCompactStorage', INFO,
+            "Converting %d entries of directory %s to compact storage" %
+            (self.objectCount(), self.getId()))
+        done = 0
+        for id, ob in self._scanEntryItems():
+            ob = aq_base(ob)
+            values = {}
+            for key, value in ob.__dict__.items():
+                if not key.startswith('_'):
+                    values[key] = value
+            store.createRecord(id)
+            store.setValues(id, values)
+            done += 1
+            if done % CONVERSION_BATCH == 0:
+                transaction.savepoint(optimistic=True)
+        # Drop the subobjects
+        self._initBTrees()
+        self._compact_store = store
 
-        return deepcopy(res)
+    security.declarePrivate('_convertToObjectStorage')
+    def _convertToObjectStorage(self):
+        """Move the compact records of all entries to subobjects."""
+        store = self._compact_store
+        LOG('ZODBDirectory._convertToObjectStorage', INFO,
+            "Converting %d entries of directory %s to subobjects" %
+            (len(store), self.getId()))
+        done = 0
+        for id in store.keys():
+            ob = ZODBDirectoryEntry()
+            for key, value in store.getValues(id).items():
+                setattr(ob, key, value)
+            self._addEntryObject(id, ob)
+            done += 1
+            if done % CONVERSION_BATCH == 0:
+                transaction.savepoint(optimistic=True)
+        self._compact_store = None
 
     #
     # Internal
@@ -294,7 +1063,7 @@ class ZODBDirectory(PropertiesPostProcessor, BTreeFolder2,
     def _getAdapters(self, id, search=0, **kw):
         """Get the adapters for an entry."""
         if id is not None:
-            ob = self._getOb(id)
+            ob = self._getEntryObject(id)
         else:
             # Creation
             ob = None
@@ -0,0 +1,505 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Dependency tracking for cached search results.
+
+Instead of invalidating all the cached results of a directory on each
+write, the directory records the write in a tracker, along with the old
+and new values of the entry. Cached results are stored with a stamp from
+the tracker, and on retrieval the directory checks the writes that
+happened since: only the results that could be affected by one of them
+are considered stale.
+
+Trackers are kept in memory, per process, like the RAM cache managers.
+
+Cached results are stored frozen, and handed out wrapped into copy on
+write entries, so that a cache hit doesn't have to copy them.
+
+This module also provides a small LRU cache, used for values that are
+cheap to keep but computed very often, like LDAP search filters, and a
+cache of the existence of entries, with expiration.
+"""
+
+import time
+import threading
+from copy import deepcopy
+from UserDict import DictMixin
+
+import transaction
+
+# Number of write events kept. Results older than the oldest kept event
+# are considered stale.
+MAX_EVENTS = 1000
+
+# Number of entries whose existence is kept
+EXISTENCE_CACHE_SIZE = 10000
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+_existence_caches = {}
+
+def getCacheTracker(key):
+    """Get the tracker for a given key (typically a physical path)."""
+    _trackers_lock.acquire()
+    try:
+        tracker = _trackers.get(key)
+        if tracker is None:
+            tracker = _trackers[key] = CacheTracker()
+        return tracker
+    finally:
+        _trackers_lock.release()
+
+
+class CacheTracker(object):
+    """Records the writes done to a directory.
+
+    Also holds the hit/miss/eviction counters of the cache.
+    """
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        # Identifies this tracker, so that stamps from another process
+        # or another tracker are never trusted.
+        self._token = '%x-%f' % (id(self), time.time())
+        self._serial = 0
+        self._floor = 0
+        self._events = []
+        self.resetCounters()
+
+    def resetCounters(self):
+        """Reset the statistics."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getStatistics(self):
+        """Get the statistics, as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'events': len(self._events),
+            }
+
+    def hit(self):
+        self._lock.acquire()
+        try:
+            self.hits += 1
+        finally:
+            self._lock.release()
+
+    def miss(self):
+        self._lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+    def evict(self):
+        self._lock.acquire()
+        try:
+            self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def getStamp(self):
+        """Get the stamp to store along with results computed from now on.
+        """
+        return (self._token, self._serial)
+
+    def _record(self, id, old, new):
+        self._lock.acquire()
+        try:
+            self._serial += 1
+            events = self._events
+            events.append((self._serial, id, old, new))
+            if len(events) > self.max_events:
+                dropped = len(events) - self.max_events
+                self._floor = events[dropped-1][0]
+                del events[:dropped]
+        finally:
+            self._lock.release()
+
+    def _afterCommit(self, status, id, old, new):
+        self._record(id, old, new)
+
+    def recordWrite(self, id, old, new):
+        """Record that an entry changed.
+
+        old and new are mappings of all the values of the entry before
+        and after the change, or None on creation and deletion.
+
+        The write is recorded again after commit, so that results
+        computed by concurrent transactions that didn't see it yet are
+        checked against it.
+        """
+        self._record(id, old, new)
+        txn = transaction.get()
+        addAfterCommitHook = getattr(txn, 'addAfterCommitHook', None)
+        if addAfterCommitHook is not None:
+            addAfterCommitHook(self._afterCommit, (id, old, new))
+
+    def recordChange(self, id):
+        """Record that an entry was changed outside of this process.
+
+        Unlike recordWrite, this doesn't depend on a transaction: it's
+        meant for the changes reported by another system.
+        """
+        self._record(id, None, None)
+
+    def recordFlush(self):
+        """Record a change after which no cached result is valid."""
+        self._lock.acquire()
+        try:
+            self._serial += 1
+            self._floor = self._serial
+            self._events = []
+        finally:
+            self._lock.release()
+
+    def getEventsSince(self, stamp):
+        """Get the writes that happened after the stamp was taken.
+
+        Returns a list of (serial, id, old, new), or None if the stamp
+        is too old to know.
+        """
+        token, serial = stamp
+        self._lock.acquire()
+        try:
+            if token != self._token or serial < self._floor:
+                return None
+            return [event for event in self._events if event[0] > serial]
+        finally:
+            self._lock.release()
+
+
+class LRUCache(object):
+    """A mapping keeping at most size items, the least recently used
+    being dropped first.
+
+    It isn't thread safe: it's meant to be kept in volatile attributes,
+    which are per ZODB connection.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self._data = {}
+        # Circular doubly linked list of [prev, next, key, value],
+        # the most recently used being right after the root.
+        root = self._root = []
+        root[:] = [root, root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _pushFront(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        """Get a value, marking it as the most recently used."""
+        link = self._data.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._pushFront(link)
+        return link[3]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def set(self, key, value):
+        """Store a value, dropping the least recently used if full."""
+        link = self._data.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._pushFront(link)
+            return
+        link = [None, None, key, value]
+        self._data[key] = link
+        self._pushFront(link)
+        if len(self._data) > self.size:
+            last = self._root[0]
+            self._unlink(last)
+            del self._data[last[2]]
+
+    def clear(self):
+        """Remove all the values."""
+        self._data.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def getStatistics(self):
+        """Get the statistics, as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'max_size': self.size,
+            }
+
+
+def getExistenceCache(key):
+    """Get the existence cache for a given key (typically a physical path).
+    """
+    _trackers_lock.acquire()
+    try:
+        cache = _existence_caches.get(key)
+        if cache is None:
+            cache = _existence_caches[key] = ExistenceCache()
+        return cache
+    finally:
+        _trackers_lock.release()
+
+
+class ExistenceCache(object):
+    """Remembers whether entries exist, for a limited time.
+
+    Answers expire after a time to live given when reading them, that
+    can be different for existing and missing entries. When the cache is
+    full, expired answers are dropped, then the oldest ones.
+
+    Shared by all the threads of the process.
+    """
+
+    def __init__(self, size=EXISTENCE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = {}
+        self.resetCounters()
+
+    def resetCounters(self):
+        """Reset the statistics."""
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def getStatistics(self):
+        """Get the statistics, as a dict."""
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'size': len(self._data),
+            'max_size': self.size,
+            }
+
+    def get(self, key, ttl, negative_ttl):
+        """Get whether an entry exists.
+
+        ttl and negative_ttl are the times to live, in seconds, of the
+        answers for existing and missing entries.
+
+        Returns True or False, or None if the answer isn't known.
+        """
+        self._lock.acquire()
+        try:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            exists, stored = value
+            if exists:
+                max_age = ttl
+            else:
+                max_age = negative_ttl
+            if time.time() - stored >= max_age:
+                del self._data[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            if exists:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return exists
+        finally:
+            self._lock.release()
+
+    def set(self, key, exists, max_age=None):
+        """Record whether an entry exists.
+
+        max_age is the longest time to live in use, answers older than
+        that are the first dropped when the cache is full.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            data = self._data
+            if key not in data and len(data) >= self.size:
+                if max_age is not None:
+                    for k, (e, stored) in data.items():
+                        if now - stored >= max_age:
+                            del data[k]
+                if len(data) >= self.size:
+                    # Drop the oldest quarter
+                    items = [(stored, k) for k, (e, stored) in data.items()]
+                    items.sort()
+                    for stored, k in items[:max(1, self.size // 4)]:
+                        del data[k]
+            data[key] = (bool(exists), now)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        """Forget whether an entry exists."""
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forget everything."""
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+
+def freezeEntry(entry):
+    """Copy an entry so that it doesn't share mutable values."""
+    frozen = {}
+    for key, value in entry.items():
+        if isinstance(value, (list, dict)):
+            value = deepcopy(value)
+        frozen[key] = value
+    return frozen
+
+def freezeResults(results):
+    """Get an immutable version of search results, suitable for caching.
+
+    Results are a list of ids, or of (id, entry) tuples.
+    """
+    frozen = []
+    for result in results:
+        if isinstance(result, tuple):
+            id, entry = result
+            result = (id, freezeEntry(entry))
+        frozen.append(result)
+    return tuple(frozen)
+
+def thawResults(results):
+    """Get search results that can be handed out to callers.
+
+    The entries are wrapped, not copied.
+    """
+    thawed = []
+    for result in results:
+        if isinstance(result, tuple):
+            id, entry = result
+            result = (id, CopyOnWriteEntry(entry))
+        thawed.append(result)
+    return thawed
+
+
+class CopyOnWriteEntry(DictMixin, object):
+    """A mapping wrapping a shared entry.
+
+    The shared entry is never modified: a private copy is made on the
+    first write. Mutable values are copied when first accessed, so that
+    modifying them in place is safe too.
+    """
+
+    # Allow use from restricted code, like a dict
+    __allow_access_to_unprotected_subobjects__ = 1
+    _guarded_writes = 1
+
+    def __init__(self, entry):
+        self._shared = entry
+        self._copies = {}
+        self._own = None
+
+    def _getOwn(self):
+        own = self._own
+        if own is None:
+            own = {}
+            for key in self._shared.keys():
+                own[key] = self[key]
+            self._own = own
+            self._shared = None
+            self._copies = None
+        return own
+
+    def __getitem__(self, key):
+        own = self._own
+        if own is not None:
+            return own[key]
+        value = self._shared[key]
+        if isinstance(value, (list, dict)):
+            copies = self._copies
+            if key not in copies:
+                copies[key] = deepcopy(value)
+            value = copies[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._getOwn()[key] = value
+
+    def __delitem__(self, key):
+        del self._getOwn()[key]
+
+    def keys(self):
+        if self._own is not None:
+            return self._own.keys()
+        return self._shared.keys()
+
+    def __contains__(self, key):
+        if self._own is not None:
+            return key in self._own
+        return key in self._shared
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        if self._own is not None:
+            return len(self._own)
+        return len(self._shared)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
@@ -0,0 +1,403 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Change feeds, used to evict the cached results of LDAP directories.
+
+Writes done through a directory invalidate its cached results, but the
+changes made to the LDAP server by other applications are only seen when
+the cache expires. A change feed tells about those changes: a listener
+thread consumes it and records the changed dns, so that only the cached
+results they affect are evicted.
+
+A feed is an iterator over (change type, dn, previous dn), the change
+type being one of 'add', 'delete', 'modify' and 'modrdn', and the
+previous dn only being known for renamed entries. Feeds yield None when
+they have been idle for a while, so that the listener can check whether
+it has been stopped.
+
+The LDAP feeds (persistent search and content synchronization) are in
+LDAPBackingDirectory. This module provides a feed following an LDIF
+change log, like the ones written by the OpenLDAP auditlog overlay, that
+can also be replayed.
+
+Listeners are kept per process, like the caches they maintain. Like
+ldappool, this module doesn't depend on the ldap module.
+"""
+
+import os
+import time
+import base64
+import threading
+from logging import getLogger
+
+logger = getLogger('CPSDirectory.changefeed')
+
+# Time to wait before reopening a feed that failed
+RETRY_DELAY = 30.0
+
+# Time between two checks of a log file for new changes
+POLL_INTERVAL = 1.0
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+class ChangeFeedError(Exception):
+    """A change feed stopped unexpectedly."""
+
+
+#
+# LDIF change logs
+#
+
+def _parentDN(dn):
+    """Get the parent of a dn, ignoring escaped commas.
+
+    >>> _parentDN('cn=Doe\\\\, John,ou=people,o=org')
+    'ou=people,o=org'
+    >>> _parentDN('o=org')
+    ''
+    """
+    i = 0
+    while i < len(dn):
+        c = dn[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == ',':
+            return dn[i+1:].strip()
+        i += 1
+    return ''
+
+def parseLDIF(lines):
+    """Iterate over the records of LDIF lines, as lists of (attr, value).
+
+    Folded lines are joined, comments are skipped and base64 values are
+    decoded. None items in lines are passed through.
+
+    >>> lines = ['# comment', 'dn: cn=a,o=org', 'changetype: modify',
+    ...          'description: long', '  value', '', 'dn:: Y249YixvPW9yZw==']
+    >>> list(parseLDIF(lines))
+    [[('dn', 'cn=a,o=org'), ('changetype', 'modify'), ('description', 'long value')], [('dn', 'cn=b,o=org')]]
+    """
+    record = []
+    current = None
+    for line in lines:
+        if line is None:
+            yield None
+            continue
+        line = line.rstrip('\r\n')
+        if line.startswith(' '):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            record.append(current)
+            current = None
+        if not line:
+            if record:
+                yield _parseLines(record)
+                record = []
+            continue
+        if line.startswith('#'):
+            continue
+        current = line
+    if current is not None:
+        record.append(current)
+    if record:
+        yield _parseLines(record)
+
+def _parseLines(lines):
+    items = []
+    for line in lines:
+        if line == '-':
+            continue
+        if ':' not in line:
+            logger.debug("Ignoring LDIF line %r", line)
+            continue
+        attr, value = line.split(':', 1)
+        if value.startswith(':'):
+            value = base64.decodestring(value[1:].strip())
+        else:
+            value = value.lstrip()
+        items.append((attr.strip().lower(), value))
+    return items
+
+def getChange(record):
+    """Get the (change type, dn, previous dn) of an LDIF record.
+
+    Records without a changetype are additions. Returns None for records
+    without a dn, like the version line.
+
+    >>> getChange([('dn', 'cn=a,o=org'), ('changetype', 'delete')])
+    ('delete', 'cn=a,o=org', None)
+    >>> getChange([('dn', 'cn=a,ou=x,o=org'), ('changetype', 'modrdn'),
+    ...            ('newrdn', 'cn=b'), ('deleteoldrdn', '1')])
+    ('modrdn', 'cn=b,ou=x,o=org', 'cn=a,ou=x,o=org')
+    >>> getChange([('dn', 'cn=a,ou=x,o=org'), ('changetype', 'moddn'),
+    ...            ('newrdn', 'cn=a'), ('newsuperior', 'ou=y,o=org')])
+    ('modrdn', 'cn=a,ou=y,o=org', 'cn=a,ou=x,o=org')
+    """
+    values = {}
+    for attr, value in record:
+        values.setdefault(attr, value)
+    dn = values.get('dn')
+    if dn is None:
+        return None
+    change_type = values.get('changetype', 'add').strip().lower()
+    if change_type not in ('modrdn', 'moddn'):
+        return change_type, dn, None
+    superior = values.get('newsuperior')
+    if superior is None:
+        superior = _parentDN(dn)
+    new_dn = values.get('newrdn', '').strip()
+    if superior:
+        new_dn = '%s,%s' % (new_dn, superior)
+    return 'modrdn', new_dn, dn
+
+def iterChanges(records):
+    """Iterate over the changes of LDIF records, passing None through."""
+    for record in records:
+        if record is None:
+            yield None
+            continue
+        change = getChange(record)
+        if change is not None:
+            yield change
+
+
+class LogFileFeed(object):
+    """Changes appended to an LDIF change log file.
+
+    The file is followed like tail -f does, and reopened when it is
+    rotated or truncated. Only the changes written after the feed
+    started are returned, unless replay is true: the changes already in
+    the file are returned first. If follow is false, the feed stops at
+    the end of the file.
+    """
+
+    def __init__(self, path, replay=False, follow=True,
+                 poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.replay = replay
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self._closed = False
+
+    def __iter__(self):
+        return iterChanges(parseLDIF(self._iterLines()))
+
+    def close(self):
+        """Stop following the file."""
+        self._closed = True
+
+    def _open(self):
+        try:
+            return open(self.path, 'rb')
+        except IOError:
+            return None
+
+    def _isRotated(self, f):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_ino != os.fstat(f.fileno()).st_ino
+                or st.st_size < f.tell())
+
+    def _iterLines(self):
+        f = self._open()
+        if f is None and not self.follow:
+            raise ChangeFeedError("Can't open change log %s" % self.path)
+        if f is not None and not self.replay:
+            f.seek(0, 2)
+        pending = ''
+        while not self._closed:
+            if f is None:
+                # Not created yet, or rotated: new changes are at the start
+                f = self._open()
+                if f is None:
+                    time.sleep(self.poll_interval)
+                    yield None
+                    continue
+            line = f.readline()
+            if line:
+                pending += line
+                if line.endswith('\n'):
+                    yield pending
+                    pending = ''
+                continue
+            if not self.follow:
+                break
+            if self._isRotated(f):
+                f.close()
+                f = None
+                pending = ''
+                continue
+            time.sleep(self.poll_interval)
+            yield None
+        if pending:
+            yield pending
+        if f is not None:
+            f.close()
+
+
+#
+# Listeners
+#
+
+class ChangeListener(threading.Thread):
+    """Thread consuming a change feed.
+
+    feed_factory() opens the feed. on_change(change_type, dn, previous_dn)
+    is called for each change, and on_reset() when changes may have been
+    missed: when the feed is opened, and when it fails. The feed is
+    opened again after retry_delay seconds when it fails.
+
+    config identifies the settings the feed was opened with.
+    """
+
+    def __init__(self, name, config, feed_factory, on_change, on_reset,
+                 retry_delay=RETRY_DELAY):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.config = config
+        self.retry_delay = retry_delay
+        self._feed_factory = feed_factory
+        self._on_change = on_change
+        self._on_reset = on_reset
+        self._stopped = threading.Event()
+        self.connected = False
+        self.changes = 0
+        self.errors = 0
+        self.last_change = None
+        self.last_error = None
+
+    def stop(self):
+        """Ask the thread to stop.
+
+        It stops the next time the feed yields a change or is idle.
+        """
+        self._stopped.set()
+
+    def isStopped(self):
+        return self._stopped.isSet()
+
+    def getStatistics(self):
+        """Get the status of the listener, as a dict."""
+        return {
+            'running': self.isAlive() and not self.isStopped(),
+            'connected': self.connected,
+            'changes': self.changes,
+            'errors': self.errors,
+            'last_change': self.last_change,
+            'last_error': self.last_error,
+            }
+
+    def _closeFeed(self, feed):
+        close = getattr(feed, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception, e:
+                logger.debug("Error closing change feed: %s", e)
+
+    def _consume(self, feed):
+        for change in feed:
+            if self._stopped.isSet():
+                return
+            if change is None:
+                continue
+            self.changes += 1
+            self.last_change = time.time()
+            logger.log(5, '%s: %s %s (was %s)', self.getName(), *change)
+            self._on_change(*change)
+
+    def run(self):
+        while not self._stopped.isSet():
+            feed = None
+            try:
+                feed = self._feed_factory()
+                # Changes done before the feed was opened are unknown
+                self._on_reset()
+                self.connected = True
+                self._consume(feed)
+            except Exception, e:
+                self.connected = False
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error("%s failed, retrying in %ss: %s", self.getName(),
+                             self.retry_delay, e)
+                self._on_reset()
+                if feed is not None:
+                    self._closeFeed(feed)
+                self._stopped.wait(self.retry_delay)
+                continue
+            # Stopped, or end of a replayed log
+            self._closeFeed(feed)
+            break
+        self.connected = False
+
+
+def getChangeListener(key):
+    """Get the listener for a key (typically a physical path), or None."""
+    return _listeners.get(key)
+
+def startChangeListener(key, config, feed_factory, on_change, on_reset,
+                        **kw):
+    """Start the listener for a key.
+
+    Nothing is done if a listener with the same config was already
+    started, otherwise it is stopped and replaced. Returns the listener.
+    The other keyword arguments are passed to ChangeListener.
+    """
+    _listeners_lock.acquire()
+    try:
+        listener = _listeners.get(key)
+        if listener is not None:
+            if listener.config == config and not listener.isStopped():
+                return listener
+            listener.stop()
+        name = 'Change feed %s' % '/'.join(key)
+        listener = ChangeListener(name, config, feed_factory, on_change,
+                                  on_reset, **kw)
+        _listeners[key] = listener
+        listener.start()
+        return listener
+    finally:
+        _listeners_lock.release()
+
+def stopChangeListener(key):
+    """Stop the listener for a key, if any."""
+    _listeners_lock.acquire()
+    try:
+        listener = _listeners.pop(key, None)
+    finally:
+        _listeners_lock.release()
+    if listener is not None:
+        listener.stop()
+
+def stopChangeListeners():
+    """Stop all the listeners (for tests)."""
+    _listeners_lock.acquire()
+    try:
+        listeners = _listeners.values()
+        _listeners.clear()
+    finally:
+        _listeners_lock.release()
+    for listener in listeners:
+        listener.stop()
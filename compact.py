@@ -0,0 +1,187 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Compact storage of directory entries.
+
+Instead of one persistent object per entry, entries are stored as
+records, tuples of values in the order of a field layout, kept in an
+OOBTree keyed by entry id. The records are pickled together in the
+buckets of the tree, so that a directory of small entries needs far
+fewer persistent objects, oids and ZODB cache slots.
+
+The field layout only grows: a new field is appended, and records that
+are shorter than the layout simply don't have a value for the last
+fields. Missing values are stored as Missing.Value, like in ZCatalog
+metadata records.
+"""
+
+from Globals import Persistent
+from Missing import MV
+
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+
+
+class CompactEntryStore(Persistent):
+    """Stores entries as records of values."""
+
+    def __init__(self, field_ids=()):
+        self._fields = ()
+        self._positions = {}
+        self._records = OOBTree()
+        self._length = Length()
+        for field_id in field_ids:
+            self._addField(field_id)
+
+    def _addField(self, field_id):
+        """Append a field to the layout, return its position."""
+        pos = len(self._fields)
+        self._fields = self._fields + (field_id,)
+        positions = self._positions.copy()
+        positions[field_id] = pos
+        self._positions = positions
+        return pos
+
+    def getFieldIds(self):
+        """Get the field layout of the records."""
+        return self._fields
+
+    def __len__(self):
+        return self._length()
+
+    def has_key(self, id):
+        return self._records.has_key(id)
+
+    __contains__ = has_key
+
+    def keys(self):
+        """Get the entry ids, sorted."""
+        return self._records.keys()
+
+    def iterkeys(self):
+        return self._records.iterkeys()
+
+    def createRecord(self, id):
+        """Create an empty record."""
+        if self._records.has_key(id):
+            raise KeyError("Entry '%s' already exists" % id)
+        self._records[id] = ()
+        self._length.change(1)
+
+    def deleteRecord(self, id):
+        """Delete a record. Raises KeyError if it doesn't exist."""
+        del self._records[id]
+        self._length.change(-1)
+
+    def getEntry(self, id, default=None):
+        """Get the entry object giving access to a record."""
+        if not self._records.has_key(id):
+            return default
+        return CompactEntry(self, id)
+
+    def items(self):
+        """Get the list of (id, entry), sorted by id."""
+        return [(id, CompactEntry(self, id)) for id in self._records.keys()]
+
+    def getValues(self, id):
+        """Get a dict of the values of a record."""
+        record = self._records[id]
+        values = {}
+        for field_id, value in zip(self._fields, record):
+            if value is not MV:
+                values[field_id] = value
+        return values
+
+    def getValue(self, id, field_id):
+        """Get a value of a record.
+
+        Raises AttributeError if the record has no value for the field.
+        """
+        record = self._records[id]
+        pos = self._positions.get(field_id)
+        if pos is None or pos >= len(record) or record[pos] is MV:
+            raise AttributeError(field_id)
+        return record[pos]
+
+    def setValues(self, id, values):
+        """Set some values of a record."""
+        record = list(self._records[id])
+        for field_id, value in values.items():
+            pos = self._positions.get(field_id)
+            if pos is None:
+                pos = self._addField(field_id)
+            if pos >= len(record):
+                record.extend([MV] * (pos + 1 - len(record)))
+            record[pos] = value
+        self._storeRecord(id, record)
+
+    def setValue(self, id, field_id, value):
+        """Set a value of a record."""
+        self.setValues(id, {field_id: value})
+
+    def delValue(self, id, field_id):
+        """Remove the value of a field from a record."""
+        record = list(self._records[id])
+        pos = self._positions.get(field_id)
+        if pos is None or pos >= len(record) or record[pos] is MV:
+            raise AttributeError(field_id)
+        record[pos] = MV
+        self._storeRecord(id, record)
+
+    def _storeRecord(self, id, record):
+        # Missing values at the end take no space
+        while record and record[-1] is MV:
+            del record[-1]
+        self._records[id] = tuple(record)
+
+
+class CompactEntry(object):
+    """Attribute access to a record, for use by storage adapters.
+
+    Values are read from and written to the store directly.
+    """
+
+    def __init__(self, store, id):
+        self.__dict__['_store'] = store
+        self.__dict__['_id'] = id
+
+    def getId(self):
+        """Return the id of the entry."""
+        return self._id
+
+    def _isPrivate(self, name):
+        return (name.startswith('__') or name.startswith('_p_')
+                or name.startswith('_v_'))
+
+    def __getattr__(self, name):
+        if self._isPrivate(name):
+            raise AttributeError(name)
+        return self._store.getValue(self._id, name)
+
+    def __setattr__(self, name, value):
+        if self._isPrivate(name):
+            # _p_changed and such don't apply to records
+            return
+        self._store.setValue(self._id, name, value)
+
+    def __delattr__(self, name):
+        if self._isPrivate(name):
+            raise AttributeError(name)
+        self._store.delValue(self._id, name)
+
+    def __repr__(self):
+        return '<CompactEntry %r>' % (self._id,)
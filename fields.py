@@ -26,8 +26,16 @@ from Products.CPSSchemas.BasicFields import CPSStringListField
 from Products.CPSSchemas.BasicFields import CPSStringField
 from Products.CPSSchemas.BasicFields import toUTF8, fromUTF8
 
+from Products.CPSDirectory.utils import iterBatches
+
 logger = logging.getLogger(__name__)
 
+# Maximum number of values ORed in a single resolution search
+RESOLUTION_CHUNK_SIZE = 100
+
+# Key of the resolution caches in the request
+RESOLUTION_CACHE_KEY = '_cps_directory_dn_resolution'
+
 def attribute_to_dn(value, attr, directory=None):
     """Resolve an attribute value to provide a Dn."""
     logger.debug("attribute_to_dn : %s='%s'", attr, value)
@@ -79,6 +87,124 @@ def dn_to_attribute(dn, attr, directory=None):
         raise KeyError(dn)
     return entries[0][1][attr]
 
+def attributes_to_entries(values, attr, directory=None, return_fields=()):
+    """Resolve attribute values to partial entries.
+
+    Values are looked up by chunks, with one search per chunk.
+
+    Returns a dict mapping each value to its entry. Values matching no
+    entry, or more than one, are left out.
+    """
+    logger.debug("attributes_to_entries : %s, %d values", attr, len(values))
+    if attr not in return_fields:
+        return_fields = list(return_fields)
+        return_fields.append(attr)
+    values = [v for v in dict.fromkeys(values) if v]
+
+    found = {}
+    ambiguous = {}
+    for chunk in iterBatches(values, RESOLUTION_CHUNK_SIZE):
+        wanted = dict.fromkeys(chunk)
+        s_entries = directory._searchEntries(return_fields=return_fields,
+                                             **{attr: chunk})
+        for eid, entry in s_entries:
+            # some directories can have a substring behaviour,
+            # enforcing exact match
+            value = entry[attr]
+            if value not in wanted:
+                continue
+            if value in found:
+                ambiguous[value] = None
+            found[value] = entry
+
+    for value in values:
+        msg = "in directory '%s' with '%s=%s" % (directory.getId(),
+                                                 attr, value)
+        if value in ambiguous:
+            logger.info("More than one entry " + msg)
+            del found[value]
+        elif value not in found:
+            logger.info("No entry " + msg)
+    return found
+
+def attributes_to_dns(values, attr, directory=None):
+    """Resolve attribute values to Dns.
+
+    Returns a dict mapping each resolved value to its Dn.
+    """
+    entries = attributes_to_entries(values, attr, directory=directory,
+                                    return_fields=['dn'])
+    return dict((value, entry['dn']) for value, entry in entries.items())
+
+def _normalizeDN(dn):
+    return ','.join([rdn.strip() for rdn in dn.lower().split(',')])
+
+def dns_to_attributes(dns, attr, directory=None):
+    """Find the attribute values for given dns.
+
+    The dns are grouped by the attribute of their RDN, which is then
+    searched for by chunks in the directory. If that attribute isn't a
+    field of the directory, each dn is resolved separately.
+
+    Returns a dict mapping each resolved dn to the attribute value.
+    """
+    logger.debug('dns_to_attributes : %d dns', len(dns))
+    # attribute names are case insensitive
+    search_fields = dict((f.lower(), f)
+                         for f in directory._getFieldIds(search=True))
+    res = {}
+    by_rdn_attr = {}
+    for dn in dns:
+        rdn = dn.split(',')[0]
+        if '=' not in rdn:
+            logger.info("In directory '%s', invalid DN %s",
+                        directory.getId(), dn)
+            continue
+        rdn_attr, rdn_value = rdn.split('=', 1)
+        rdn_attr = search_fields.get(rdn_attr.strip().lower())
+        if rdn_attr is None:
+            try:
+                res[dn] = dn_to_attribute(dn, attr, directory=directory)
+            except KeyError:
+                pass
+            continue
+        by_rdn_attr.setdefault(rdn_attr, {}).setdefault(
+            fromUTF8(rdn_value.strip()), []).append(dn)
+
+    for rdn_attr, dns_by_value in by_rdn_attr.items():
+        wanted = {}
+        for group in dns_by_value.values():
+            for dn in group:
+                wanted[_normalizeDN(dn)] = dn
+        return_fields = ['dn', attr]
+        for chunk in iterBatches(dns_by_value.keys(), RESOLUTION_CHUNK_SIZE):
+            s_entries = directory._searchEntries(return_fields=return_fields,
+                                                 **{rdn_attr: chunk})
+            for eid, entry in s_entries:
+                dn = wanted.get(_normalizeDN(entry['dn']))
+                if dn is not None:
+                    res[dn] = entry[attr]
+        for dn in wanted.values():
+            if dn not in res:
+                logger.info("In directory '%s', no entry with DN %s",
+                            directory.getId(), dn)
+    return res
+
+def getResolutionCache(field, kind):
+    """Get the cache of resolved values of a field for the current request.
+
+    Returns a new dict if there is no request.
+    """
+    request = getattr(field, 'REQUEST', None)
+    other = getattr(request, 'other', None)
+    if other is None:
+        return {}
+    caches = other.get(RESOLUTION_CACHE_KEY)
+    if caches is None:
+        caches = other[RESOLUTION_CACHE_KEY] = {}
+    key = (field.aux_directory, field.ldap_attribute, kind)
+    return caches.setdefault(key, {})
+
 
 class CPSDistinguishedNameListField(CPSStringListField):
     """ Stores a list of DNs in ldap while presenting attribute values to CPS.
@@ -89,7 +215,9 @@ class CPSDistinguishedNameListField(CPSStringListField):
 
     performance note: if the attribute is the entry RDN, no LDAP query is
     issued for read. On the other hand, every write will have to query ldap to
-    deduce DN from attribute value.
+    deduce DN from attribute value. Values are resolved by chunks of
+    RESOLUTION_CHUNK_SIZE, with one OR search per chunk, and the results
+    are cached for the duration of the request.
 
     Remark: the auxiliary directory does not have to be an LDAP backing
     directory; it could be any directory with 'dn' and the attribute in the
@@ -145,9 +273,16 @@ class CPSDistinguishedNameListField(CPSStringListField):
         for field in cdf: # might include self's id
             data[field] = []
 
+        target_fields.sort()
+        cache = getResolutionCache(self, ('entry',) + tuple(target_fields))
+        missing = [v for v in values if v not in cache]
+        if missing:
+            cache.update(attributes_to_entries(missing, attr,
+                                               directory=aux_dir,
+                                               return_fields=target_fields))
+
         for v in values:
-            entry = attribute_to_entry(v, attr, directory=aux_dir,
-                                       return_fields=target_fields)
+            entry = cache.get(v)
             if entry is None:
                 continue
             for field, target_field in self.cross_dependent_fields_c.items():
@@ -164,9 +299,14 @@ class CPSDistinguishedNameListField(CPSStringListField):
         attr = self.ldap_attribute
         aux_dir = getToolByName(self, 'portal_directories')[self.aux_directory]
 
+        cache = getResolutionCache(self, 'dn')
+        missing = [v for v in value if v not in cache]
+        if missing:
+            cache.update(attributes_to_dns(missing, attr, directory=aux_dir))
+
         res = []
         for v in value:
-            dn = attribute_to_dn(v, attr, directory=aux_dir)
+            dn = cache.get(v)
             if dn:
                 res.append(dn)
         return res
@@ -177,15 +317,19 @@ class CPSDistinguishedNameListField(CPSStringListField):
         attr = self.ldap_attribute
         aux_dir = getToolByName(self, 'portal_directories')[self.aux_directory]
 
+        cache = getResolutionCache(self, 'attribute')
+        missing = [dn for dn in values
+                   if not dn.startswith(attr + '=') and dn not in cache]
+        if missing:
+            cache.update(dns_to_attributes(missing, attr, directory=aux_dir))
+
         res = []
         for dn in values:
             if dn.startswith(attr + '='): # fast case: attr is RDN
                 res.append(fromUTF8(dn.split(',')[0].split('=')[1]))
                 continue
-            try:
-                res.append(dn_to_attribute(dn, attr, directory=aux_dir))
-            except KeyError:
-                pass
+            if dn in cache:
+                res.append(cache[dn])
         return res
 
 InitializeClass(CPSDistinguishedNameListField)
@@ -0,0 +1,393 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Persistent indexes used by directories that store their entries
+in the ZODB.
+
+Indexes map values of a given field to the set of ids of the entries
+having that value. They are kept in sync by the directory on each
+write, and allow searches to avoid waking up all the entries.
+"""
+
+from Globals import Persistent
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from BTrees.OOBTree import union
+from BTrees.OOBTree import intersection
+from BTrees.Length import Length
+
+from Products.CPSDirectory.utils import valueKind
+from Products.CPSDirectory.utils import normalizeSubstring
+from Products.CPSDirectory.utils import titleSortKey
+
+# Size of the n-grams in substring indexes
+NGRAM_SIZE = 3
+
+
+def indexKey(value):
+    """Compute the key under which a scalar value is indexed.
+
+    Keys are tagged by kind of value so that a BTree never has to compare
+    values that Python would not order consistently. The tagging follows
+    what QueryMatcher considers equal: numbers and booleans together,
+    unicode and ASCII strings together, non ASCII byte strings apart.
+
+    Returns None for values that cannot be indexed.
+
+    >>> indexKey('abc') == indexKey(u'abc')
+    True
+    >>> indexKey(True) == indexKey(1)
+    True
+    >>> indexKey(object()) is None
+    True
+    """
+    kind = valueKind(value)
+    if kind is None:
+        return None
+    if kind == 's' and isinstance(value, str):
+        value = value.decode('ascii')
+    return (kind, value)
+
+
+def indexKeys(value):
+    """Compute the set of keys for the value of a field.
+
+    Returns None if the value cannot be indexed, in which case the entry
+    has to be checked explicitly on each search.
+    """
+    if value is None:
+        return set()
+    if isinstance(value, (list, tuple)):
+        items = value
+    else:
+        items = (value,)
+    keys = set()
+    for item in items:
+        if item is None:
+            # None never matches a query
+            continue
+        key = indexKey(item)
+        if key is None:
+            return None
+        keys.add(key)
+    return keys
+
+
+def sortKey(keys):
+    """Compute the key to sort entries on a field, from the index keys
+    of its value.
+
+    Entries without a value, or whose value cannot be indexed (keys is
+    None), sort last.
+
+    >>> sortKey(indexKeys(['b', 'a'])) < sortKey(indexKeys('b'))
+    True
+    >>> sortKey(indexKeys('z')) < sortKey(indexKeys(None))
+    True
+    """
+    if not keys:
+        return (1,)
+    return (0, min(keys))
+
+
+class FieldIndex(Persistent):
+    """Index of the values of a field.
+
+    For list values, each item is indexed.
+    """
+
+    def __init__(self, id):
+        self.id = id
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the index."""
+        self._fwd = OOBTree()     # key -> OOTreeSet of ids
+        self._rev = OOBTree()     # id -> tuple of keys
+        self._unindexable = OOTreeSet() # ids of not indexable values
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def _getKeys(self, value):
+        """Compute the keys to index a value under, or None."""
+        return indexKeys(value)
+
+    def indexEntry(self, id, value):
+        """Index the value of the field for a given entry."""
+        keys = self._getKeys(value)
+        if keys is None:
+            self.unindexEntry(id)
+            self._unindexable.insert(id)
+            self._length.change(1)
+            return
+        old_keys = self._rev.get(id)
+        if old_keys is not None and set(old_keys) == keys:
+            return
+        self.unindexEntry(id)
+        fwd = self._fwd
+        for key in keys:
+            ids = fwd.get(key)
+            if ids is None:
+                ids = fwd[key] = OOTreeSet()
+            ids.insert(id)
+        self._rev[id] = tuple(keys)
+        self._length.change(1)
+
+    def unindexEntry(self, id):
+        """Remove an entry from the index."""
+        if self._unindexable.has_key(id):
+            self._unindexable.remove(id)
+            self._length.change(-1)
+            return
+        keys = self._rev.get(id)
+        if keys is None:
+            return
+        fwd = self._fwd
+        for key in keys:
+            ids = fwd.get(key)
+            if ids is None:
+                continue
+            ids.remove(id)
+            if not ids:
+                del fwd[key]
+        del self._rev[id]
+        self._length.change(-1)
+
+    def getKeys(self, id):
+        """Get the keys an entry is indexed under.
+
+        Returns None if its value cannot be indexed.
+        """
+        if self._unindexable.has_key(id):
+            return None
+        return self._rev.get(id, ())
+
+    def search(self, values):
+        """Find entries having one of the given values.
+
+        Returns a tuple (ids, exact). If exact is false, ids is a
+        superset of the result, and candidates have to be checked.
+        Returns (None, False) if some value cannot be looked up.
+        """
+        fwd = self._fwd
+        res = None
+        for value in values:
+            key = indexKey(value)
+            if key is None:
+                return None, False
+            res = union(res, fwd.get(key))
+        if res is None:
+            res = OOTreeSet()
+        if self._unindexable:
+            return union(res, self._unindexable), False
+        return res, True
+
+    def searchRange(self, low, high):
+        """Find entries having a value between low and high (included).
+
+        None is an open bound. Only values of the same kind as the bounds
+        are considered, like QueryMatcher does.
+
+        Returns a tuple (ids, exact) like search().
+        """
+        if low is not None:
+            kind = valueKind(low)
+        else:
+            kind = valueKind(high)
+        if kind is None:
+            return None, False
+        if low is not None:
+            start = indexKey(low)
+        else:
+            start = (kind,)
+        if high is not None:
+            stop = indexKey(high)
+        else:
+            stop = None
+        res = None
+        for key, ids in self._fwd.items(start):
+            if key[0] != kind or (stop is not None and key > stop):
+                break
+            res = union(res, ids)
+        if res is None:
+            res = OOTreeSet()
+        if self._unindexable:
+            return union(res, self._unindexable), False
+        return res, True
+
+
+def ngrams(value, n=NGRAM_SIZE):
+    """Compute the set of n-grams of a normalized string.
+
+    Strings shorter than n are their own only n-gram.
+
+    >>> sorted(ngrams('abcd'))
+    ['abc', 'bcd']
+    >>> sorted(ngrams('ab'))
+    ['ab']
+    """
+    if len(value) <= n:
+        return set((value,))
+    return set([value[i:i+n] for i in range(len(value) - n + 1)])
+
+
+class TrigramIndex(FieldIndex):
+    """Substring index of the values of a field.
+
+    Values are normalized the way QueryMatcher does for substring
+    searches (accents folded, lowercased), then indexed under each of
+    their trigrams.
+
+    Searching only gives candidates, to be checked by the QueryMatcher.
+    """
+
+    def _getKeys(self, value):
+        """Compute the keys to index a value under, or None."""
+        if value is None:
+            return set()
+        if isinstance(value, (list, tuple)):
+            items = value
+        else:
+            items = (value,)
+        keys = set()
+        for item in items:
+            if item is None:
+                continue
+            if not isinstance(item, basestring):
+                return None
+            keys.update(ngrams(normalizeSubstring(item)))
+        return keys
+
+    def search(self, value):
+        """Find entries whose value may contain the given substring.
+
+        Returns a tuple (ids, exact) like FieldIndex.search, where
+        exact is always false.
+        """
+        value = normalizeSubstring(value)
+        fwd = self._fwd
+        if len(value) >= NGRAM_SIZE:
+            sets = []
+            for gram in ngrams(value):
+                ids = fwd.get(gram)
+                if ids is None:
+                    sets = [OOTreeSet()]
+                    break
+                sets.append(ids)
+            res = intersectIds(sets)
+        else:
+            # Short query, find the n-grams containing it
+            res = None
+            for gram, ids in fwd.items():
+                if value in gram:
+                    res = union(res, ids)
+        if res is None:
+            res = OOTreeSet()
+        return union(res, self._unindexable), False
+
+
+class TitleIndex(Persistent):
+    """Index of the titles of the entries, sorted without case nor accents.
+
+    The signature identifies how titles are computed, so that the
+    directory knows when the index has to be rebuilt.
+    """
+
+    def __init__(self, id, signature=None):
+        self.id = id
+        self.signature = signature
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the index."""
+        self._sorted = OOBTree() # (sort key, id) -> title
+        self._rev = OOBTree()    # id -> (sort key, id)
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def indexEntry(self, id, title):
+        """Index the title of an entry."""
+        key = (titleSortKey(title), id)
+        old_key = self._rev.get(id)
+        if old_key is None:
+            self._length.change(1)
+        else:
+            if old_key == key and self._sorted[key] == title:
+                return
+            del self._sorted[old_key]
+        self._sorted[key] = title
+        self._rev[id] = key
+
+    def unindexEntry(self, id):
+        """Remove an entry from the index."""
+        key = self._rev.get(id)
+        if key is None:
+            return
+        del self._sorted[key]
+        del self._rev[id]
+        self._length.change(-1)
+
+    def getTitle(self, id, default=None):
+        """Get the title of an entry."""
+        key = self._rev.get(id)
+        if key is None:
+            return default
+        return self._sorted[key]
+
+    def items(self):
+        """Get the list of (id, title), sorted by id."""
+        sorted = self._sorted
+        return [(id, sorted[key]) for id, key in self._rev.items()]
+
+    def sortedItems(self, prefix='', start=0, limit=None):
+        """Get a list of (id, title), sorted by title.
+
+        Only titles starting with prefix (compared without case nor
+        accents) are returned, skipping the first start ones, and at most
+        limit of them.
+        """
+        prefix = titleSortKey(prefix)
+        res = []
+        if limit is not None and limit <= 0:
+            return res
+        for key, title in self._sorted.items((prefix,)):
+            if not key[0].startswith(prefix):
+                break
+            if start:
+                start -= 1
+                continue
+            res.append((key[1], title))
+            if limit is not None and len(res) >= limit:
+                break
+        return res
+
+
+def intersectIds(sets):
+    """Intersect a sequence of id sets, smallest first."""
+    sets = list(sets)
+    sets.sort(key=len)
+    res = None
+    for ids in sets:
+        res = intersection(res, ids)
+        if not res:
+            break
+    return res
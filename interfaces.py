@@ -53,6 +53,12 @@ class IDirectory(Interface):
         or None.
         """
 
+    def createEntries(entries):
+        """Create several entries in the directory.
+
+        Returns the list of what createEntry returns for each entry.
+        """
+
     def getEntry(id, default=_marker):
         """Get entry filtered by acls and processes.
 
@@ -87,6 +93,13 @@ class IDirectory(Interface):
         return_fields=['*'] means to return all available fields.
         """
 
+    def iterSearchEntries(return_fields=None, batch_size=None, **kw):
+        """Search for entries in the directory, iterating over the results.
+
+        Same as searchEntries(), but returns an iterator. Results may be
+        fetched batch_size entries at a time.
+        """
+
     def editEntry(entry):
         """Edit an entry in the directory.
         """
@@ -130,6 +143,12 @@ class IDirectory(Interface):
         or None.
         """
 
+    def _createEntries(entries):
+        """Create several entries in the directory, unrestricted.
+
+        Returns the list of what _createEntry returns for each entry.
+        """
+
     def _deleteEntry(id):
         """Delete an entry in the directory, unrestricted.
         """
@@ -161,6 +180,13 @@ class IDirectory(Interface):
         This private method does not do ACL checks.
         """
 
+    def _iterSearchEntries(return_fields=None, batch_size=None, **kw):
+        """Search for entries in the directory, iterating, unrestricted.
+
+        See documentation on iterSearchEntries().
+        This private method does not do ACL checks.
+        """
+
     def _editEntry(entry, check_acls=False):
         """Edit an entry in the directory, unrestricted.
         """
@@ -0,0 +1,410 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Values of the LDAP sorting, virtual list view and change controls.
+
+The server side sort control (RFC 2891), the virtual list view control
+(draft-ietf-ldapext-ldapv3-vlv), the persistent search controls
+(draft-ietf-ldapext-psearch) and the content synchronization controls
+(RFC 4533) aren't provided by all the versions of python-ldap. This
+module encodes and decodes their BER values, so that they can be sent
+as plain LDAPControl. Like ldappool, it doesn't depend on the ldap
+module.
+"""
+
+SORT_REQUEST_OID = '1.2.840.113556.1.4.473'
+SORT_RESPONSE_OID = '1.2.840.113556.1.4.474'
+VLV_REQUEST_OID = '2.16.840.1.113730.3.4.9'
+VLV_RESPONSE_OID = '2.16.840.1.113730.3.4.10'
+PSEARCH_OID = '2.16.840.1.113730.3.4.3'
+ENTRY_CHANGE_OID = '2.16.840.1.113730.3.4.7'
+SYNC_REQUEST_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+SYNC_STATE_OID = '1.3.6.1.4.1.4203.1.9.1.2'
+
+# Change types of persistent searches
+CHANGE_ADD = 1
+CHANGE_DELETE = 2
+CHANGE_MODIFY = 4
+CHANGE_MODDN = 8
+CHANGE_ANY = 15
+
+# Content synchronization modes and entry states
+SYNC_REFRESH_ONLY = 1
+SYNC_REFRESH_AND_PERSIST = 3
+SYNC_PRESENT = 0
+SYNC_ADD = 1
+SYNC_MODIFY = 2
+SYNC_DELETE = 3
+
+# BER tags
+BOOLEAN = 0x01
+INTEGER = 0x02
+OCTET_STRING = 0x04
+ENUMERATED = 0x0a
+SEQUENCE = 0x30
+CONTEXT = 0x80
+CONSTRUCTED = 0x20
+
+#
+# BER
+#
+
+def encodeLength(n):
+    """Encode the length of a BER element.
+
+    >>> encodeLength(3)
+    '\\x03'
+    >>> encodeLength(300)
+    '\\x82\\x01,'
+    """
+    if n < 0x80:
+        return chr(n)
+    s = ''
+    while n:
+        s = chr(n & 0xff) + s
+        n >>= 8
+    return chr(0x80 | len(s)) + s
+
+def encode(tag, content):
+    """Encode a BER element."""
+    return chr(tag) + encodeLength(len(content)) + content
+
+def encodeInteger(n, tag=INTEGER):
+    """Encode an integer.
+
+    >>> encodeInteger(0)
+    '\\x02\\x01\\x00'
+    >>> encodeInteger(128)
+    '\\x02\\x02\\x00\\x80'
+    >>> encodeInteger(-1)
+    '\\x02\\x01\\xff'
+    """
+    s = ''
+    while True:
+        s = chr(n & 0xff) + s
+        n >>= 8
+        high = ord(s[0]) & 0x80
+        if (n == 0 and not high) or (n == -1 and high):
+            break
+    return encode(tag, s)
+
+def decodeInteger(content):
+    """Decode the content of an integer.
+
+    >>> decodeInteger('\\x00\\x80')
+    128
+    >>> decodeInteger('\\xff')
+    -1
+    """
+    n = 0
+    for c in content:
+        n = (n << 8) | ord(c)
+    if content and ord(content[0]) & 0x80:
+        n -= 1 << (8 * len(content))
+    return n
+
+def decode(data):
+    """Decode a string of BER elements into a list of (tag, content).
+
+    Only the elements at the first level are decoded.
+
+    >>> decode(encodeInteger(3) + encode(OCTET_STRING, 'cn'))
+    [(2, '\\x03'), (4, 'cn')]
+    """
+    elements = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        if pos + 2 > end:
+            raise ValueError("Truncated BER data")
+        tag = ord(data[pos])
+        length = ord(data[pos+1])
+        pos += 2
+        if length & 0x80:
+            n = length & 0x7f
+            length = 0
+            for c in data[pos:pos+n]:
+                length = (length << 8) | ord(c)
+            pos += n
+        content = data[pos:pos+length]
+        if len(content) < length:
+            raise ValueError("Truncated BER data")
+        elements.append((tag, content))
+        pos += length
+    return elements
+
+def _decodeSequence(value):
+    elements = decode(value)
+    if len(elements) != 1 or elements[0][0] != SEQUENCE:
+        raise ValueError("Expected a BER sequence")
+    return decode(elements[0][1])
+
+#
+# Server side sort (RFC 2891)
+#
+
+def encodeSortRequest(keys):
+    """Encode the value of a sort request control.
+
+    keys is a sequence of (attribute, reverse).
+
+    >>> keys = [('sn', False), ('givenName', True)]
+    >>> decodeSortRequest(encodeSortRequest(keys)) == keys
+    True
+    """
+    items = []
+    for attr, reverse in keys:
+        content = encode(OCTET_STRING, attr)
+        if reverse:
+            content += encode(CONTEXT | 1, '\xff')
+        items.append(encode(SEQUENCE, content))
+    return encode(SEQUENCE, ''.join(items))
+
+def decodeSortRequest(value):
+    """Decode the value of a sort request control into (attribute, reverse).
+
+    Ordering rules are ignored.
+    """
+    keys = []
+    for tag, content in _decodeSequence(value):
+        attr = None
+        reverse = False
+        for tag, v in decode(content):
+            if tag == OCTET_STRING:
+                attr = v
+            elif tag == CONTEXT | 1:
+                reverse = v != '\x00'
+        keys.append((attr, reverse))
+    return keys
+
+def encodeSortResponse(result, attr=None):
+    """Encode the value of a sort response control.
+
+    >>> decodeSortResponse(encodeSortResponse(0))
+    (0, None)
+    >>> decodeSortResponse(encodeSortResponse(16, 'sn'))
+    (16, 'sn')
+    """
+    content = encodeInteger(result, ENUMERATED)
+    if attr is not None:
+        content += encode(CONTEXT | 0, attr)
+    return encode(SEQUENCE, content)
+
+def decodeSortResponse(value):
+    """Decode the value of a sort response control into (result, attr).
+
+    result is 0 if the results were sorted.
+    """
+    elements = _decodeSequence(value)
+    result = decodeInteger(elements[0][1])
+    attr = None
+    for tag, content in elements[1:]:
+        if tag == CONTEXT | 0:
+            attr = content
+    return result, attr
+
+#
+# Virtual list view
+#
+
+def encodeVLVRequest(before, after, offset, count=0, context=None):
+    """Encode the value of a virtual list view request, by offset.
+
+    before and after are the number of entries returned around the
+    target, offset is its position starting at 1 and count the number
+    of entries estimated by the client (0 if unknown).
+
+    >>> decodeVLVRequest(encodeVLVRequest(0, 19, 41))
+    (0, 19, 41, 0, None)
+    """
+    target = encodeInteger(offset) + encodeInteger(count)
+    content = (encodeInteger(before) + encodeInteger(after) +
+               encode(CONTEXT | CONSTRUCTED | 0, target))
+    if context is not None:
+        content += encode(OCTET_STRING, context)
+    return encode(SEQUENCE, content)
+
+def decodeVLVRequest(value):
+    """Decode the value of a virtual list view request.
+
+    Returns (before, after, offset, count, context). Only requests by
+    offset are supported.
+    """
+    elements = _decodeSequence(value)
+    before = decodeInteger(elements[0][1])
+    after = decodeInteger(elements[1][1])
+    tag, target = elements[2]
+    if tag != CONTEXT | CONSTRUCTED | 0:
+        raise ValueError("Unsupported virtual list view target")
+    offset, count = [decodeInteger(v) for t, v in decode(target)]
+    context = None
+    for tag, content in elements[3:]:
+        if tag == OCTET_STRING:
+            context = content
+    return before, after, offset, count, context
+
+def encodeVLVResponse(position, count, result, context=None):
+    """Encode the value of a virtual list view response.
+
+    >>> decodeVLVResponse(encodeVLVResponse(41, 1000, 0, 'ctx'))
+    (41, 1000, 0, 'ctx')
+    """
+    content = (encodeInteger(position) + encodeInteger(count) +
+               encodeInteger(result, ENUMERATED))
+    if context is not None:
+        content += encode(OCTET_STRING, context)
+    return encode(SEQUENCE, content)
+
+def decodeVLVResponse(value):
+    """Decode the value of a virtual list view response.
+
+    Returns (target position, content count, result, context). result
+    is 0 if the requested entries were returned.
+    """
+    elements = _decodeSequence(value)
+    position, count, result = [decodeInteger(v) for t, v in elements[:3]]
+    context = None
+    for tag, content in elements[3:]:
+        if tag == OCTET_STRING:
+            context = content
+    return position, count, result, context
+
+def _encodeBoolean(value):
+    if value:
+        return encode(BOOLEAN, '\xff')
+    return encode(BOOLEAN, '\x00')
+
+#
+# Persistent search
+#
+
+def encodePersistentSearch(change_types=CHANGE_ANY, changes_only=True,
+                           return_ecs=True):
+    """Encode the value of a persistent search control.
+
+    change_types is a combination of the CHANGE_* flags. If changes_only
+    is false, the existing entries are returned first. If return_ecs is
+    true, entries come with an entry change notification control.
+
+    >>> decodePersistentSearch(encodePersistentSearch())
+    (15, True, True)
+    """
+    content = (encodeInteger(change_types) + _encodeBoolean(changes_only) +
+               _encodeBoolean(return_ecs))
+    return encode(SEQUENCE, content)
+
+def decodePersistentSearch(value):
+    """Decode the value of a persistent search control.
+
+    Returns (change_types, changes_only, return_ecs).
+    """
+    elements = _decodeSequence(value)
+    change_types = decodeInteger(elements[0][1])
+    changes_only, return_ecs = [v != '\x00' for t, v in elements[1:3]]
+    return change_types, changes_only, return_ecs
+
+def encodeEntryChange(change_type, previous_dn=None, change_number=None):
+    """Encode the value of an entry change notification control.
+
+    >>> decodeEntryChange(encodeEntryChange(CHANGE_MODDN, 'cn=old,o=org'))
+    (8, 'cn=old,o=org', None)
+    >>> decodeEntryChange(encodeEntryChange(CHANGE_ADD, change_number=42))
+    (1, None, 42)
+    """
+    content = encodeInteger(change_type, ENUMERATED)
+    if previous_dn is not None:
+        content += encode(OCTET_STRING, previous_dn)
+    if change_number is not None:
+        content += encodeInteger(change_number)
+    return encode(SEQUENCE, content)
+
+def decodeEntryChange(value):
+    """Decode the value of an entry change notification control.
+
+    Returns (change_type, previous_dn, change_number). The previous dn
+    is only sent for renamed entries.
+    """
+    elements = _decodeSequence(value)
+    change_type = decodeInteger(elements[0][1])
+    previous_dn = change_number = None
+    for tag, content in elements[1:]:
+        if tag == OCTET_STRING:
+            previous_dn = content
+        elif tag == INTEGER:
+            change_number = decodeInteger(content)
+    return change_type, previous_dn, change_number
+
+#
+# Content synchronization (RFC 4533)
+#
+
+def encodeSyncRequest(mode=SYNC_REFRESH_AND_PERSIST, cookie=None,
+                      reload_hint=False):
+    """Encode the value of a sync request control.
+
+    >>> decodeSyncRequest(encodeSyncRequest(cookie='rid=1,csn=2'))
+    (3, 'rid=1,csn=2', False)
+    >>> decodeSyncRequest(encodeSyncRequest(SYNC_REFRESH_ONLY))
+    (1, None, False)
+    """
+    content = encodeInteger(mode, ENUMERATED)
+    if cookie is not None:
+        content += encode(OCTET_STRING, cookie)
+    if reload_hint:
+        content += _encodeBoolean(True)
+    return encode(SEQUENCE, content)
+
+def decodeSyncRequest(value):
+    """Decode the value of a sync request control.
+
+    Returns (mode, cookie, reload_hint).
+    """
+    elements = _decodeSequence(value)
+    mode = decodeInteger(elements[0][1])
+    cookie = None
+    reload_hint = False
+    for tag, content in elements[1:]:
+        if tag == OCTET_STRING:
+            cookie = content
+        elif tag == BOOLEAN:
+            reload_hint = content != '\x00'
+    return mode, cookie, reload_hint
+
+def encodeSyncState(state, entry_uuid, cookie=None):
+    """Encode the value of a sync state control.
+
+    >>> decodeSyncState(encodeSyncState(SYNC_DELETE, 'u' * 16, 'csn=3'))
+    (3, 'uuuuuuuuuuuuuuuu', 'csn=3')
+    """
+    content = encodeInteger(state, ENUMERATED) + encode(OCTET_STRING,
+                                                         entry_uuid)
+    if cookie is not None:
+        content += encode(OCTET_STRING, cookie)
+    return encode(SEQUENCE, content)
+
+def decodeSyncState(value):
+    """Decode the value of a sync state control.
+
+    Returns (state, entry_uuid, cookie).
+    """
+    elements = _decodeSequence(value)
+    state = decodeInteger(elements[0][1])
+    entry_uuid = elements[1][1]
+    cookie = None
+    if len(elements) > 2:
+        cookie = elements[2][1]
+    return state, entry_uuid, cookie
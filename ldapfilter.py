@@ -0,0 +1,365 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Evaluation of LDAP search filters on local copies of entries.
+
+Filters (RFC 4515) are parsed into trees of tuples:
+
+- ('&', children) and ('|', children),
+- ('!', child),
+- ('=', attr, value), approximate matches being treated as equality,
+- ('present', attr),
+- ('sub', attr, initial, any, final), any being a tuple,
+- ('>=', attr, value) and ('<=', attr, value).
+
+Attribute names are lowercased, and values unescaped and normalized.
+
+Trees are compiled into predicates taking entries as mappings of the
+lowercased attribute names to lists of values, as returned by python-ldap.
+Values are compared ignoring case and repeated spaces, like the
+caseIgnoreMatch rule used by most attributes; ordering comparisons are
+numeric when both values are integers.
+
+Extensible matches are not supported. Like ldapcontrols, this module
+doesn't depend on the ldap module.
+"""
+
+import re
+
+_spaces = re.compile(r'\s+', re.UNICODE)
+_hex = '0123456789abcdefABCDEF'
+
+
+class FilterError(ValueError):
+    """A filter can't be parsed or evaluated."""
+
+
+def normalizeValue(value):
+    """Normalize an UTF-8 value for comparisons.
+
+    >>> normalizeValue('  John   DOE ')
+    u'john doe'
+    >>> normalizeValue('\\xc3\\x89T\\xc3\\x89')
+    u'\\xe9t\\xe9'
+    """
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8', 'replace')
+    return _spaces.sub(u' ', value.strip()).lower()
+
+def _unescape(value):
+    """Unescape a filter value.
+
+    >>> _unescape('a\\\\2a\\\\28b\\\\29')
+    'a*(b)'
+    >>> _unescape('a\\\\*')
+    'a*'
+    """
+    if '\\' not in value:
+        return value
+    res = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c != '\\':
+            res.append(c)
+            i += 1
+        elif (i + 2 < len(value) and value[i+1] in _hex
+              and value[i+2] in _hex):
+            res.append(chr(int(value[i+1:i+3], 16)))
+            i += 3
+        elif i + 1 < len(value):
+            # RFC 2254 style escaping of a single char
+            res.append(value[i+1])
+            i += 2
+        else:
+            raise FilterError("Bad escaping in %r" % value)
+    return ''.join(res)
+
+def _splitSubstrings(value):
+    """Split a value on its unescaped stars."""
+    parts = []
+    start = 0
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '*':
+            parts.append(value[start:i])
+            start = i + 1
+        i += 1
+    parts.append(value[start:])
+    return parts
+
+
+#
+# Parsing
+#
+
+def parseFilter(filter):
+    """Parse a filter into a tree.
+
+    >>> parseFilter('(&(objectClass=person)(|(cn=Jo*n*)(!(mail=*))))')
+    ('&', (('=', 'objectclass', u'person'), ('|', (('sub', 'cn', u'jo', (u'n',), u''), ('!', ('present', 'mail'))))))
+    >>> parseFilter('uidNumber>=1000')
+    ('>=', 'uidnumber', u'1000')
+    >>> parseFilter('(cn:dn:=John)')
+    Traceback (most recent call last):
+    ...
+    FilterError: Extensible match not supported in '(cn:dn:=John)'
+    """
+    if isinstance(filter, unicode):
+        filter = filter.encode('utf-8')
+    filter = filter.strip()
+    if not filter.startswith('('):
+        filter = '(%s)' % filter
+    node, pos = _parse(filter, 0)
+    if pos != len(filter):
+        raise FilterError("Trailing characters in %r" % filter)
+    return node
+
+def _parse(filter, pos):
+    """Parse the filter starting at pos, return (node, end position)."""
+    if filter[pos:pos+1] != '(':
+        raise FilterError("Expected '(' at %s in %r" % (pos, filter))
+    pos += 1
+    c = filter[pos:pos+1]
+    if c in ('&', '|'):
+        children = []
+        pos += 1
+        while filter[pos:pos+1] == '(':
+            child, pos = _parse(filter, pos)
+            children.append(child)
+        node = (c, tuple(children))
+    elif c == '!':
+        child, pos = _parse(filter, pos + 1)
+        node = ('!', child)
+    else:
+        end = pos
+        while end < len(filter) and filter[end] != ')':
+            if filter[end] == '(':
+                raise FilterError("Unexpected '(' at %s in %r"
+                                  % (end, filter))
+            if filter[end] == '\\':
+                end += 1
+            end += 1
+        node = _parseItem(filter[pos:end], filter)
+        pos = end
+    if filter[pos:pos+1] != ')':
+        raise FilterError("Expected ')' at %s in %r" % (pos, filter))
+    return node, pos + 1
+
+def _parseItem(item, filter):
+    eq = item.find('=')
+    if eq <= 0:
+        raise FilterError("Bad item %r in %r" % (item, filter))
+    attr = item[:eq]
+    value = item[eq+1:]
+    op = '='
+    if attr[-1] in '~<>:':
+        op = attr[-1] + '='
+        attr = attr[:-1]
+    if op == ':=' or ':' in attr:
+        raise FilterError("Extensible match not supported in %r" % filter)
+    attr = attr.strip().lower()
+    if not attr:
+        raise FilterError("Bad item %r in %r" % (item, filter))
+    if op in ('>=', '<='):
+        return (op, attr, normalizeValue(_unescape(value)))
+    if op == '=' and value == '*':
+        return ('present', attr)
+    parts = _splitSubstrings(value)
+    if len(parts) == 1 or op == '~=':
+        return ('=', attr, normalizeValue(_unescape(value)))
+    parts = [normalizeValue(_unescape(part)) for part in parts]
+    return ('sub', attr, parts[0], tuple(parts[1:-1]), parts[-1])
+
+def filterAttributes(node):
+    """Get the attributes a filter tree depends on.
+
+    >>> sorted(filterAttributes(parseFilter('(&(cn=a)(!(sn>=b)))')))
+    ['cn', 'sn']
+    """
+    attrs = set()
+    if node is None:
+        return attrs
+    op = node[0]
+    if op in ('&', '|'):
+        for child in node[1]:
+            attrs.update(filterAttributes(child))
+    elif op == '!':
+        attrs.update(filterAttributes(node[1]))
+    else:
+        attrs.add(node[1])
+    return attrs
+
+def removeTerm(node, term):
+    """Remove a term known to be true from a filter tree.
+
+    Returns None if the whole filter is then known to be true.
+
+    >>> known = parseFilter('(objectClass=person)')
+    >>> removeTerm(parseFilter('(&(objectClass=person)(cn=a))'), known)
+    ('=', 'cn', u'a')
+    >>> removeTerm(known, known) is None
+    True
+    """
+    if node == term:
+        return None
+    if node[0] != '&':
+        return node
+    children = [child for child in node[1] if child != term]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return ('&', tuple(children))
+
+def getIndexTerms(node, indexed):
+    """Get equality terms whose matches include those of a filter tree.
+
+    indexed is the set of attributes that can be looked up. Returns a
+    list of (attr, value), the filter matching only entries having one
+    of them, or None if the filter can't be narrowed that way.
+
+    >>> getIndexTerms(parseFilter('(&(sn=*)(|(uid=a)(uid=b)))'), ['uid'])
+    [('uid', u'a'), ('uid', u'b')]
+    >>> getIndexTerms(parseFilter('(|(uid=a)(cn=b))'), ['uid']) is None
+    True
+    """
+    if node is None:
+        return None
+    op = node[0]
+    if op == '=':
+        if node[1] in indexed:
+            return [(node[1], node[2])]
+        return None
+    if op == '&':
+        best = None
+        for child in node[1]:
+            terms = getIndexTerms(child, indexed)
+            if terms is not None and (best is None or len(terms) < len(best)):
+                best = terms
+        return best
+    if op == '|':
+        res = []
+        for child in node[1]:
+            terms = getIndexTerms(child, indexed)
+            if terms is None:
+                return None
+            res.extend(terms)
+        return res
+    return None
+
+
+#
+# Evaluation
+#
+
+def _toInt(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def _compareValue(a, b):
+    """Compare two normalized values, numerically if possible."""
+    ia = _toInt(a)
+    if ia is not None:
+        ib = _toInt(b)
+        if ib is not None:
+            return cmp(ia, ib)
+    return cmp(a, b)
+
+def compileFilter(node):
+    """Compile a filter tree into a predicate on entries.
+
+    A None tree matches all the entries.
+
+    >>> match = compileFilter(parseFilter('(&(cn=*doe)(uidNumber<=1000))'))
+    >>> match({'cn': ['John  Doe'], 'uidnumber': ['999']})
+    True
+    >>> match({'cn': ['John Doe'], 'uidnumber': ['1001']})
+    False
+    >>> match({'cn': ['Jane Doe']})
+    False
+    """
+    if node is None:
+        return lambda entry: True
+    op = node[0]
+    if op == '&':
+        preds = [compileFilter(child) for child in node[1]]
+        def match(entry):
+            for pred in preds:
+                if not pred(entry):
+                    return False
+            return True
+    elif op == '|':
+        preds = [compileFilter(child) for child in node[1]]
+        def match(entry):
+            for pred in preds:
+                if pred(entry):
+                    return True
+            return False
+    elif op == '!':
+        pred = compileFilter(node[1])
+        def match(entry):
+            return not pred(entry)
+    elif op == 'present':
+        attr = node[1]
+        def match(entry):
+            return not not entry.get(attr)
+    elif op == '=':
+        attr, expected = node[1], node[2]
+        def match(entry):
+            for value in entry.get(attr, ()):
+                if normalizeValue(value) == expected:
+                    return True
+            return False
+    elif op == 'sub':
+        attr, initial, any, final = node[1:]
+        def match(entry):
+            for value in entry.get(attr, ()):
+                value = normalizeValue(value)
+                if not value.startswith(initial):
+                    continue
+                pos = len(initial)
+                for part in any:
+                    pos = value.find(part, pos)
+                    if pos < 0:
+                        break
+                    pos += len(part)
+                else:
+                    if (len(value) - len(final) >= pos
+                        and value.endswith(final)):
+                        return True
+            return False
+    elif op in ('>=', '<='):
+        attr, expected = node[1], node[2]
+        if op == '>=':
+            sign = 1
+        else:
+            sign = -1
+        def match(entry):
+            for value in entry.get(attr, ()):
+                if _compareValue(normalizeValue(value), expected) * sign >= 0:
+                    return True
+            return False
+    else:
+        raise FilterError("Unknown filter node %r" % (node,))
+    return match
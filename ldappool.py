@@ -0,0 +1,358 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Pools of LDAP connections.
+
+Opening and binding a connection to an LDAP server is expensive. Pools
+are kept per process, like the RAM cache managers, and shared by all
+the directories that use the same server with the same bind
+credentials: each thread borrows a connection for the duration of an
+LDAP operation, then gives it back.
+
+This module doesn't depend on the ldap module: connections are opened
+by a factory, and checked by a function, both given by the caller.
+"""
+
+import time
+import threading
+from logging import getLogger
+
+logger = getLogger('CPSDirectory.ldappool')
+
+DEFAULT_MIN_SIZE = 0
+DEFAULT_MAX_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# Connections idle for longer than this are checked before being reused
+CHECK_DELAY = 30.0
+
+# Time to wait for a connection when all of them are in use
+WAIT_TIMEOUT = 30.0
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolExhaustedError(Exception):
+    """No connection could be borrowed in time."""
+
+
+def getPool(key, factory, check=None, **kw):
+    """Get the pool for a given key, creating it if needed.
+
+    factory and check are only used when creating the pool. The other
+    keyword arguments are the pool sizes and timeouts, they update the
+    settings of an existing pool.
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(factory, check)
+    finally:
+        _pools_lock.release()
+    if kw:
+        pool.configure(**kw)
+    return pool
+
+def getExistingPool(key):
+    """Get the pool for a given key, or None."""
+    return _pools.get(key)
+
+def listPools(prefix):
+    """Get the pools whose key is a tuple starting with prefix."""
+    n = len(prefix)
+    _pools_lock.acquire()
+    try:
+        return [pool for key, pool in _pools.items()
+                if isinstance(key, tuple) and key[:n] == prefix]
+    finally:
+        _pools_lock.release()
+
+def clearPools():
+    """Close all pools and forget them."""
+    _pools_lock.acquire()
+    try:
+        pools = _pools.values()
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+    for pool in pools:
+        pool.close()
+
+def closeConnection(conn):
+    """Unbind a connection, ignoring errors."""
+    unbind = getattr(conn, 'unbind_s', None)
+    if unbind is None:
+        return
+    try:
+        unbind()
+    except Exception, e:
+        logger.debug("Error closing connection: %s", e)
+
+
+class ConnectionPool(object):
+    """A pool of connections bound with the same credentials.
+
+    factory() opens and binds a new connection. check(conn) raises an
+    exception if the connection doesn't work anymore.
+
+    At most max_size connections are open at the same time; above that,
+    borrowers wait. Idle connections are closed after idle_timeout
+    seconds, except for min_size of them.
+
+    server_info is a mapping where users of the pool can keep what they
+    learn about the server, such as the controls it supports.
+    """
+
+    def __init__(self, factory, check=None,
+                 min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.factory = factory
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = [] # (last use time, connection), most recent last
+        self._size = 0 # open connections, idle or in use
+        self._abandoned = [] # connections to close, see abandon()
+        self.closed = False
+        self.server_info = {}
+        self.resetCounters()
+
+    def configure(self, min_size=None, max_size=None, idle_timeout=None):
+        """Change the settings of the pool."""
+        self._cond.acquire()
+        try:
+            if min_size is not None:
+                self.min_size = max(0, min_size)
+            if max_size is not None:
+                self.max_size = max(1, max_size)
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            # Waiters may proceed if max_size grew
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def resetCounters(self):
+        """Reset the statistics."""
+        self._cond.acquire()
+        try:
+            self.created = 0
+            self.reused = 0
+            self.discarded = 0
+            self.expired = 0
+            self.waits = 0
+            self.timeouts = 0
+        finally:
+            self._cond.release()
+
+    def _count(self, counter):
+        """Increment a statistics counter, taking the lock."""
+        self._cond.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._cond.release()
+
+    def getStatistics(self):
+        """Get the statistics of the pool, as a dict."""
+        self._cond.acquire()
+        try:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'expired': self.expired,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                }
+        finally:
+            self._cond.release()
+
+    def borrow(self, timeout=WAIT_TIMEOUT):
+        """Borrow a connection, to be given back using release().
+
+        Raises PoolExhaustedError if no connection is available after
+        waiting timeout seconds, or the exception raised by the factory.
+        """
+        while True:
+            conn, last_used = self._reserve(timeout)
+            if conn is None:
+                return self._create()
+            if (self.check is None or
+                time.time() - last_used < CHECK_DELAY):
+                self._count('reused')
+                return conn
+            try:
+                self.check(conn)
+            except Exception, e:
+                logger.info("Discarding broken connection: %s", e)
+                self._discard(conn)
+                continue
+            self._count('reused')
+            return conn
+
+    def _reserve(self, timeout):
+        """Take an idle connection, or a slot for a new one.
+
+        Returns (connection, last use time), or (None, None) when a new
+        connection has to be created.
+        """
+        expired = []
+        cond = self._cond
+        cond.acquire()
+        try:
+            expired = self._expire()
+            deadline = None
+            while not self._idle and self._size >= self.max_size:
+                abandoned = self._takeAbandoned()
+                if abandoned:
+                    expired.extend(abandoned)
+                    continue
+                now = time.time()
+                if deadline is None:
+                    self.waits += 1
+                    deadline = now + timeout
+                elif now >= deadline:
+                    self.timeouts += 1
+                    raise PoolExhaustedError("No LDAP connection available "
+                                             "after %s seconds" % timeout)
+                cond.wait(deadline - now)
+            if self._idle:
+                last_used, conn = self._idle.pop()
+                return conn, last_used
+            self._size += 1
+            return None, None
+        finally:
+            cond.release()
+            for conn in expired:
+                closeConnection(conn)
+
+    def _expire(self):
+        """Remove the connections idle for too long, keeping min_size.
+
+        Called with the lock held. Returns the connections to close.
+        """
+        limit = time.time() - self.idle_timeout
+        idle = self._idle
+        expired = []
+        # Oldest first
+        while (idle and idle[0][0] < limit and
+               self._size - len(expired) > self.min_size):
+            expired.append(idle.pop(0)[1])
+        self._size -= len(expired)
+        self.expired += len(expired)
+        return expired + self._takeAbandoned()
+
+    def _takeAbandoned(self):
+        """Remove the abandoned connections from the pool.
+
+        Called with the lock held. Returns the connections to close.
+        """
+        abandoned = self._abandoned
+        if not abandoned:
+            return []
+        # abandon() appends without the lock, take only what we saw
+        n = len(abandoned)
+        taken = abandoned[:n]
+        del abandoned[:n]
+        self._size -= n
+        self.discarded += n
+        return taken
+
+    def _create(self):
+        """Create a new connection in a reserved slot."""
+        try:
+            conn = self.factory()
+        except:
+            self._free()
+            raise
+        conn._cps_pool = self
+        self._count('created')
+        return conn
+
+    def _free(self, discarded=False):
+        """Free the slot of a connection that is closed."""
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            if discarded:
+                self.discarded += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _discard(self, conn):
+        self._free(discarded=True)
+        closeConnection(conn)
+
+    def release(self, conn, broken=False):
+        """Give back a borrowed connection.
+
+        Broken connections are closed instead of being reused.
+        """
+        if broken or self.closed:
+            self._discard(conn)
+            return
+        self._cond.acquire()
+        try:
+            self._idle.append((time.time(), conn))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def abandon(self, conn):
+        """Give back a borrowed connection from a finalizer.
+
+        The connection is not reused, as it may be in the middle of an
+        operation. It is only queued, without taking the lock nor doing
+        any network I/O, and closed by the next borrower.
+        """
+        self._abandoned.append(conn)
+
+    def closeIdle(self):
+        """Close the idle connections."""
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            abandoned = self._takeAbandoned()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        for last_used, conn in idle:
+            closeConnection(conn)
+        for conn in abandoned:
+            closeConnection(conn)
+
+    def close(self):
+        """Close the pool.
+
+        Connections in use are closed when given back.
+        """
+        self.closed = True
+        self.closeIdle()
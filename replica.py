@@ -0,0 +1,323 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Local replicas of the entries of LDAP directories.
+
+A replica keeps a copy of the LDAP values of the entries of a directory
+in the ZODB, so that reads and searches don't need the LDAP server. The
+directory loads it fully once, then brings it up to date by reading the
+entries changed since the last sync, found using a watermark attribute
+(modifyTimestamp or entryCSN), and the list of the existing dns.
+
+Entries are kept in an OOBTree keyed by their rdns, lowercased, from the
+root of the tree down to the entry, so that the entries of a subtree are
+a range of keys. The callers use change keys, which are the same rdns
+starting from the entry (see LDAPBackingDirectory.getChangeKey).
+Equality indexes can be kept on some attributes.
+
+Like ldapcontrols, this module doesn't depend on the ldap module.
+"""
+
+import time
+import calendar
+import threading
+
+from Globals import Persistent
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from BTrees.OOBTree import union
+from BTrees.Length import Length
+
+from Products.CPSDirectory.ldapfilter import compileFilter
+from Products.CPSDirectory.ldapfilter import getIndexTerms
+from Products.CPSDirectory.ldapfilter import normalizeValue
+
+# Search scopes, as defined by the LDAP protocol
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+# Attributes that are never stored, but can be asked for
+_NO_ATTRS = ('dn', '1.1')
+
+_syncing = set()
+_syncing_lock = threading.Lock()
+
+
+def beginSync(key):
+    """Mark a replica (typically by physical path) as being synced.
+
+    Returns False if it is already being synced by another thread of
+    this process.
+    """
+    _syncing_lock.acquire()
+    try:
+        if key in _syncing:
+            return False
+        _syncing.add(key)
+        return True
+    finally:
+        _syncing_lock.release()
+
+def endSync(key):
+    """Mark a replica as not being synced anymore."""
+    _syncing_lock.acquire()
+    try:
+        _syncing.discard(key)
+    finally:
+        _syncing_lock.release()
+
+def getWatermarkStart(watermark, overlap):
+    """Get the value from which to look for changed entries.
+
+    It's overlap seconds before the watermark, the latest modifyTimestamp
+    or entryCSN seen, so that changes committed late or by servers whose
+    clocks differ are not missed. Returns None if the watermark can't be
+    read.
+
+    >>> getWatermarkStart('20100131235930Z', 60)
+    '20100131235830Z'
+    >>> getWatermarkStart('20100201000010.123456Z#000000#000#000000', 60)
+    '20100131235910.000000Z#000000#000#000000'
+    >>> getWatermarkStart('garbage', 60) is None
+    True
+    """
+    try:
+        t = calendar.timegm(time.strptime(watermark[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+    start = time.strftime('%Y%m%d%H%M%S', time.gmtime(t - overlap))
+    if '#' in watermark:
+        return start + '.000000Z#000000#000#000000'
+    return start + 'Z'
+
+
+class LDAPReplica(Persistent):
+    """Copy of the LDAP entries of a directory.
+
+    base_key and scope tell which entries are replicated. source
+    identifies the settings the replica was loaded with, and attrs are
+    the replicated attributes. Values are stored as read from LDAP, with
+    the attribute names lowercased, the names used by the server being
+    kept separately.
+    """
+
+    def __init__(self, source, base_key, scope, attrs, indexed_attrs=()):
+        self.source = source
+        self.base_key = tuple(base_key)
+        self.scope = scope
+        self.attrs = tuple(attrs)
+        self._attrs = frozenset([attr.lower() for attr in attrs])
+        self._entries = OOBTree()
+        self._length = Length()
+        self._names = {}
+        self._indexes = {}
+        for attr in indexed_attrs:
+            attr = attr.lower()
+            if attr in self._attrs:
+                self._indexes[attr] = OOBTree()
+        # Status of the syncs
+        self.watermark = None
+        self.last_sync = None
+        self.last_full_sync = None
+        self.last_duration = None
+        self.last_changes = 0
+        self.last_removals = 0
+
+    def __len__(self):
+        return self._length()
+
+    def _toKey(self, change_key):
+        key = list(change_key)
+        key.reverse()
+        return tuple(key)
+
+    def _fromKey(self, key):
+        change_key = list(key)
+        change_key.reverse()
+        return tuple(change_key)
+
+    def covers(self, base_key, scope):
+        """Tell whether the results of a search are all in the replica."""
+        base_key = self._toKey(base_key)
+        root = self._toKey(self.base_key)
+        if base_key[:len(root)] != root:
+            return False
+        if self.scope == SCOPE_SUBTREE:
+            return True
+        # One level replica
+        if scope == SCOPE_BASE:
+            return len(base_key) == len(root) + 1
+        return scope == SCOPE_ONELEVEL and base_key == root
+
+    def hasAttributes(self, attrs):
+        """Tell whether some attributes are all replicated.
+
+        None, meaning all the attributes, is never replicated.
+        """
+        if attrs is None:
+            return False
+        for attr in attrs:
+            attr = attr.lower()
+            if attr not in self._attrs and attr not in _NO_ATTRS:
+                return False
+        return True
+
+    def keys(self):
+        """Get the change keys of all the entries."""
+        return [self._fromKey(key) for key in self._entries.keys()]
+
+    def getEntry(self, change_key):
+        """Get an entry, as (dn, entry), or None."""
+        value = self._entries.get(self._toKey(change_key))
+        if value is None:
+            return None
+        return self._project(value, None)
+
+    def setEntry(self, change_key, dn, ldap_entry):
+        """Store an entry as read from LDAP.
+
+        Returns whether it changed.
+        """
+        key = self._toKey(change_key)
+        names = self._names
+        values = {}
+        new_names = None
+        for name, value in ldap_entry.items():
+            attr = name.lower()
+            if attr not in self._attrs:
+                continue
+            values[attr] = list(value)
+            if names.get(attr) != name:
+                if new_names is None:
+                    new_names = names.copy()
+                new_names[attr] = name
+        if new_names is not None:
+            self._names = new_names
+        old = self._entries.get(key)
+        if old == (dn, values):
+            return False
+        if old is None:
+            self._length.change(1)
+        else:
+            self._unindex(key, old[1])
+        self._entries[key] = (dn, values)
+        self._index(key, values)
+        return True
+
+    def removeEntry(self, change_key):
+        """Remove an entry. Returns whether it was there."""
+        key = self._toKey(change_key)
+        old = self._entries.get(key)
+        if old is None:
+            return False
+        self._unindex(key, old[1])
+        del self._entries[key]
+        self._length.change(-1)
+        return True
+
+    def _getIndexKeys(self, values):
+        return set([normalizeValue(value) for value in values])
+
+    def _index(self, key, values):
+        for attr, index in self._indexes.items():
+            for value in self._getIndexKeys(values.get(attr, ())):
+                keys = index.get(value)
+                if keys is None:
+                    keys = index[value] = OOTreeSet()
+                keys.insert(key)
+
+    def _unindex(self, key, values):
+        for attr, index in self._indexes.items():
+            for value in self._getIndexKeys(values.get(attr, ())):
+                keys = index.get(value)
+                if keys is None:
+                    continue
+                keys.remove(key)
+                if not keys:
+                    del index[value]
+
+    def _project(self, value, attrs):
+        """Get an entry with the server names of the attributes.
+
+        Values are copied, as the caller may modify them.
+        """
+        dn, values = value
+        names = self._names
+        entry = {}
+        if attrs is None:
+            for attr, v in values.items():
+                entry[names.get(attr, attr)] = list(v)
+        else:
+            for attr in attrs:
+                v = values.get(attr.lower())
+                if v is not None:
+                    entry[names.get(attr.lower(), attr)] = list(v)
+        return dn, entry
+
+    def _inScope(self, key, base, scope):
+        if scope == SCOPE_BASE:
+            return key == base
+        if key[:len(base)] != base:
+            return False
+        if scope == SCOPE_ONELEVEL:
+            return len(key) == len(base) + 1
+        return True
+
+    def search(self, base_key, scope, node, attrs):
+        """Search the entries in a scope matching a filter tree.
+
+        node is a tree from ldapfilter.parseFilter, or None to match all
+        the entries. Returns a list of (dn, entry) in tree order, entries
+        only having the asked attributes.
+        """
+        base = self._toKey(base_key)
+        entries = self._entries
+        if scope == SCOPE_BASE:
+            value = entries.get(base)
+            if value is None:
+                candidates = ()
+            else:
+                candidates = [(base, value)]
+        else:
+            terms = getIndexTerms(node, self._indexes)
+            if terms is not None:
+                keys = None
+                for attr, value in terms:
+                    keys = union(keys, self._indexes[attr].get(value))
+                if keys is None:
+                    keys = ()
+                candidates = [(key, entries[key]) for key in keys
+                              if self._inScope(key, base, scope)]
+            else:
+                candidates = self._iterScope(base, scope)
+        match = compileFilter(node)
+        results = []
+        for key, value in candidates:
+            if match(value[1]):
+                results.append(self._project(value, attrs))
+        return results
+
+    def _iterScope(self, base, scope):
+        """Iterate over the (key, value) of the entries under a base."""
+        for key, value in self._entries.items(min=base):
+            if key[:len(base)] != base:
+                break
+            if scope == SCOPE_ONELEVEL and len(key) != len(base) + 1:
+                continue
+            yield key, value
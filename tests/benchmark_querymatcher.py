@@ -0,0 +1,65 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Microbenchmark of QueryMatcher, reporting the cost per entry.
+
+Not part of the test suite. Run it with the Zope instance python, e.g.:
+
+  $ bin/zopectl run Products/CPSDirectory/tests/benchmark_querymatcher.py
+"""
+
+import time
+
+from Products.CPSDirectory.utils import QueryMatcher
+
+NB_ENTRIES = 20000
+REPEAT = 3
+
+QUERIES = (
+    ('exact', {'sn': 'name500'}),
+    ('list', {'sn': ['name1', 'name2', 'name3', 'name500']}),
+    ('substring', {'givenName': u'\xe9l\xe8ne'}),
+    ('multi', {'sn': ['name1', 'name500'], 'givenName': 'hel'}),
+    ('negate', {'sn': {'query': 'name500', 'negate': True}}),
+    )
+
+def makeEntries(n):
+    return [{'sn': 'name%d' % i,
+             'givenName': u'H\xe9l\xe8ne %d' % i,
+             'groups': ['group%d' % (i % 10), 'members'],
+             } for i in xrange(n)]
+
+def bench(entries, query):
+    """Return the best time per entry, in microseconds."""
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        matcher = QueryMatcher(query, substring_keys=('givenName',))
+        matcher.filter(entries)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / len(entries)
+
+def main():
+    entries = makeEntries(NB_ENTRIES)
+    print "%d entries, best of %d" % (NB_ENTRIES, REPEAT)
+    for title, query in QUERIES:
+        print "%-10s %6.2f us/entry" % (title, bench(entries, query))
+
+if __name__ == '__main__':
+    main()
@@ -31,13 +31,16 @@ class FakeSQLConnection:
     def sql_quote__(self, value):
         return quote(value)
 
-select_re = re.compile(r'SELECT (.*) FROM ([^ ]+)(?: WHERE (.*))?')
+select_re = re.compile(r'SELECT (.*) FROM ([^ ]+)(?: WHERE (.*?))?'
+                       r'(?: ORDER BY (.*?)( DESC)?)?'
+                       r'(?: LIMIT (\d+))?(?: OFFSET (\d+))?$')
 insert_re = re.compile(r'INSERT INTO ([^ ]+) \((.*)\) VALUES \((.*)\)')
 delete_re = re.compile(r'DELETE FROM ([^ ]+) WHERE (.*)')
 update_re = re.compile(r'UPDATE ([^ ]+) SET (.*) WHERE (.*)')
 eq_re = re.compile(r'([^ ]+) = "([^"]*)"')
 set_re = eq_re
 in_re = re.compile(r'([^ ]+) IN \((.*)\)')
+cmp_re = re.compile(r'([^ ]+) (<=|>=|<|>) "([^"]*)"')
 count_re = re.compile(r'COUNT\(([^)]*)\)')
 
 def quote(v):
@@ -57,6 +60,7 @@ class FakeDBC:
     def __init__(self):
         self.columns = {}
         self.data = {}
+        self.queries = []
 
     def _createTable(self, id, columns):
         self.columns[id] = [col.upper() for col in columns]
@@ -64,10 +68,12 @@ class FakeDBC:
 
     def query(self, sql):
         #print 'query:', sql
+        self.queries.append(sql)
         m = select_re.match(sql)
         if m is not None:
-            columns, table, where = m.groups()
-            return self.doSelect(table, columns, where)
+            columns, table, where, order_by, desc, limit, offset = m.groups()
+            return self.doSelect(table, columns, where, order_by, desc,
+                                 limit, offset)
         m = insert_re.match(sql)
         if m is not None:
             table, columns, values = m.groups()
@@ -83,7 +89,8 @@ class FakeDBC:
 
         raise ValueError("Cannot parse query %r" % sql)
 
-    def doSelect(self, table, columns, where):
+    def doSelect(self, table, columns, where, order_by=None, desc=None,
+                 limit=None, offset=None):
         if table not in self.data:
             raise ValueError("No table %s" % table)
         columns, counts, orig_columns = self._parseColumns(table, columns,
@@ -92,13 +99,31 @@ class FakeDBC:
         match_info = self._parseWhere(table, where)
 
         # Filter results
-        results = []
+        lines = []
         data = self.data[table]
         for line in data:
             if self._matchLine(line, match_info):
                 # Matches !
-                res = [line[col] for col in columns]
-                results.append(tuple(res))
+                lines.append(line)
+
+        # Order and batch
+        if order_by is not None:
+            order_cols = self._parseColumns(table, order_by)
+            decorated = [([line[col] for col in order_cols], i, line)
+                         for i, line in enumerate(lines)]
+            decorated.sort()
+            lines = [line for key, i, line in decorated]
+            if desc:
+                lines.reverse()
+        if offset is not None:
+            lines = lines[int(offset):]
+        if limit is not None:
+            lines = lines[:int(limit)]
+
+        results = []
+        for line in lines:
+            res = [line[col] for col in columns]
+            results.append(tuple(res))
 
         # Counts, single column assumed
         if counts:
@@ -195,6 +220,7 @@ class FakeDBC:
         table_columns = self.columns[table]
         equalities = []
         members = []
+        comparisons = []
         if where is not None:
             for clause in where.split(' AND '):
                 clause = clause.strip()
@@ -215,10 +241,19 @@ class FakeDBC:
                     vals = [unquote(v) for v in groups[1].split(',')]
                     members.append((col, vals))
                     continue
+                m = cmp_re.match(clause)
+                if m is not None:
+                    col, op, val = m.groups()
+                    col = col.upper()
+                    if col not in table_columns:
+                        raise ValueError("No column %s" % col)
+                    comparisons.append((col, op, val))
+                    continue
                 raise ValueError("Unknown clause syntax %r" % clause)
         return {
             'equalities': equalities,
             'members': members,
+            'comparisons': comparisons,
             }
 
     def _matchLine(self, line, match_info):
@@ -231,4 +266,16 @@ class FakeDBC:
                     break
             else:
                 return False
+        for col, op, val in match_info['comparisons']:
+            value = line[col]
+            if value is None:
+                return False
+            if op == '<' and not value < val:
+                return False
+            if op == '<=' and not value <= val:
+                return False
+            if op == '>' and not value > val:
+                return False
+            if op == '>=' and not value >= val:
+                return False
         return True
@@ -20,8 +20,8 @@
 from functions import open, initialize, init, explode_dn, explode_rdn, get_option, set_option
 import ldapobject
 import filter
+import controls
 
-NO_SUCH_OBJECT = 'NO_SUCH_OBJECT'
 SIZELIMIT_EXCEEDED = 'SIZELIMIT_EXCEEDED'
 SERVER_DOWN = 'SERVER_DOWN'
 INVALID_DN_SYNTAX = 'INVALID_DN_SYNTAX'
@@ -33,11 +33,15 @@ SCOPE_BASE = 0
 SCOPE_ONELEVEL = 1
 SCOPE_SUBTREE = 2
 from fakeldap import MOD_ADD, MOD_DELETE, MOD_REPLACE
+from fakeldap import NO_SUCH_OBJECT, ALREADY_EXISTS
 OPT_REFERRALS = 8
 OPT_TIMELIMIT = 4
 OPT_SIZELIMIT = 3
 OPT_NETWORK_TIMEOUT = 20485
 OPT_PROTOCOL_VERSION = 17
+LDAP_CONTROL_PAGE_OID = controls.SimplePagedResultsControl.controlType
+RES_SEARCH_RESULT = 101
+RES_ADD = 105
 
 VERSION2 = 2
 VERSION3 = 3
@@ -0,0 +1,41 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Fake ldap.controls, with the python-ldap 2.4 API."""
+
+class LDAPControl:
+
+    controlType = None
+
+    def __init__(self, controlType=None, criticality=False,
+                 controlValue=None, encodedControlValue=None):
+        if controlType is not None:
+            self.controlType = controlType
+        self.criticality = criticality
+        self.controlValue = controlValue
+        self.encodedControlValue = encodedControlValue
+
+
+class SimplePagedResultsControl(LDAPControl):
+    """ paged results control (RFC 2696)
+    """
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality=False, size=10, cookie=''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
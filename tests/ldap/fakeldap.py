@@ -28,8 +28,19 @@
 """
 
 import sys,string
+from controls import LDAPControl
+from controls import SimplePagedResultsControl
 from os import path
 
+from Products.CPSDirectory.ldapcontrols import SORT_REQUEST_OID
+from Products.CPSDirectory.ldapcontrols import SORT_RESPONSE_OID
+from Products.CPSDirectory.ldapcontrols import VLV_REQUEST_OID
+from Products.CPSDirectory.ldapcontrols import VLV_RESPONSE_OID
+from Products.CPSDirectory.ldapcontrols import decodeSortRequest
+from Products.CPSDirectory.ldapcontrols import encodeSortResponse
+from Products.CPSDirectory.ldapcontrols import decodeVLVRequest
+from Products.CPSDirectory.ldapcontrols import encodeVLVResponse
+
 MODULE_DIR = path.dirname(__file__) + '/'
 CONF_FILE = MODULE_DIR + 'fakeldap.conf'
 
@@ -38,6 +49,16 @@ MOD_ADD = 0
 MOD_DELETE = 1
 MOD_REPLACE = 2
 
+NO_SUCH_OBJECT = 'NO_SUCH_OBJECT'
+ALREADY_EXISTS = 'ALREADY_EXISTS'
+
+# Controls advertised in the root DSE, tests may change them per server
+SUPPORTED_CONTROLS = (
+    SimplePagedResultsControl.controlType,
+    SORT_REQUEST_OID,
+    VLV_REQUEST_OID,
+    )
+
 class LogFile:
     """ a log class"""
     def __init__(self, filename=''):
@@ -70,6 +91,7 @@ class LdifReader:
 
     def __init__(self, owner, filename=''):
         self.owner = owner
+        self.supported_controls = list(SUPPORTED_CONTROLS)
 
         if filename == '':
             filename = MODULE_DIR + LDIF_FILENAME
@@ -234,6 +256,11 @@ class LdifReader:
             using empty lines it will be faster
         """
 
+        if base == '' and scope == 0:
+            # root DSE
+            entry = {'supportedControl': list(self.supported_controls)}
+            return self.project([('', entry)], attributes)
+
         content = self.ldif_content
         base = string.lower(base)
 
@@ -301,23 +328,10 @@ class LdifReader:
                     #self.vislog('found entry : %s' %str(ldif_entry))
                     filtered_entries.append(ldif_entry)
 
-        if attributes is None:
-            # insulation is for cache tests
-            return [(InsulatedString(entry['dn'][0]), entry) for entry
-                    in filtered_entries]
-
-        results = []
-        for filtered_entry in filtered_entries:
-            # adding fields
-
-            result_entry = {}
-            for attribute in attributes:
-                if filtered_entry.has_key(attribute):
-                    result_entry[attribute] = filtered_entry[attribute]
-
-            # insulation is for cache tests
-            result = (InsulatedString(filtered_entry['dn'][0]), result_entry)
-            results.append(result)
+        # insulation is for cache tests
+        results = [(InsulatedString(entry['dn'][0]), entry) for entry
+                   in filtered_entries]
+        results = self.project(results, attributes)
 
 
         #print('base %s scope %s filter %s attributes %s results %s'
@@ -325,6 +339,40 @@ class LdifReader:
 
         return results
 
+    def project(self, results, attributes):
+        """ keep only some attributes of the results """
+        if attributes is None:
+            return results
+        projected = []
+        for dn, entry in results:
+            result_entry = {}
+            for attribute in attributes:
+                if entry.has_key(attribute):
+                    result_entry[attribute] = entry[attribute]
+            projected.append((dn, result_entry))
+        return projected
+
+    def sort(self, results, keys):
+        """ sort results like the server side sort control, ignoring
+        case, entries without a value last
+        """
+        results = list(results)
+        for attr, reverse in reversed(keys):
+            def key(result):
+                values = result[1].get(attr)
+                if not values:
+                    return (1,)
+                return (0, min([v.decode('utf-8').lower() for v in values]))
+            results.sort(key=key, reverse=reverse)
+        return results
+
+# Data of the fake servers, by uri, shared by all their connections
+_servers = {}
+
+def resetServers():
+    """Forget the data of all fake servers."""
+    _servers.clear()
+
 class FakeLdap:
     """
         implements part of python-ldap
@@ -334,7 +382,7 @@ class FakeLdap:
     """
     options = {}
 
-    def __init__(self):
+    def __init__(self, uri='fake'):
         conffile = open(CONF_FILE, 'r')
         try:
             lines = conffile.readlines()
@@ -345,11 +393,17 @@ class FakeLdap:
         finally:
             conffile.close()
 
-        self.dif_reader = LdifReader(self, filename)
+        dif_reader = _servers.get(uri)
+        if dif_reader is None:
+            dif_reader = _servers[uri] = LdifReader(self, filename)
+        self.dif_reader = dif_reader
+        self.pending = {}
         self.logger = LogFile(logfilename)
 
 
     def delete_s(self,dn):
+        if self.dif_reader._findEntry(dn) is None:
+            raise NO_SUCH_OBJECT
         self.dif_reader.deleteEntry(dn)
 
 
@@ -357,6 +411,8 @@ class FakeLdap:
         """ adds an entry
         """
         self.ldap_logcall('add_ds')
+        if self.dif_reader._findEntry(dn) is not None:
+            raise ALREADY_EXISTS
         entry = ['dn: '+ dn ]
         for attribute in attrs_list:
             line = attribute[0]+': '
@@ -389,7 +445,14 @@ class FakeLdap:
         self.ldap_logcall('simple_bind_s')
 
     def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        """ asynchronous add, errors are raised when result is called
+        """
         self.ldap_logcall('add_ext')
+        try:
+            self.add_s(dn, modlist)
+        except ALREADY_EXISTS:
+            return self._queue(105, [], error=ALREADY_EXISTS)
+        return self._queue(105, [])
 
     def bind(self, who, cred,method):
         self.ldap_logcall('bind')
@@ -415,10 +478,70 @@ class FakeLdap:
 
     def result(self, msgid=0, all=1, timeout=None):
         self.ldap_logcall('result')
+        rtype, results, msgid, resp_ctrls = self.result3(msgid)
+        return rtype, results
 
     def search_ext(self, base, scope, filterstr='(objectClass=*)',attrlist=None,
        attrsonly=0,serverctrls=None,clientctrls=None,timeout=-1,sizelimit=0):
+        """ asynchronous search, results are kept until result3 is called
+        the paged results control cookie is the index of the next result
+        """
         self.ldap_logcall('search_ext')
+        reader = self.dif_reader
+        results = reader.search(base, scope, filterstr, None)
+        ctrls = {}
+        for ctrl in serverctrls or ():
+            # unsupported controls are ignored, as they aren't critical
+            if ctrl.controlType in reader.supported_controls:
+                ctrls[ctrl.controlType] = ctrl
+        resp_ctrls = []
+        ctrl = ctrls.get(SORT_REQUEST_OID)
+        if ctrl is not None:
+            keys = decodeSortRequest(ctrl.encodedControlValue)
+            results = reader.sort(results, keys)
+            resp_ctrls.append(LDAPControl(SORT_RESPONSE_OID, False, None,
+                                          encodeSortResponse(0)))
+        ctrl = ctrls.get(VLV_REQUEST_OID)
+        if ctrl is not None:
+            before, after, offset, count, context = decodeVLVRequest(
+                ctrl.encodedControlValue)
+            total = len(results)
+            if count:
+                offset = offset * total / count
+            start = max(0, offset - 1 - before)
+            results = results[start:offset+after]
+            value = encodeVLVResponse(offset, total, 0)
+            resp_ctrls.append(LDAPControl(VLV_RESPONSE_OID, False, None,
+                                          value))
+        ctrl = ctrls.get(SimplePagedResultsControl.controlType)
+        if ctrl is not None:
+            start = int(ctrl.cookie or 0)
+            end = start + ctrl.size
+            if ctrl.size and end < len(results):
+                cookie = str(end)
+            else:
+                cookie = ''
+            total = len(results)
+            results = results[start:end]
+            resp_ctrls.append(SimplePagedResultsControl(size=total,
+                                                        cookie=cookie))
+        results = reader.project(results, attrlist)
+        return self._queue(101, results, resp_ctrls)
+
+    def _queue(self, rtype, results, resp_ctrls=(), error=None):
+        """ keep the results of an asynchronous operation """
+        msgid = len(self.pending) + 1
+        while self.pending.has_key(msgid):
+            msgid += 1
+        self.pending[msgid] = (rtype, results, list(resp_ctrls), error)
+        return msgid
+
+    def result3(self, msgid=-1, all=1, timeout=None, resp_ctrl_classes=None):
+        self.ldap_logcall('result3')
+        rtype, results, resp_ctrls, error = self.pending.pop(msgid)
+        if error is not None:
+            raise error
+        return rtype, results, msgid, resp_ctrls
 
     def set_cache_options(self, *args, **kwargs):
         self.ldap_logcall('set_cache_options')
@@ -432,6 +555,9 @@ class FakeLdap:
     def unbind_ext(self, serverctrls=None, clientctrls=None):
         self.ldap_logcall('unbind_ext')
 
+    def unbind_s(self):
+        self.ldap_logcall('unbind_s')
+
     def get_option(self, option):
         if self.options.has_key(option):
             return options[option]
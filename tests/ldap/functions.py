@@ -31,7 +31,7 @@ import fakeldap
 ob_pt = None
 
 def initialize(uri,trace_level=0,trace_file=sys.stdout,trace_stack_limit=None):
-  ob = fakeldap.FakeLdap()
+  ob = fakeldap.FakeLdap(uri)
   ob_pt = ob
   return ob
 
@@ -150,6 +150,13 @@ class TestDirectoryVocabulary(ZopeTestCase):
             self.assert_((k, v) in items + [('', 'empty')])
         self.assertEquals(dvoc.items()[0], ('', 'empty'))
 
+    def test_sortedItems(self):
+        dvoc = self.dvoc
+        dvoc.add_empty_key = True
+        self.assertEquals(dvoc.sortedItems(prefix='TOTO', start=1, limit=1),
+                          [('toto2', 'toto2_val')])
+        self.assertEquals(dvoc.sortedItems(prefix='titi'), [])
+
     def test_values(self):
         dvoc = self.dvoc
         values = self.data.values()
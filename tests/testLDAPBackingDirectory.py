@@ -19,6 +19,9 @@
 # $Id$
 
 import os, sys
+import time
+import shutil
+import tempfile
 
 if __name__ == '__main__':
     execfile(os.path.join(sys.path[0], 'framework.py'))
@@ -42,8 +45,34 @@ from Products.CPSDirectory.tests.fakeCps import FakeMembershipTool
 from Products.CPSDirectory.tests.fakeCps import FakeUserFolder
 from Products.CPSDirectory.tests.fakeCps import FakeDirectoryTool
 from Products.CPSDirectory.tests.fakeCps import FakeRoot
+from Products.CPSDirectory.tests.ldap.fakeldap import resetServers
+from Products.CPSDirectory.ldappool import clearPools
+from Products.CPSDirectory.changefeed import stopChangeListeners
 
-class TestLDAPbackingDirectory(ZopeTestCase):
+
+def waitFor(condition, timeout=10.0):
+    # Wait for the change feed listener thread
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("Timeout")
+        time.sleep(0.05)
+
+
+class LDAPTestCase(ZopeTestCase):
+    # Each test starts with empty fake servers and no pooled connections
+
+    def beforeSetUp(self):
+        resetServers()
+        clearPools()
+
+    def afterClear(self):
+        stopChangeListeners()
+        clearPools()
+        resetServers()
+
+
+class TestLDAPbackingDirectory(LDAPTestCase):
 
     def afterSetUp(self):
         ZopeTestCase.afterSetUp(self)
@@ -223,7 +252,11 @@ class TestLDAPbackingDirectory(ZopeTestCase):
         # We'll need to go low level to retrieve what has been written
         def readPwd():
             conn = ldir.connectLDAP()
-            res = conn.search_s(dn, 0, '(objectClass=person)', ['userPassword'])
+            try:
+                res = conn.search_s(dn, 0, '(objectClass=person)',
+                                    ['userPassword'])
+            finally:
+                ldir.releaseLDAP(conn)
             # correctness of ldap call
             self.assertEquals(len(res), 1)
             self.assertEquals(res[0][0], dn)
@@ -262,6 +295,451 @@ class TestLDAPbackingDirectory(ZopeTestCase):
         entry = ldir.getEntry(dn)
         self.assertEquals(entry['userPassword'], '')
 
+    def testExistenceCache(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        dir = self.dir
+        dn = 'uid=chat,ou=personnes,o=nuxeo,c=com'
+
+        probes = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, *args, **kw):
+            if base == dn:
+                probes.append(base)
+            return search_s(conn, base, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            # no caching by default
+            self.failIf(dir._hasEntry(dn))
+            self.failIf(dir._hasEntry(dn))
+            self.assertEquals(len(probes), 2)
+
+            dir.manage_changeProperties(ldap_exists_cache_ttl=60,
+                                        ldap_missing_cache_ttl=60)
+            del probes[:]
+            self.failIf(dir._hasEntry(dn))
+            self.failIf(dir._hasEntry(dn))
+            self.assertRaises(KeyError, dir._getEntry, dn)
+            self.assertEquals(len(probes), 1)
+
+            # local writes update the cache
+            dir._createEntry({'dn': dn, 'cn': 'chat'})
+            self.assert_(dir._hasEntry(dn))
+            dir._deleteEntry(dn)
+            self.failIf(dir._hasEntry(dn))
+            self.assertEquals(len(probes), 1)
+            stats = dir.getCacheStatistics()
+            self.assertEquals(stats['hits'], 2)
+            self.assertEquals(stats['negative_hits'], 4)
+
+            # only missing entries are cached
+            dir.manage_changeProperties(ldap_exists_cache_ttl=0)
+            dir._createEntry({'dn': dn, 'cn': 'chat'})
+            del probes[:]
+            self.assert_(dir._hasEntry(dn))
+            self.assert_(dir._hasEntry(dn))
+            self.assertEquals(len(probes), 2)
+        finally:
+            FakeLdap.search_s = search_s
+
+    def testLazyFields(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        from Products.CPSDirectory.utils import LazyValue
+        dir = self.dir
+        dn = 'uid=chat,ou=personnes,o=nuxeo,c=com'
+        dir._createEntry({'dn': dn, 'cn': 'chat', 'foo': 'miaou'})
+        dir.manage_changeProperties(ldap_lazy_fields=['foo'])
+
+        searches = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, scope, filter, attrs=None, *args, **kw):
+            searches.append(attrs)
+            return search_s(conn, base, scope, filter, attrs, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            entry = dir._getEntry(dn)
+            value = entry['foo']
+            self.assert_(isinstance(value, LazyValue))
+            self.failIf(value.isLoaded())
+            self.failIf([attrs for attrs in searches
+                         if attrs and 'foo' in attrs])
+            # read when used
+            del searches[:]
+            self.assertEquals(value, 'miaou')
+            self.assertEquals(searches, [['foo']])
+
+            del searches[:]
+            res = dir._searchEntries(cn='chat', return_fields=['*'])
+            self.assertEquals(len(res), 1)
+            self.failIf(res[0][1]['foo'].isLoaded())
+            self.failIf([attrs for attrs in searches
+                         if attrs and 'foo' in attrs])
+
+            # unchanged lazy fields are kept
+            dir._editEntry({'dn': dn, 'cn': 'chaton', 'foo': res[0][1]['foo']})
+        finally:
+            FakeLdap.search_s = search_s
+        dir.manage_changeProperties(ldap_lazy_fields=[])
+        entry = dir._getEntry(dn)
+        self.assertEquals(entry['cn'], 'chaton')
+        self.assertEquals(entry['foo'], 'miaou')
+
+    def testChangeFeed(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        from Products.CPSDirectory.changefeed import getChangeListener
+        from Products.CPSDirectory.thumbnails import getThumbnailCache
+        from Products.CPSDirectory.tests import ldap
+        dir = self.dir
+        dtool = self.portal.portal_directories
+        # REQUEST is necessary for ZCacheable methods.
+        dir.REQUEST = dtool.REQUEST = self.app.REQUEST
+        dtool._setObject('cache_manager', RAMCacheManager('cache_manager'))
+        dir.ZCacheable_setManagerId('cache_manager')
+
+        dn1 = 'uid=tree,ou=personnes,o=nuxeo,c=com'
+        dn2 = 'uid=sea,ou=personnes,o=nuxeo,c=com'
+        dir._createEntry({'dn': dn1, 'cn': 'tree', 'foo': 'green'})
+        dir._createEntry({'dn': dn2, 'cn': 'sea', 'foo': 'blue'})
+
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'audit.ldif')
+        open(path, 'w').close()
+        searches = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, scope, *args, **kw):
+            searches.append((base, scope))
+            return search_s(conn, base, scope, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            dir.manage_changeProperties(ldap_change_feed='log',
+                                        ldap_change_log=path)
+            # the first search starts the listener
+            dir.searchEntries(foo='green')
+            listener = getChangeListener(dir.getPhysicalPath())
+            waitFor(lambda: listener.connected)
+
+            self.assertEquals(dir.searchEntries(foo='green'), [dn1])
+            self.assertEquals(dir._getEntry(dn2)['foo'], 'blue')
+            dir.manage_resetCacheStatistics()
+            del searches[:]
+            self.assertEquals(dir.searchEntries(foo='green'), [dn1])
+            self.assertEquals(dir._getEntry(dn2)['foo'], 'blue')
+            self.assertEquals(searches, [])
+
+            # an entry changed by another application
+            thumbnail_key = ('/'.join(dir.getPhysicalPath()),
+                             dir._getThumbnailEntryId(dn1), 'foo', 48, 'd')
+            getThumbnailCache().set(thumbnail_key, 'thumb')
+            f = open(path, 'a')
+            f.write('dn: %s\nchangetype: modify\nreplace: foo\n'
+                    'foo: yellow\n-\n\n' % dn1)
+            f.close()
+            waitFor(lambda: listener.changes == 1)
+            # its thumbnails are removed
+            waitFor(lambda: getThumbnailCache().get(thumbnail_key) is None)
+            # only the searches whose scope contains it are evicted
+            self.assertEquals(dir._getEntry(dn2)['foo'], 'blue')
+            self.assertEquals(searches, [])
+            self.assertEquals(dir.searchEntries(foo='green'), [dn1])
+            self.assertEquals(searches, [('ou=personnes,o=nuxeo,c=com',
+                                          ldap.SCOPE_SUBTREE)])
+            stats = dir.getChangeFeedStatistics()
+            self.assert_(stats['running'])
+            self.assertEquals(stats['changes'], 1)
+            self.assertEquals(stats['evictions'], 1)
+
+            # without change feed, the listener is stopped
+            dir.manage_changeProperties(ldap_change_feed='')
+            dir.searchEntries(foo='green')
+            self.failIf(dir.getChangeFeedStatistics()['running'])
+        finally:
+            FakeLdap.search_s = search_s
+            shutil.rmtree(tmpdir)
+
+    def testReplica(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        from Products.CPSDirectory.tests import ldap
+        dir = self.dir
+        base = 'ou=personnes,o=nuxeo,c=com'
+        dn1 = 'uid=tree,ou=personnes,o=nuxeo,c=com'
+        dn2 = 'uid=sea,ou=personnes,o=nuxeo,c=com'
+        dn3 = 'uid=sky,ou=personnes,o=nuxeo,c=com'
+        dir._createEntry({'dn': dn1, 'cn': 'tree', 'foo': 'green'})
+        dir._createEntry({'dn': dn2, 'cn': 'sea', 'foo': 'blue'})
+
+        dir.manage_changeProperties(ldap_replica=True,
+                                    ldap_replica_sync_interval=0,
+                                    ldap_replica_indexed_attrs=['foo'])
+        # not loaded yet
+        self.failIf(dir.getReplicaStatus()['usable'])
+        self.assertEquals(dir.syncReplica(), (2, 0))
+        status = dir.getReplicaStatus()
+        self.assert_(status['usable'])
+        self.assertEquals(status['entries'], 2)
+        self.assert_(status['lag'] >= 0)
+
+        searches = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, scope, *args, **kw):
+            searches.append((base, scope))
+            return search_s(conn, base, scope, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            # reads are served by the replica
+            self.assertEquals(dir.searchEntries(foo='green'), [dn1])
+            self.assertEquals(dir._getEntry(dn2)['foo'], 'blue')
+            self.assert_(dir._hasEntry(dn1))
+            self.failIf(dir._hasEntry('uid=nobody,ou=personnes,o=nuxeo,c=com'))
+            self.assertEquals(searches, [])
+            # but not the searches on attributes that aren't replicated
+            dir.searchLDAP(base, ldap.SCOPE_SUBTREE, '(objectClass=person)',
+                           ['sn'])
+            self.assertEquals(searches, [(base, ldap.SCOPE_SUBTREE)])
+
+            # writes go to LDAP, and update the replica
+            dir._createEntry({'dn': dn3, 'cn': 'sky', 'foo': 'blue'})
+            dir._editEntry({'dn': dn1, 'foo': 'yellow'})
+            del searches[:]
+            self.assertEquals(sorted(dir.searchEntries(foo='blue')),
+                              [dn2, dn3])
+            self.assertEquals(dir.searchEntries(foo='green'), [])
+            self.assertEquals(dir._getEntry(dn1)['foo'], 'yellow')
+            self.assertEquals(searches, [])
+            dir._deleteEntry(dn3)
+            self.assertEquals(dir.searchEntries(foo='blue'), [dn2])
+            self.assertEquals(dir.getReplicaStatus()['entries'], 2)
+
+            # changes made by other applications are seen after a sync
+            conn = dir.connectLDAP()
+            conn.modify_s(dn2, [(ldap.MOD_REPLACE, 'foo', ['red'])])
+            conn.delete_s(dn1)
+            dir.releaseLDAP(conn)
+            self.assertEquals(dir.searchEntries(foo='red'), [])
+            self.assertEquals(dir.syncReplica(), (1, 1))
+            self.assertEquals(dir.searchEntries(foo='red'), [dn2])
+            self.failIf(dir._hasEntry(dn1))
+        finally:
+            FakeLdap.search_s = search_s
+
+        dir.manage_changeProperties(ldap_replica=False)
+        self.failIf(dir.getReplicaStatus()['enabled'])
+        self.assertEquals(dir.getReplicaStatus()['entries'], 0)
+
+        # reads don't load the replica, they go to LDAP until a sync
+        dir.manage_changeProperties(ldap_replica=True)
+        self.assertEquals(dir.searchEntries(foo='red'), [dn2])
+        self.failIf(dir.getReplicaStatus()['loaded'])
+        self.assertEquals(dir.syncReplica(), (1, 0))
+        self.assert_(dir.getReplicaStatus()['usable'])
+
+        # nor sync it when it is too old
+        dir._replica.last_sync -= 120
+        last_sync = dir._replica.last_sync
+        dir.manage_changeProperties(ldap_replica_sync_interval=60)
+        conn = dir.connectLDAP()
+        conn.modify_s(dn2, [(ldap.MOD_REPLACE, 'foo', ['white'])])
+        dir.releaseLDAP(conn)
+        self.assertEquals(dir.searchEntries(foo='white'), [dn2])
+        self.assertEquals(dir._replica.last_sync, last_sync)
+        status = dir.getReplicaStatus()
+        self.assert_(status['loaded'])
+        self.failIf(status['usable'])
+
+    def testBuildFilter(self):
+        dir = self.dir
+        dir.search_substring_fields = ['cn']
+        self.assertEquals(dir._buildFilter({}), '(objectClass=person)')
+        self.assertEquals(dir._buildFilter({'cn': 'a*', 'foo': 'b',
+                                            'zblurg': 'c', 'dn': 'd'}),
+                          '(&(objectClass=person)(cn=*a\\2a*)(foo=b))')
+        self.assertEquals(dir._buildFilter({'bar': ['x', '', 'y)'],
+                                            'bl': True, 'foo': '*'}),
+                          '(&(objectClass=person)(|(bar=x)(bar=y\\29))'
+                          '(bl=TRUE)(foo=*))')
+        self.assertEquals(dir._buildFilter({'bar': ['x'], 'cn': ''}),
+                          '(&(objectClass=person)(bar=x))')
+        self.assertRaises(ValueError, dir._buildFilter, {'foo': {}})
+
+        # the search filter is taken into account
+        dir.manage_changeProperties(ldap_search_filter='uid=%s*')
+        self.assertEquals(dir.searchFilter(),
+                          '(&(objectClass=person)(uid=%s*))')
+        self.assertEquals(dir._buildFilter({'foo': 'b'}),
+                          '(&(&(objectClass=person)(uid=%s*))(foo=b))')
+
+    def testExplainFilter(self):
+        dir = self.dir
+        dir.search_substring_fields = []
+        res = dir.explainFilter(foo='b')
+        self.assertEquals(res['filter'], '(&(objectClass=person)(foo=b))')
+        self.assertEquals(res['shape'], (('foo', ('str',), False),))
+        self.failIf(res['cached'])
+        # same shape, other value
+        res = dir.explainFilter(foo='c')
+        self.assertEquals(res['filter'], '(&(objectClass=person)(foo=c))')
+        self.assert_(res['cached'])
+        self.assertEquals(res['statistics']['hits'], 1)
+        # substring search doesn't share the compiled filter
+        dir.search_substring_fields = ['foo']
+        res = dir.explainFilter(foo='c')
+        self.assertEquals(res['filter'], '(&(objectClass=person)(foo=*c*))')
+        self.failIf(res['cached'])
+        # changing the directory drops the compiled filters
+        dir.manage_changeProperties(ldap_search_classes='person, group')
+        res = dir.explainFilter(foo='c')
+        self.failIf(res['cached'])
+        self.assertEquals(res['filter'], '(&(|(objectClass=person)'
+                          '(objectClass=group))(foo=*c*))')
+
+    def testConvertDataFromLDAP(self):
+        dir = self.dir
+        dn = 'uid=me,ou=personnes,o=nuxeo,c=com'
+        ldap_entry = {'cn': ['chien'], 'bar': ['a', 'b'], 'objectClass': ['x'],
+                      'userPassword': ['secret'], 'dn': ['ignored']}
+        self.assertEquals(dir.convertDataFromLDAP(dn, ldap_entry),
+                          {'dn': dn, 'cn': 'chien', 'bar': ['a', 'b']})
+        converters = dir._getLDAPConverters()
+        self.failIf('dn' in converters)
+        self.failIf('userPassword' in converters)
+        self.assertEquals(dir.convertDataFromLDAP(dn, {'foo': ['grr']},
+                                                  converters),
+                          {'dn': dn, 'foo': 'grr'})
+
+        # schemas are resolved once per search, not for each entry
+        for i in range(5):
+            dir._createEntry({'dn': 'uid=%s,ou=personnes,o=nuxeo,c=com' % i,
+                              'cn': 'cn%s' % i})
+        calls = []
+        getUniqueSchema = dir._getUniqueSchema
+        def spy(*args, **kw):
+            calls.append(args)
+            return getUniqueSchema(*args, **kw)
+        dir._getUniqueSchema = spy
+        try:
+            res = dir._searchEntries(cn='cn0', return_fields=['cn'])
+            self.assertEquals(len(res), 1)
+            ncalls = len(calls)
+            del calls[:]
+            res = dir._searchEntries(return_fields=['cn'])
+            self.assertEquals(len(res), 5)
+            self.assertEquals(len(calls), ncalls)
+        finally:
+            del dir._getUniqueSchema
+
+    def testOptimisticWrites(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        dir = self.dir
+        dir.manage_changeProperties(ldap_optimistic_writes=True)
+        dn = 'uid=chien,ou=personnes,o=nuxeo,c=com'
+        entry = {'dn': dn, 'cn': 'chien', 'foo': 'ouah'}
+
+        searches = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, *args, **kw):
+            if base == dn:
+                searches.append(base)
+            return search_s(conn, base, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            dir.createEntry(entry)
+            self.assertRaises(KeyError, dir.createEntry, entry)
+            dir.deleteEntry(dn)
+            self.assertRaises(KeyError, dir.deleteEntry, dn)
+            self.assertRaises(KeyError, dir.deleteEntry,
+                              'uid=chien,ou=autres,o=nuxeo,c=com')
+        finally:
+            FakeLdap.search_s = search_s
+        # existence was never checked
+        self.assertEquals(searches, [])
+        self.assertEquals(dir.listEntryIds(), [])
+
+    def testCreateEntries(self):
+        dir = self.dir
+        base = 'ou=personnes,o=nuxeo,c=com'
+        entries = [{'dn': 'uid=%s,%s' % (i, base), 'cn': str(i)}
+                   for i in range(5)]
+        dns = dir.createEntries(entries)
+        self.assertEquals(dns, [entry['dn'] for entry in entries])
+        self.assertEquals(sorted(dir.listEntryIds()), dns)
+        self.assertEquals(dir.getEntry(dns[3])['cn'], '3')
+
+        # existing entries are checked before any addition
+        new = {'dn': 'uid=new,' + base, 'cn': 'new'}
+        self.assertRaises(KeyError, dir.createEntries, [new, entries[0]])
+        self.failIf(dir.hasEntry(new['dn']))
+
+        # or reported after the additions in optimistic mode
+        dir.manage_changeProperties(ldap_optimistic_writes=True)
+        self.assertRaises(KeyError, dir.createEntries, [entries[0], new])
+        self.assert_(dir.hasEntry(new['dn']))
+
+    def testModifyLDAP(self):
+        from Products.CPSDirectory.tests.ldap.fakeldap import FakeLdap
+        ldir = self.dir
+        dn = 'uid=me,ou=personnes,o=nuxeo,c=com'
+        ldir._createEntry({'dn': dn, 'cn': 'me', 'foo': 'grr', 'bar': ['x']})
+
+        searches = []
+        search_s = FakeLdap.search_s
+        def spy(conn, base, *args, **kw):
+            if base == dn:
+                searches.append(base)
+            return search_s(conn, base, *args, **kw)
+        FakeLdap.search_s = spy
+        try:
+            # known values are not read again
+            ldir.modifyLDAP(dn, {'foo': ['ouah'], 'bar': ['']},
+                            current={'foo': ['grr'], 'bar': ['x']})
+            self.assertEquals(searches, [])
+            entry = ldir.getEntry(dn)
+            self.assertEquals(entry['foo'], 'ouah')
+            self.assertEquals(entry['bar'], [])
+            # absent attributes are added
+            ldir.modifyLDAP(dn, {'bar': ['y']}, current={'bar': None})
+            self.assertEquals(ldir.getEntry(dn)['bar'], ['y'])
+            self.assertRaises(ValueError, ldir.modifyLDAP, dn,
+                              {'uid': ['other']}, current={'uid': ['me']})
+
+            # unknown values are read first
+            del searches[:]
+            ldir.modifyLDAP(dn, {'foo': ['ouah'], 'bar': ['z']})
+            self.assertEquals(searches, [dn])
+            self.assertEquals(ldir.getEntry(dn)['bar'], ['z'])
+
+            # edition reuses the values read by the datamodel
+            del searches[:]
+            ldir._editEntry({'dn': dn, 'foo': 'miaou', 'bar': []})
+            self.assertEquals(len(searches), 1)
+        finally:
+            FakeLdap.search_s = search_s
+        entry = ldir.getEntry(dn)
+        self.assertEquals(entry['foo'], 'miaou')
+        self.assertEquals(entry['bar'], [])
+
+    def testModifyLDAP_cachedValues(self):
+        from Products.CPSDirectory.tests import ldap
+        ldir = self.dir
+        dtool = self.portal.portal_directories
+        # REQUEST is necessary for ZCacheable methods.
+        ldir.REQUEST = dtool.REQUEST = self.app.REQUEST
+        dtool._setObject('cache_manager', RAMCacheManager('cache_manager'))
+        ldir.ZCacheable_setManagerId('cache_manager')
+        dn = 'uid=me,ou=personnes,o=nuxeo,c=com'
+        ldir._createEntry({'dn': dn, 'cn': 'me', 'foo': 'grr'})
+        self.assertEquals(ldir._getEntry(dn)['foo'], 'grr')
+
+        # changed by another application, the cache doesn't know it
+        conn = ldir.connectLDAP()
+        conn.modify_s(dn, [(ldap.MOD_REPLACE, 'foo', ['ouah'])])
+        ldir.releaseLDAP(conn)
+        self.assertEquals(ldir._getEntry(dn)['foo'], 'grr')
+
+        # setting back the cached value still changes LDAP
+        ldir._editEntry({'dn': dn, 'foo': 'grr'})
+        conn = ldir.connectLDAP()
+        res = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)', ['foo'])
+        ldir.releaseLDAP(conn)
+        self.assertEquals(res[0][1]['foo'], ['grr'])
+
     def testSearch(self):
         dir = self.dir
 
@@ -541,8 +1019,223 @@ class TestLDAPbackingDirectory(ZopeTestCase):
         self.assertEquals(zdir.searchEntries(id=id1), [dn1])
         self.assertEquals(len(getCacheReport()), 1)
 
+    def testConnectionPool(self):
+        from Products.CPSDirectory.LDAPBackingDirectory import \
+                                                    LDAPBackingDirectory
+        dtool = self.portal.portal_directories
+        other = LDAPBackingDirectory('others',
+            schema='testldapbd',
+            schema_search='testldapbd',
+            title_field='cn',
+            ldap_server_access='ldap_server_access',
+            ldap_base='ou=personnes,o=nuxeo,c=com',
+            ldap_search_classes='person',
+            )
+        dtool._setObject(other.getId(), other)
+        other = dtool.others
+        access = dtool.ldap_server_access
+        self.assertEquals(access.getConnectionPoolStatistics(), None)
+
+        dn = 'uid=tree,ou=personnes,o=nuxeo,c=com'
+        self.dir._createEntry({'dn': dn, 'foo': 'green', 'cn': 'tree'})
+        # both directories see the same server through the same connection
+        self.assertEquals(other._searchEntries(), [dn])
+        self.assert_(self.dir._hasEntry(dn))
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['created'], 1)
+        self.assertEquals(stats['size'], 1)
+        self.assertEquals(stats['idle'], 1)
+        self.assertEquals(stats['in_use'], 0)
+
+        # a borrowed connection isn't shared
+        conn = self.dir.connectLDAP()
+        self.assertEquals(other._searchEntries(), [dn])
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['created'], 2)
+        self.assertEquals(stats['in_use'], 1)
+        self.dir.releaseLDAP(conn)
+
+        # binds as a user use their own pool
+        self.assertEquals(access.getConnectionPoolStatistics(auth=True), None)
+        conn = self.dir.connectLDAP(dn, 'secret')
+        self.dir.releaseLDAP(conn)
+        conn = self.dir.connectLDAP(dn, 'secret')
+        self.dir.releaseLDAP(conn)
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['size'], 2)
+        self.assertEquals(stats['idle'], 2)
+        stats = access.getConnectionPoolStatistics(auth=True)
+        self.assertEquals(stats['created'], 1)
+        self.assertEquals(stats['reused'], 1)
+        self.assertEquals(stats['idle'], 1)
+
+        # other connection options use another pool
+        other.manage_changeProperties(ldap_timeout=5.0)
+        self.assertEquals(other._searchEntries(), [dn])
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['created'], 3)
+        self.assertEquals(stats['size'], 3)
+        conn = other.connectLDAP()
+        self.assertEquals(conn.timeout, 5.0)
+        other.releaseLDAP(conn)
+        conn = self.dir.connectLDAP()
+        self.failIf(getattr(conn, 'timeout', -1) == 5.0)
+        self.dir.releaseLDAP(conn)
+
+        # other credentials use another pool
+        access.manage_changeProperties(bind_dn='cn=other,o=nuxeo,c=com')
+        self.assertEquals(access.getConnectionPoolStatistics(), None)
+        self.assertEquals(other._searchEntries(), [dn])
+        self.assertEquals(access.getConnectionPoolStatistics()['created'], 1)
+        self.dir._hasEntry(dn)
+        self.assertEquals(access.getConnectionPoolStatistics()['created'], 2)
+
+        access.manage_resetConnectionPool()
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['size'], 0)
+        self.assertEquals(stats['created'], 0)
+
+    def testPagedSearch(self):
+        from Products.CPSDirectory.LDAPBackingDirectory import searchPage
+        from Products.CPSDirectory.tests import ldap
+        dir = self.dir
+        dns = ['uid=%s,ou=personnes,o=nuxeo,c=com' % i for i in range(5)]
+        for dn in dns:
+            dir._createEntry({'dn': dn, 'cn': dn[4]})
+        base = dir.ldap_base
+        filter = '(objectClass=person)'
 
-class TestLDAPbackingDirectoryHierarchical(ZopeTestCase):
+        conn = dir.connectLDAP()
+        try:
+            res, cookie = searchPage(conn, base, ldap.SCOPE_SUBTREE,
+                                     filter, ['dn'], 2)
+            self.assertEquals([dn for dn, e in res], dns[:2])
+            self.assert_(cookie)
+            res, cookie = searchPage(conn, base, ldap.SCOPE_SUBTREE,
+                                     filter, ['dn'], 4, cookie)
+            self.assertEquals([dn for dn, e in res], dns[2:])
+            self.assertEquals(cookie, '')
+        finally:
+            dir.releaseLDAP(conn)
+
+        dir.manage_changeProperties(ldap_page_size=2)
+        self.assertEquals(sorted(dir.listEntryIds()), dns)
+        it = dir.iterSearchLDAP(base, ldap.SCOPE_SUBTREE, filter, ['dn'])
+        self.assertEquals([dn for dn, e in it], dns)
+        # the connection is given back when the iterator is exhausted
+        # or closed
+        access = self.pd.ldap_server_access
+        it = dir.iterSearchLDAP(base, ldap.SCOPE_SUBTREE, filter, ['dn'])
+        self.assertEquals(it.next()[0], dns[0])
+        self.assertEquals(access.getConnectionPoolStatistics()['in_use'], 1)
+        it.close()
+        self.assertEquals(access.getConnectionPoolStatistics()['in_use'], 0)
+        self.assertEquals(list(it), [])
+        # iterators dropped without being closed leave their connection
+        # for the next borrower to close
+        discarded = access.getConnectionPoolStatistics()['discarded']
+        it = dir.iterSearchLDAP(base, ldap.SCOPE_SUBTREE, filter, ['dn'])
+        it.next()
+        del it
+        self.assertEquals(sorted(dir.listEntryIds()), dns)
+        stats = access.getConnectionPoolStatistics()
+        self.assertEquals(stats['in_use'], 0)
+        self.assertEquals(stats['discarded'], discarded + 1)
+
+        # without paging
+        dir.manage_changeProperties(ldap_page_size=0)
+        self.assertEquals(sorted(dir.listEntryIds()), dns)
+        it = dir.iterSearchLDAP(base, ldap.SCOPE_SUBTREE, filter, ['dn'])
+        self.assertEquals([dn for dn, e in it], dns)
+
+    def testIterSearchEntries(self):
+        dir = self.dir
+        dns = ['uid=%s,ou=personnes,o=nuxeo,c=com' % i for i in range(5)]
+        for i, dn in enumerate(dns):
+            dir._createEntry({'dn': dn, 'cn': 'cn%s' % (i % 2)})
+        access = self.pd.ldap_server_access
+
+        it = dir.iterSearchEntries(batch_size=2)
+        self.assertEquals(it.next(), dns[0])
+        self.assertEquals(access.getConnectionPoolStatistics()['in_use'], 1)
+        self.assertEquals(list(it), dns[1:])
+        self.assertEquals(access.getConnectionPoolStatistics()['in_use'], 0)
+        for return_fields in (None, ['cn']):
+            it = dir.iterSearchEntries(return_fields=return_fields,
+                                       batch_size=2)
+            it.next()
+            self.assertEquals(
+                access.getConnectionPoolStatistics()['in_use'], 1)
+            it.close()
+            self.assertEquals(
+                access.getConnectionPoolStatistics()['in_use'], 0)
+
+        self.assertEquals(list(dir.iterSearchEntries(cn='cn1', batch_size=2)),
+                          [dns[1], dns[3]])
+        res = list(dir.iterSearchEntries(cn='cn0', return_fields=['cn'],
+                                         batch_size=2))
+        self.assertEquals(res, dir.searchEntries(cn='cn0',
+                                                 return_fields=['cn']))
+        self.assertEquals([id for id, entry in res],
+                          [dns[0], dns[2], dns[4]])
+
+    def testQueryOptions(self):
+        from Products.CPSDirectory.interfaces import IBatchable
+        from Products.CPSDirectory.interfaces import IOrderable
+        from Products.CPSDirectory.ldappool import clearPools
+        from Products.CPSDirectory.tests.ldap import fakeldap
+        dir = self.dir
+        self.assert_(IBatchable.providedBy(dir))
+        self.assert_(IOrderable.providedBy(dir))
+        base = 'ou=personnes,o=nuxeo,c=com'
+        dn_tree = 'uid=tree,' + base
+        dn_sea = 'uid=sea,' + base
+        dn_fire = 'uid=fire,' + base
+        dn_night = 'uid=night,' + base
+        dir.createEntry({'dn': dn_tree, 'cn': 'x', 'foo': 'green'})
+        dir.createEntry({'dn': dn_sea, 'cn': 'x', 'foo': 'Blue'})
+        dir.createEntry({'dn': dn_fire, 'cn': 'x', 'foo': 'red'})
+        dir.createEntry({'dn': dn_night, 'cn': 'x'})
+
+        def search(**options):
+            return dir.searchEntries(cn='x', query_options=options)
+
+        conn = dir.connectLDAP()
+        reader = conn.dif_reader
+        dir.releaseLDAP(conn)
+        for supported in (fakeldap.SUPPORTED_CONTROLS,
+                          fakeldap.SUPPORTED_CONTROLS[:2],
+                          ()):
+            # server capabilities are kept with the connection pool
+            clearPools()
+            reader.supported_controls = list(supported)
+            self.assertEquals(search(order_by='foo'),
+                              [dn_sea, dn_tree, dn_fire, dn_night])
+            self.assertEquals(search(order_by='foo', reverse=True),
+                              [dn_night, dn_fire, dn_tree, dn_sea])
+            self.assertEquals(search(order_by=('foo',), limit=2),
+                              [dn_sea, dn_tree])
+            self.assertEquals(search(order_by='foo', offset=1, limit=1),
+                              [dn_tree])
+            self.assertEquals(search(order_by='foo', offset=2),
+                              [dn_fire, dn_night])
+            self.assertEquals(search(order_by='foo', reverse=True, offset=1,
+                                     limit=2),
+                              [dn_fire, dn_tree])
+            self.assertEquals(search(count=True), [4])
+            res = dir.searchEntries(cn='x', return_fields=['foo'],
+                                    query_options={'order_by': 'foo',
+                                                   'limit': 1})
+            self.assertEquals(res, [(dn_sea, {'foo': 'Blue'})])
+
+        # without ordering
+        res = search()
+        self.assertEquals(search(limit=2), res[:2])
+        self.assertEquals(search(offset=1, reverse=True),
+                          list(reversed(res))[1:])
+
+
+class TestLDAPbackingDirectoryHierarchical(LDAPTestCase):
 
     def afterSetUp(self):
         ZopeTestCase.afterSetUp(self)
@@ -654,7 +1347,7 @@ class TestLDAPbackingDirectoryHierarchical(ZopeTestCase):
 
 
 
-class TestDirectoryEntryLocalRoles(ZopeTestCase):
+class TestDirectoryEntryLocalRoles(LDAPTestCase):
     # We test entry local roles on LDAPBacking directory as this is the
     # simplest form of directory with minimal dependencies.
 
@@ -786,7 +1479,7 @@ class TestDirectoryEntryLocalRoles(ZopeTestCase):
         self.assert_(meth(id='uid=peterpan,ou=personnes,o=nuxeo,c=com'))
         self.assert_(meth(entry={'name': 'Peterpan'}))
 
-class TestLDAPBackingDirectoryWithBaseDNForCreation(ZopeTestCase):
+class TestLDAPBackingDirectoryWithBaseDNForCreation(LDAPTestCase):
 
     # Test the creation of an entry where the ldap_base_creation is specified
 
@@ -877,7 +1570,7 @@ class TestLDAPBackingDirectoryWithBaseDNForCreation(ZopeTestCase):
         self.assert_(not dir.hasEntry(id))
         self.assertRaises(KeyError, dir.getEntry, dn)
 
-class TestLDAPBackingDirectoryWithSeveralSchemas(ZopeTestCase):
+class TestLDAPBackingDirectoryWithSeveralSchemas(LDAPTestCase):
 
     # Test the behavior while adding several schemas on the directory
 
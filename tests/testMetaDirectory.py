@@ -345,6 +345,27 @@ class TestMetaDirectoryNoMissing(TestMetaDirectory):
         self.assertEquals(res, [('BBB', entry2),
                                 ('CCC', entry3)])
 
+    def test_iterSearchEntries(self):
+        dir = self.dirmeta
+        dir.createEntry({'id': 'AAA', 'foo': 'oof', 'bar': 'rab',
+                         'email': 'lame@at'})
+        dir.createEntry({'id': 'BBB', 'foo': 'oo', 'bar': 'man',
+                         'email': 'evil@hell'})
+        dir.createEntry({'id': 'CCC', 'foo': 'oo', 'bar': 'rab',
+                         'email': 'yo@mama'})
+
+        for kw in ({}, {'id': 'AAA'}, {'foo': 'oo'}, {'bar': 'rab'},
+                   {'email': 'evil@hell'}, {'foo': 'oo', 'bar': 'rab'}):
+            for return_fields in (None, ['email'], ['email', 'foo'],
+                                  ['id'], ['*']):
+                res = list(dir.iterSearchEntries(return_fields=return_fields,
+                                                 batch_size=2, **kw))
+                res.sort()
+                expected = dir.searchEntries(return_fields=return_fields,
+                                             **kw)
+                expected.sort()
+                self.assertEquals(res, expected)
+
     def test_searchEntries_ghost(self):
         dir = self.dirmeta
         fooentry = {'idd': 'DDD', 'foo': 'ouah', 'pasglop': 'arg'}
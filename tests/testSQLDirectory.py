@@ -177,6 +177,61 @@ class TestSQLDirectory(ZopeTestCase):
         self.assertEquals(getCacheReport()[0]['entries'], 1)
         self.assertEquals(getCacheReport()[0]['hits'], 2)
 
+    def test_iterSearchEntries(self):
+        dir = self.dir
+        for uid, sn in (('u3', 'Man'), ('u1', 'Man'), ('u4', 'Man'),
+                        ('u2', 'Woman')):
+            dir.createEntry({'uid': uid, 'givenName': uid.upper(), 'sn': sn})
+        queries = self.portal.sqlconn.dbc.queries
+
+        # batches ordered by id, each one starting after the previous one
+        for batch_size, nqueries in ((1, 5), (2, 3), (3, 2), (4, 2), (10, 1)):
+            del queries[:]
+            it = dir.iterSearchEntries(batch_size=batch_size)
+            self.failIf(isinstance(it, list))
+            self.assertEquals(list(it), ['u1', 'u2', 'u3', 'u4'])
+            self.assertEquals(len(queries), nqueries)
+            self.failIf('>' in queries[0])
+            self.assert_('LIMIT %d' % batch_size in queries[0])
+        del queries[:]
+        self.assertEquals(list(dir.iterSearchEntries(batch_size=2)),
+                          ['u1', 'u2', 'u3', 'u4'])
+        self.assert_('uid > "u2"' in queries[1])
+        self.assert_('uid > "u4"' in queries[2])
+
+        # with filters
+        for batch_size in (1, 2, 3):
+            self.assertEquals(list(dir.iterSearchEntries(
+                sn='Man', batch_size=batch_size)), ['u1', 'u3', 'u4'])
+            self.assertEquals(list(dir.iterSearchEntries(
+                sn=['Woman', 'Blob'], batch_size=batch_size)), ['u2'])
+            self.assertEquals(list(dir.iterSearchEntries(
+                sn='Blob', batch_size=batch_size)), [])
+        res = list(dir.iterSearchEntries(sn='Man', return_fields=['givenName'],
+                                         batch_size=2))
+        self.assertEquals(res, [('u1', {'uid': 'u1', 'givenName': 'U1'}),
+                                ('u3', {'uid': 'u3', 'givenName': 'U3'}),
+                                ('u4', {'uid': 'u4', 'givenName': 'U4'})])
+
+    def test_iterSearchEntries_noCache(self):
+        from Products.StandardCacheManagers.RAMCacheManager import (
+            RAMCacheManager)
+        self.makeEntries()
+        dir = self.dir
+        dtool = self.portal.portal_directories
+        dtool.REQUEST = self.app.REQUEST
+        man_id = 'cache_manager'
+        dtool._setObject(man_id, RAMCacheManager(man_id))
+        dir.ZCacheable_setManagerId(man_id)
+
+        self.assertEquals(list(dir.iterSearchEntries(batch_size=1)),
+                          ['batman', 'sman'])
+        self.assertEquals(dtool.cache_manager.getCacheReport(), [])
+        # rows written since are seen
+        dir.createEntry({'uid': 'aman', 'givenName': 'A', 'sn': 'Man'})
+        self.assertEquals(list(dir.iterSearchEntries(batch_size=1)),
+                          ['aman', 'batman', 'sman'])
+
     def test_listEntryIdsAndTitles(self):
         self.makeEntries()
         dir = self.dir
@@ -343,6 +343,26 @@ class TestStackingDirectory(ZopeTestCase):
                                 ('JJJ', entry4),
                                 ('LLL', entry6)])
 
+    def test_iterSearchEntries(self):
+        dir = self.dirstack
+        self.dirfoo.createEntry({'uid': 'GGG', 'moo': 'f2', 'glop': 'g1'})
+        self.dirfoo.createEntry({'uid': 'HHH', 'moo': 'f3', 'glop': 'g2'})
+        self.dirbar.createEntry({'uid': 'III', 'moo': 'f4', 'glop': 'g1'})
+        self.dirbar.createEntry({'uid': 'JJJ', 'moo': 'f5', 'glop': 'g2'})
+        self.dirbaz.createEntry({'uid': 'KKK', 'moo': 'f6', 'glop': 'g1'})
+        self.dirbaz.createEntry({'uid': 'LLL', 'moo': 'f7', 'glop': 'g2'})
+
+        for kw in ({}, {'glop': 'g1'}, {'moo': 'f6'}, {'moo': ['f2', 'f7']},
+                   {'uid': 'JJJ', 'glop': 'g2'}, {'uid': 'f7'}):
+            for return_fields in (None, ['glop'], ['*']):
+                res = list(dir.iterSearchEntries(return_fields=return_fields,
+                                                 batch_size=2, **kw))
+                res.sort()
+                expected = dir.searchEntries(return_fields=return_fields,
+                                             **kw)
+                expected.sort()
+                self.assertEquals(res, expected)
+
     def testBasicSecurity(self):
         self.assert_(self.dirstack.searchEntries() is not None)
         self.logout()
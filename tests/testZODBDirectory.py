@@ -18,6 +18,7 @@
 #
 # $Id$
 
+import md5
 import unittest
 from Testing.ZopeTestCase import ZopeTestCase
 
@@ -120,6 +121,13 @@ class TestZODBDirectory(ZopeTestCase):
         self.assert_(not zdir.hasEntry(id))
         self.assertRaises(KeyError, zdir.getEntry, id)
 
+    def testCreateEntries(self):
+        zdir = self.dir
+        zdir.createEntries([{'idd': 'chien', 'foo': 'ouah'},
+                            {'idd': 'chat', 'foo': 'miaou'}])
+        self.assertEqual(zdir.listEntryIds(), ['chat', 'chien'])
+        self.assertRaises(KeyError, zdir.createEntries, [{'idd': 'chat'}])
+
     def test__getEntry(self):
         # this actually tests code from BaseDirectory
 
@@ -413,24 +421,462 @@ class TestZODBDirectory(ZopeTestCase):
         res2 = zdir.searchEntries(idd=id1, return_fields=['foo'])
         self.assertEquals(res2, [(id1, {'foo': foo1})])
 
-        # editing entries clears the cache
+        # editing an entry only evicts the results that depend on it
+        self.assertEquals(zdir.searchEntries(foo=foo2), [id2])
+        stats = zdir.getCacheStatistics()
         e2['foo'] = 'foo_new'
         zdir.editEntry(e2)
-        self.assertEquals(len(getCacheReport()), 0)
-        self.assertEquals(zdir.searchEntries(idd=id1), [id1])
         self.assertEquals(len(getCacheReport()), 1)
+        self.assertEquals(zdir.searchEntries(idd=id1), [id1])
+        self.assertEquals(zdir.getCacheStatistics()['hits'], stats['hits'] + 1)
+        self.assertEquals(zdir.searchEntries(idd=id2), [id2])
+        self.assertEquals(zdir.searchEntries(foo=foo2), [])
+        self.assertEquals(zdir.getCacheStatistics()['evictions'],
+                          stats['evictions'] + 2)
+
+        # new values are taken into account
+        self.assertEquals(zdir.searchEntries(foo='foo_new'), [id2])
+        zdir.editEntry({'idd': id1, 'foo': 'foo_new'})
+        self.assertEquals(zdir.searchEntries(foo='foo_new'), [id2, id1])
 
-        # deleting entry clears the cache
+        # deleting an entry
         zdir.deleteEntry(id2)
-        self.assertEquals(len(getCacheReport()), 0)
-        self.assertEquals(zdir.searchEntries(idd=id1), [id1])
-        self.assertEquals(len(getCacheReport()), 1)
+        self.assertEquals(zdir.searchEntries(idd=id2), [])
+        self.assertEquals(zdir.searchEntries(foo='foo_new'), [id1])
 
-        # adding entries clears the cache
+        # adding an entry
+        self.assertEquals(zdir.searchEntries(foo=foo2), [])
         zdir.createEntry(e2)
+        self.assertEquals(zdir.searchEntries(idd=id2), [id2])
+        self.assertEquals(zdir.searchEntries(foo='foo_new'), [id2, id1])
+
+        # without caching, results cached before may not be trusted
+        zdir.ZCacheable_setManagerId(None)
+        zdir.editEntry({'idd': id1, 'foo': 'other'})
+        zdir.ZCacheable_setManagerId(man_id)
+        self.assertEquals(zdir.searchEntries(foo='foo_new'), [id2])
+
+        # property changes clear the cache
+        zdir.manage_changeProperties(title_field='bar')
         self.assertEquals(len(getCacheReport()), 0)
-        self.assertEquals(zdir.searchEntries(idd=id1), [id1])
-        self.assertEquals(len(getCacheReport()), 1)
+
+        zdir.manage_resetCacheStatistics()
+        self.assertEquals(zdir.getCacheStatistics()['hits'], 0)
+
+    def testIndexedSearch(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'green', 'bar': ['a', 'gra']})
+
+        # existing entries are indexed when the index is created
+        zdir.manage_changeProperties(indexed_fields=['foo', 'bar'])
+        self.assertEquals(sorted(zdir._indexes.keys()), ['bar', 'foo'])
+        self.assertEquals(len(zdir._indexes['foo']), 1)
+
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue', 'bar': ['812A', 'gra']})
+        self.assertEquals(len(zdir._indexes['foo']), 2)
+
+        # index only
+        self.assertEquals(zdir.searchEntries(foo='green'), ['tree'])
+        self.assertEquals(zdir.searchEntries(foo=['blue', 'green']),
+                          ['sea', 'tree'])
+        self.assertEquals(zdir.searchEntries(bar='gra'), ['sea', 'tree'])
+        self.assertEquals(zdir.searchEntries(foo='blue', bar='a'), [])
+        self.assertEquals(zdir.searchEntries(foo='hop'), [])
+        self.assertEquals(zdir.searchEntries(foo=u'green'), ['tree'])
+
+        # index and scan
+        self.assertEquals(zdir.searchEntries(bar='gra', idd='sea'), ['sea'])
+        self.assertEquals(zdir.searchEntries(foo='green', return_fields=['*']),
+                          [('tree', {'idd': 'tree', 'foo': 'green',
+                                     'bar': ['a', 'gra']})])
+
+        # indexes follow edits and deletions
+        zdir.editEntry({'idd': 'sea', 'foo': 'green'})
+        self.assertEquals(zdir.searchEntries(foo='blue'), [])
+        self.assertEquals(zdir.searchEntries(foo='green'), ['sea', 'tree'])
+        zdir.deleteEntry('tree')
+        self.assertEquals(zdir.searchEntries(foo='green'), ['sea'])
+        self.assertEquals(zdir.searchEntries(bar='a'), [])
+        self.assertEquals(len(zdir._indexes['bar']), 1)
+
+        # typed values
+        zdir.editEntry({'idd': 'sea', 'foo': False})
+        self.assertEquals(zdir.searchEntries(foo=False), ['sea'])
+        self.assertEquals(zdir.searchEntries(foo=True), [])
+
+        # dropping the index
+        zdir.manage_changeProperties(indexed_fields=['bar'])
+        self.assertEquals(zdir._indexes.keys(), ['bar'])
+        self.assertEquals(zdir.searchEntries(foo=False), ['sea'])
+
+    def testRangeSearch(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'a', 'foo': DateTime('2000/01/01')})
+        zdir.createEntry({'idd': 'b', 'foo': DateTime('2000/06/01')})
+        zdir.createEntry({'idd': 'c', 'foo': DateTime('2001/01/01')})
+        zdir.createEntry({'idd': 'd', 'foo': 'not a date'})
+        query = {'query': DateTime('2000/03/01'), 'range': 'min'}
+        negated = {'query': DateTime('2000/03/01'), 'range': 'min',
+                   'negate': True}
+        both = {'query': (DateTime('2000/03/01'), DateTime('2000/12/31')),
+                'range': 'min:max'}
+
+        # scan
+        self.assertEquals(zdir.searchEntries(foo=query), ['b', 'c'])
+        self.assertEquals(zdir.searchEntries(foo=negated), ['a'])
+        self.assertEquals(zdir.searchEntries(foo=both), ['b'])
+
+        # index
+        zdir.manage_changeProperties(indexed_fields=['foo'])
+        self.assertEquals(zdir.searchEntries(foo=query), ['b', 'c'])
+        self.assertEquals(zdir.searchEntries(foo=negated), ['a'])
+        self.assertEquals(zdir.searchEntries(foo=both), ['b'])
+        self.assertEquals(zdir.searchEntries(foo=both, idd='c'), [])
+        zdir.editEntry({'idd': 'c', 'foo': DateTime('2000/04/01')})
+        self.assertEquals(zdir.searchEntries(foo=both), ['b', 'c'])
+
+    def testIndexedSubstringSearch(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'green', 'bar': ['a', 'gra']})
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue', 'bar': ['812A', 'gra']})
+        zdir.manage_changeProperties(search_substring_fields=['foo', 'bar'],
+                                     index_substring_fields=True)
+        self.assertEquals(sorted(zdir._substring_indexes.keys()),
+                          ['bar', 'foo'])
+
+        self.assertEquals(zdir.searchEntries(foo='REE'), ['tree'])
+        self.assertEquals(zdir.searchEntries(foo='e'), ['sea', 'tree'])
+        self.assertEquals(zdir.searchEntries(foo='*'), ['sea', 'tree'])
+        self.assertEquals(zdir.searchEntries(bar='812a'), ['sea'])
+        self.assertEquals(zdir.searchEntries(foo='E', bar='12'), ['sea'])
+        self.assertEquals(zdir.searchEntries(foo='greenish'), [])
+
+        zdir.editEntry({'idd': 'sea', 'foo': u'gr\xe9en'})
+        self.assertEquals(zdir.searchEntries(foo='green'), ['sea', 'tree'])
+        zdir.deleteEntry('tree')
+        self.assertEquals(zdir.searchEntries(foo='green'), ['sea'])
+
+        zdir.manage_changeProperties(index_substring_fields=False)
+        self.assertEquals(zdir._substring_indexes, {})
+        self.assertEquals(zdir.searchEntries(foo='green'), ['sea'])
+
+    def testListEntryIdsAndTitles(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'Green'})
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue'})
+        self.assertEquals(zdir.listEntryIdsAndTitles(),
+                          [('sea', 'blue'), ('tree', 'Green')])
+        index = zdir._title_index
+        self.assertEquals(len(index), 2)
+
+        # maintained on write
+        zdir.createEntry({'idd': 'sky', 'foo': u'\xc9ther'})
+        zdir.editEntry({'idd': 'sea', 'foo': 'Gray'})
+        zdir.deleteEntry('tree')
+        self.assertEquals(zdir.listEntryIdsAndTitles(),
+                          [('sea', 'Gray'), ('sky', u'\xc9ther')])
+        self.assert_(zdir._title_index is index)
+
+        # sorted listings
+        zdir.createEntry({'idd': 'grass', 'foo': 'green'})
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(),
+                          [('sky', u'\xc9ther'), ('sea', 'Gray'),
+                           ('grass', 'green')])
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(prefix='GR'),
+                          [('sea', 'Gray'), ('grass', 'green')])
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(prefix='e'),
+                          [('sky', u'\xc9ther')])
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(start=1, limit=1),
+                          [('sea', 'Gray')])
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(prefix='z'), [])
+
+        # rebuilt when the title field changes
+        zdir.manage_changeProperties(title_field='idd')
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(prefix='s'),
+                          [('sea', 'sea'), ('sky', 'sky')])
+        zdir.manage_changeProperties(title_field='foo')
+        self.assertEquals(zdir.listEntryIdsAndTitles(),
+                          [('grass', 'green'), ('sea', 'Gray'),
+                           ('sky', u'\xc9ther')])
+        self.failIf(zdir._title_index is index)
+
+    def testListEntryIdsAndTitles_noIndex(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'Green'})
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue'})
+        # listings don't build a missing index
+        zdir._title_index = None
+        self.assertEquals(zdir.listEntryIdsAndTitles(),
+                          [('sea', 'blue'), ('tree', 'Green')])
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(prefix='g'),
+                          [('tree', 'Green')])
+        self.assertEquals(zdir._title_index, None)
+        zdir.manage_rebuildIndexes()
+        index = zdir._title_index
+        self.assertEquals(len(index), 2)
+
+        # nor a stale one, the next write rebuilds it
+        index.signature = ('stale',)
+        self.assertEquals(zdir.listEntryIdsAndTitles(),
+                          [('sea', 'blue'), ('tree', 'Green')])
+        self.assert_(zdir._title_index is index)
+        zdir.editEntry({'idd': 'sea', 'foo': 'Gray'})
+        self.failIf(zdir._title_index is index)
+        self.assertEquals(len(zdir._title_index), 2)
+        self.assertEquals(zdir.listSortedEntryIdsAndTitles(),
+                          [('sea', 'Gray'), ('tree', 'Green')])
+
+    def testQueryOptions(self):
+        from Products.CPSDirectory.interfaces import IBatchable
+        from Products.CPSDirectory.interfaces import IOrderable
+        zdir = self.dir
+        self.assert_(IBatchable.providedBy(zdir))
+        self.assert_(IOrderable.providedBy(zdir))
+        zdir.createEntry({'idd': 'tree', 'foo': 'green', 'bar': ['x']})
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue', 'bar': ['x']})
+        zdir.createEntry({'idd': 'fire', 'foo': 'red', 'bar': ['x']})
+        zdir.createEntry({'idd': 'night', 'foo': 'black', 'bar': ['y']})
+
+        def search(**options):
+            return zdir.searchEntries(bar='x', query_options=options)
+
+        for indexed_fields in ((), ('foo',), ('foo', 'bar')):
+            zdir.manage_changeProperties(indexed_fields=indexed_fields)
+            self.assertEquals(search(order_by='foo'),
+                              ['sea', 'tree', 'fire'])
+            self.assertEquals(search(order_by='foo', reverse=True),
+                              ['fire', 'tree', 'sea'])
+            self.assertEquals(search(order_by=('foo',), limit=2),
+                              ['sea', 'tree'])
+            self.assertEquals(search(order_by='foo', offset=1, limit=1),
+                              ['tree'])
+            self.assertEquals(search(order_by='foo', offset=1),
+                              ['tree', 'fire'])
+            self.assertEquals(search(order_by='foo', reverse=True, limit=1),
+                              ['fire'])
+            # without order_by, reverse is ignored like in SQLDirectory
+            self.assertEquals(search(reverse=True), ['fire', 'sea', 'tree'])
+            self.assertEquals(search(count=True), [3])
+            self.assertEquals(zdir.searchEntries(
+                query_options={'count': True}), [4])
+            res = zdir.searchEntries(bar='x', return_fields=['foo'],
+                                     query_options={'order_by': 'foo',
+                                                    'limit': 1})
+            self.assertEquals(res, [('sea', {'foo': 'blue'})])
+            res = zdir.searchEntries(bar='x', return_fields=['foo'],
+                                     query_options={'order_by': 'foo'})
+            self.assertEquals([id for id, entry in res],
+                              ['sea', 'tree', 'fire'])
+
+        # unknown sort fields
+        for query in ({}, {'bar': 'x'}):
+            self.assertRaises(ValueError, zdir.searchEntries,
+                              query_options={'order_by': 'nosuchfield'},
+                              **query)
+            self.assertRaises(ValueError, zdir.searchEntries,
+                              return_fields=['foo'],
+                              query_options={'order_by': ('foo', 'zzz')},
+                              **query)
+
+    def testIterSearchEntries(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'green', 'bar': ['x']})
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue', 'bar': ['x']})
+        zdir.createEntry({'idd': 'fire', 'foo': 'red', 'bar': ['x']})
+        zdir.createEntry({'idd': 'night', 'foo': 'black', 'bar': ['y']})
+
+        it = zdir.iterSearchEntries(bar='x', batch_size=2)
+        self.failIf(isinstance(it, list))
+        self.assertEquals(sorted(it), ['fire', 'sea', 'tree'])
+        for indexed_fields in ((), ('foo',), ('foo', 'bar')):
+            zdir.manage_changeProperties(indexed_fields=indexed_fields)
+            for kw in ({}, {'bar': 'x'}, {'foo': 'blue'}, {'foo': 'pink'}):
+                self.assertEquals(
+                    sorted(zdir.iterSearchEntries(batch_size=2, **kw)),
+                    sorted(zdir.searchEntries(**kw)))
+                self.assertEquals(
+                    sorted(zdir.iterSearchEntries(return_fields=['foo'],
+                                                  batch_size=2, **kw)),
+                    sorted(zdir.searchEntries(return_fields=['foo'], **kw)))
+        res = zdir.iterSearchEntries(bar='x', return_fields=['foo'],
+                                     query_options={'order_by': 'foo'})
+        self.assertEquals([id for id, entry in res], ['sea', 'tree', 'fire'])
+
+    def testFieldDataValidators(self):
+        # this actually tests code from BaseDirectory
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+
+        self.assertEquals(zdir.getFileFieldData('chien', 'foo',
+                                                request, response), 'ouah')
+        etag = response.getHeader('etag')
+        self.assertEquals(etag, '"%s"' % md5.new('ouah').hexdigest())
+
+        request.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEquals(zdir.getFileFieldData('chien', 'foo',
+                                                request, response), '')
+        self.assertEquals(response.getStatus(), 304)
+
+        # a new value has a new ETag
+        zdir.editEntry({'idd': 'chien', 'foo': 'miaou'})
+        self.assertEquals(zdir.getFileFieldData('chien', 'foo',
+                                                request, response), 'miaou')
+        self.assertNotEquals(response.getHeader('etag'), etag)
+
+    def testFieldDataNotModifiedWithoutReading(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+        self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                 response, size=48),
+                          'ouah')
+        etag = response.getHeader('etag')
+        self.assertEquals(etag, '"%s-48"' % md5.new('ouah').hexdigest())
+
+        # conditional requests are answered without reading the data
+        class Unreadable(object):
+            def data(self):
+                raise AssertionError("data read")
+            data = property(data)
+        zdir._getEntryObject('chien').foo = Unreadable()
+        request.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                 response, size=48), '')
+        self.assertEquals(response.getStatus(), 304)
+        self.assertEquals(response.getHeader('etag'), etag)
+
+        # until the entry is written
+        zdir.editEntry({'idd': 'chien', 'foo': 'miaou'})
+        self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                 response, size=48),
+                          'miaou')
+        self.assertNotEquals(response.getHeader('etag'), etag)
+
+    def testImageFieldDataReadAccess(self):
+        from Products.CPSSchemas.Field import ReadAccessError
+        from Products.CPSDirectory.thumbnails import getThumbnailCache
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+        # a thumbnail made for someone allowed to read the field
+        key = ('/'.join(zdir.getPhysicalPath()), 'chien', 'foo', 48,
+               md5.new('ouah').hexdigest())
+        getThumbnailCache().set(key, 'thumb')
+        try:
+            self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                     response, size=48),
+                              'thumb')
+            class UnreadableField(FakeField):
+                def checkReadAccess(self, *args):
+                    raise ReadAccessError('foo')
+            self.portal.portal_schemas.testzodb.fields['foo'] = \
+                UnreadableField()
+            self.assertRaises(KeyError, zdir.getImageFieldData, 'chien',
+                              'foo', request, response, size=48)
+            self.assertRaises(KeyError, zdir.getFileFieldData, 'chien',
+                              'foo', request, response)
+        finally:
+            getThumbnailCache().invalidate(key[0], 'chien')
+
+    def testThumbnailsAfterEditForm(self):
+        from Products.CPSDirectory.thumbnails import getThumbnailCache
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+        key = ('/'.join(zdir.getPhysicalPath()), 'chien', 'foo', 48,
+               md5.new('ouah').hexdigest())
+        getThumbnailCache().set(key, 'thumb')
+        self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                 response, size=48),
+                          'thumb')
+
+        class FakeLayout:
+            def prepareLayoutWidgets(self, ds):
+                pass
+            def computeLayoutStructure(self, layout_mode, dm):
+                return {}
+            def validateLayoutStructure(self, layout_structure, ds, **kw):
+                # what the widgets do with the submitted value
+                ds.getDataModel()['foo'] = 'miaou'
+                return True
+        class FakeRequest:
+            form = {'foo': 'miaou'}
+        zdir._getLayout = FakeLayout
+        zdir._renderLayout = lambda *args, **kw: 'rendered'
+        rendered, ok, ds = zdir.renderEditEntryDetailed('chien',
+                                                        request=FakeRequest())
+        self.assert_(ok)
+        self.assertEquals(zdir.getEntry('chien')['foo'], 'miaou')
+        self.assertEquals(getThumbnailCache().get(key), None)
+        self.assertEquals(zdir.getImageFieldData('chien', 'foo', request,
+                                                 response, size=48),
+                          'miaou')
+
+    def testThumbnailsOfChangedImage(self):
+        from Products.CPSDirectory.thumbnails import getThumbnailCache
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+        key = ('/'.join(zdir.getPhysicalPath()), 'chien', 'foo', 48,
+               md5.new('ouah').hexdigest())
+        getThumbnailCache().set(key, 'thumb')
+        try:
+            # changed without invalidation (other process, backend)
+            zdir._getEntryObject('chien').foo = 'miaou'
+            self.assertEquals(zdir.getImageFieldData('chien', 'foo',
+                                                     request, response,
+                                                     size=48),
+                              'miaou')
+        finally:
+            getThumbnailCache().invalidate(key[0], 'chien')
+
+    def testImageFieldDataBadSize(self):
+        from zExceptions import BadRequest
+        zdir = self.dir
+        zdir.createEntry({'idd': 'chien', 'foo': 'ouah'})
+        request = self.app.REQUEST
+        response = request.RESPONSE
+        for size in ('abc', '0', '-5', 0.5):
+            self.assertRaises(BadRequest, zdir.getImageFieldData, 'chien',
+                              'foo', request, response, size=size)
+
+    def testCompactStorage(self):
+        zdir = self.dir
+        zdir.createEntry({'idd': 'tree', 'foo': 'green', 'bar': ['a', 'gra']})
+        zdir.manage_changeProperties(indexed_fields=['foo'])
+
+        zdir.manage_changeProperties(compact_storage=True)
+        self.assertEquals(list(zdir.objectIds()), [])
+        self.assertEquals(len(zdir._compact_store), 1)
+        self.assertEquals(zdir.getEntry('tree')['bar'], ['a', 'gra'])
+
+        zdir.createEntry({'idd': 'sea', 'foo': 'blue', 'bar': ['812A']})
+        self.assertEquals(zdir.listEntryIds(), ['sea', 'tree'])
+        self.assert_(zdir.hasEntry('sea'))
+        self.assertEquals(zdir.searchEntries(foo='blue'), ['sea'])
+        self.assertEquals(zdir.searchEntries(bar='812A'), ['sea'])
+        self.assertRaises(KeyError, zdir.createEntry, {'idd': 'sea'})
+
+        zdir.editEntry({'idd': 'sea', 'foo': 'gray'})
+        self.assertEquals(zdir.getEntry('sea')['foo'], 'gray')
+        self.assertEquals(zdir.searchEntries(foo='gray'), ['sea'])
+        zdir.deleteEntry('tree')
+        self.assertEquals(zdir.listEntryIds(), ['sea'])
+        self.assertEquals(zdir.searchEntries(foo='green'), [])
+        self.assertRaises(KeyError, zdir.getEntry, 'tree')
+
+        # back to subobjects
+        zdir.manage_changeProperties(compact_storage=False)
+        self.assertEquals(zdir._compact_store, None)
+        self.assertEquals(list(zdir.objectIds()), ['sea'])
+        self.assertEquals(zdir.getEntry('sea')['bar'], ['812A'])
+        self.assertEquals(zdir.searchEntries(foo='gray'), ['sea'])
 
     def testSearchSubstrings(self):
         zdir = self.dir
@@ -0,0 +1,194 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+from pickle import dumps, loads
+
+from Products.CPSDirectory.cache import CacheTracker
+from Products.CPSDirectory.cache import CopyOnWriteEntry
+from Products.CPSDirectory.cache import ExistenceCache
+from Products.CPSDirectory.cache import LRUCache
+from Products.CPSDirectory.cache import freezeResults
+from Products.CPSDirectory.cache import thawResults
+
+class CacheTrackerTestCase(unittest.TestCase):
+
+    def testEvents(self):
+        tracker = CacheTracker()
+        stamp = tracker.getStamp()
+        self.assertEquals(tracker.getEventsSince(stamp), [])
+        tracker.recordWrite('a', None, {'foo': 'bar'})
+        events = tracker.getEventsSince(stamp)
+        self.assertEquals([e[1:] for e in events],
+                          [('a', None, {'foo': 'bar'})])
+        self.assertEquals(tracker.getEventsSince(tracker.getStamp()), [])
+
+    def testFlush(self):
+        tracker = CacheTracker()
+        stamp = tracker.getStamp()
+        tracker.recordFlush()
+        self.assertEquals(tracker.getEventsSince(stamp), None)
+        self.assertEquals(tracker.getEventsSince(tracker.getStamp()), [])
+
+    def testChange(self):
+        tracker = CacheTracker()
+        stamp = tracker.getStamp()
+        tracker.recordChange('a')
+        events = tracker.getEventsSince(stamp)
+        self.assertEquals([e[1:] for e in events], [('a', None, None)])
+
+    def testMaxEvents(self):
+        tracker = CacheTracker(max_events=2)
+        stamp = tracker.getStamp()
+        tracker.recordWrite('a', None, None)
+        tracker.recordWrite('b', None, None)
+        self.assertEquals(len(tracker.getEventsSince(stamp)), 2)
+        tracker.recordWrite('c', None, None)
+        self.assertEquals(tracker.getEventsSince(stamp), None)
+
+    def testOtherTracker(self):
+        stamp = CacheTracker().getStamp()
+        self.assertEquals(CacheTracker().getEventsSince(stamp), None)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def testLRU(self):
+        cache = LRUCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b was the least recently used
+        self.failIf('b' in cache)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEquals(cache.get('a'), 4)
+        self.failIf('c' in cache)
+        self.assertEquals(cache.getStatistics(),
+                          {'hits': 4, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def testClear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get('a', 'none'), 'none')
+        cache.set('b', 2)
+        self.assertEquals(cache.get('b'), 2)
+
+
+class ExistenceCacheTestCase(unittest.TestCase):
+
+    def testTTL(self):
+        cache = ExistenceCache()
+        self.assertEquals(cache.get('a', 10, 10), None)
+        cache.set('a', True)
+        cache.set('b', False)
+        self.assertEquals(cache.get('a', 10, 10), True)
+        self.assertEquals(cache.get('b', 10, 10), False)
+        # expired
+        self.assertEquals(cache.get('b', 10, 0), None)
+        self.assertEquals(cache.get('a', 0, 10), None)
+        self.assertEquals(cache.getStatistics(),
+                          {'hits': 1, 'negative_hits': 1, 'misses': 3,
+                           'expired': 2, 'size': 0, 'max_size': 10000})
+
+    def testInvalidate(self):
+        cache = ExistenceCache()
+        cache.set('a', True)
+        cache.set('b', True)
+        cache.invalidate('a')
+        self.assertEquals(cache.get('a', 10, 10), None)
+        cache.clear()
+        self.assertEquals(cache.get('b', 10, 10), None)
+
+    def testSize(self):
+        cache = ExistenceCache(size=4)
+        for key in 'abcd':
+            cache.set(key, True)
+        cache.set('e', False)
+        self.assertEquals(cache.getStatistics()['size'], 4)
+        self.assertEquals(cache.get('e', 10, 10), False)
+        # expired answers are dropped first
+        cache.set('f', True, max_age=0)
+        self.assertEquals(cache.getStatistics()['size'], 1)
+
+
+class CopyOnWriteEntryTestCase(unittest.TestCase):
+
+    def testReadOnly(self):
+        shared = {'foo': 'bar', 'spam': ['eggs']}
+        entry = CopyOnWriteEntry(shared)
+        self.assertEquals(entry, shared)
+        self.assertEquals(shared, entry)
+        self.assertEquals(sorted(entry.keys()), ['foo', 'spam'])
+        self.assertEquals(len(entry), 2)
+        self.assert_('foo' in entry)
+        self.assertEquals(entry.get('zzz'), None)
+        self.assert_(entry['foo'] is shared['foo'])
+
+    def testWrite(self):
+        shared = {'foo': 'bar', 'spam': ['eggs']}
+        entry = CopyOnWriteEntry(shared)
+        entry['foo'] = 'baz'
+        del entry['spam']
+        self.assertEquals(entry, {'foo': 'baz'})
+        self.assertEquals(shared, {'foo': 'bar', 'spam': ['eggs']})
+
+    def testMutableValues(self):
+        shared = {'foo': 'bar', 'spam': ['eggs']}
+        entry = CopyOnWriteEntry(shared)
+        entry['spam'].append('bacon')
+        self.assertEquals(entry['spam'], ['eggs', 'bacon'])
+        entry['foo'] = 'baz'
+        self.assertEquals(entry['spam'], ['eggs', 'bacon'])
+        self.assertEquals(shared, {'foo': 'bar', 'spam': ['eggs']})
+
+        entry = CopyOnWriteEntry(shared)
+        entry['foo'] = 'baz'
+        entry['spam'].append('bacon')
+        self.assertEquals(shared, {'foo': 'bar', 'spam': ['eggs']})
+
+    def testPickle(self):
+        entry = CopyOnWriteEntry({'foo': 'bar'})
+        self.assertEquals(loads(dumps(entry)), {'foo': 'bar'})
+
+    def testResults(self):
+        entry = {'foo': ['bar']}
+        frozen = freezeResults([('a', entry)])
+        entry['foo'].append('baz')
+        self.assertEquals(frozen, (('a', {'foo': ['bar']}),))
+        results = thawResults(frozen)
+        self.assertEquals(results, [('a', {'foo': ['bar']})])
+        results[0][1]['foo'] = 'zap'
+        results.append('b')
+        self.assertEquals(thawResults(frozen), [('a', {'foo': ['bar']})])
+        self.assertEquals(thawResults(('a', 'b')), ['a', 'b'])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(CacheTrackerTestCase),
+        unittest.makeSuite(LRUCacheTestCase),
+        unittest.makeSuite(ExistenceCacheTestCase),
+        unittest.makeSuite(CopyOnWriteEntryTestCase),
+        ))
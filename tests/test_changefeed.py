@@ -0,0 +1,152 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Testing.ZopeTestCase import doctest
+
+from Products.CPSDirectory.changefeed import LogFileFeed
+from Products.CPSDirectory.changefeed import ChangeListener
+from Products.CPSDirectory.changefeed import ChangeFeedError
+
+AUDIT_LOG = """\
+# modify 1262304000 ou=people,o=org cn=admin,o=org
+dn: uid=john,ou=people,o=org
+changetype: modify
+replace: mail
+mail: john@example.com
+-
+# end modify 1262304000
+
+# delete 1262304001 ou=people,o=org cn=admin,o=org
+dn: uid=jack,ou=people,o=org
+changetype: delete
+# end delete 1262304001
+
+"""
+
+class LogFileFeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'audit.ldif')
+        self.write(AUDIT_LOG)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mode='ab'):
+        f = open(self.path, mode)
+        f.write(data)
+        f.close()
+
+    def testReplay(self):
+        feed = LogFileFeed(self.path, replay=True, follow=False)
+        self.assertEquals(list(feed), [
+            ('modify', 'uid=john,ou=people,o=org', None),
+            ('delete', 'uid=jack,ou=people,o=org', None),
+            ])
+
+    def testMissingFile(self):
+        feed = LogFileFeed(os.path.join(self.dir, 'nothere'), replay=True,
+                           follow=False)
+        self.assertRaises(ChangeFeedError, list, feed)
+
+    def testFollow(self):
+        feed = LogFileFeed(self.path, poll_interval=0)
+        it = iter(feed)
+        # existing changes are skipped
+        self.assertEquals(it.next(), None)
+        self.write("dn: uid=john,ou=people,o=org\n"
+                   "changetype: modrdn\nnewrdn: uid=johnny\n"
+                   "deleteoldrdn: 1\n")
+        self.assertEquals(it.next(), None)
+        self.write("\n")
+        self.assertEquals(it.next(), ('modrdn', 'uid=johnny,ou=people,o=org',
+                                      'uid=john,ou=people,o=org'))
+        self.assertEquals(it.next(), None)
+
+        # rotation
+        os.rename(self.path, self.path + '.1')
+        self.write("dn: uid=jim,ou=people,o=org\nchangetype: add\n"
+                   "uid: jim\n\n")
+        change = it.next()
+        while change is None:
+            change = it.next()
+        self.assertEquals(change, ('add', 'uid=jim,ou=people,o=org', None))
+
+        feed.close()
+        self.assertRaises(StopIteration, it.next)
+
+
+class ChangeListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+
+    def on_change(self, change_type, dn, previous_dn):
+        self.log.append((change_type, dn))
+
+    def on_reset(self):
+        self.log.append('reset')
+
+    def testRun(self):
+        changes = [('add', 'cn=a'), None, ('delete', 'cn=b')]
+        feeds = [[change and change + (None,) for change in changes]]
+        listener = ChangeListener('test', None, feeds.pop, self.on_change,
+                                  self.on_reset)
+        # run in this thread
+        listener.run()
+        self.assertEquals(self.log, ['reset', ('add', 'cn=a'),
+                                     ('delete', 'cn=b')])
+        stats = listener.getStatistics()
+        self.assertEquals(stats['changes'], 2)
+        self.assertEquals(stats['errors'], 0)
+        self.failIf(stats['connected'])
+
+    def testRetry(self):
+        def broken():
+            yield ('modify', 'cn=a', None)
+            raise ChangeFeedError('Connection lost')
+        feeds = [[('modify', 'cn=b', None)], broken()]
+        listener = ChangeListener('test', None, feeds.pop, self.on_change,
+                                  self.on_reset, retry_delay=0)
+        listener.run()
+        self.assertEquals(self.log, ['reset', ('modify', 'cn=a'), 'reset',
+                                     'reset', ('modify', 'cn=b')])
+        stats = listener.getStatistics()
+        self.assertEquals(stats['errors'], 1)
+        self.assertEquals(stats['last_error'], 'Connection lost')
+
+    def testStop(self):
+        listener = ChangeListener('test', None, lambda: [None] * 3,
+                                  self.on_change, self.on_reset)
+        listener.stop()
+        listener.run()
+        self.assertEquals(self.log, [])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(LogFileFeedTestCase),
+        unittest.makeSuite(ChangeListenerTestCase),
+        doctest.DocTestSuite('Products.CPSDirectory.changefeed'),
+        ))
@@ -0,0 +1,85 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Missing import MV
+
+from Products.CPSDirectory.compact import CompactEntryStore
+
+class CompactEntryStoreTestCase(unittest.TestCase):
+
+    def makeStore(self):
+        store = CompactEntryStore(('foo', 'bar', 'baz'))
+        store.createRecord('a')
+        store.setValues('a', {'foo': 'spam', 'baz': None})
+        store.createRecord('b')
+        return store
+
+    def testRecords(self):
+        store = self.makeStore()
+        self.assertEquals(len(store), 2)
+        self.assertEquals(list(store.keys()), ['a', 'b'])
+        self.assert_(store.has_key('a'))
+        self.failIf(store.has_key('c'))
+        self.assertRaises(KeyError, store.createRecord, 'a')
+        self.assertEquals(store.getValues('a'), {'foo': 'spam', 'baz': None})
+        self.assertEquals(store.getValues('b'), {})
+        store.deleteRecord('a')
+        self.assertEquals(list(store.keys()), ['b'])
+        self.assertEquals(len(store), 1)
+        self.assertRaises(KeyError, store.deleteRecord, 'a')
+
+    def testLayout(self):
+        store = self.makeStore()
+        self.assertEquals(store._records['a'], ('spam', MV, None))
+        self.assertEquals(store._records['b'], ())
+        # new fields are appended to the layout
+        store.setValue('b', 'new', 1)
+        self.assertEquals(store.getFieldIds(), ('foo', 'bar', 'baz', 'new'))
+        self.assertEquals(len(store._records['b']), 4)
+        self.assertEquals(store.getValues('a'), {'foo': 'spam', 'baz': None})
+        # trailing missing values are dropped
+        store.delValue('b', 'new')
+        self.assertEquals(store._records['b'], ())
+        store.delValue('a', 'baz')
+        self.assertEquals(store._records['a'], ('spam',))
+        self.assertRaises(AttributeError, store.delValue, 'a', 'baz')
+
+    def testEntry(self):
+        store = self.makeStore()
+        ob = store.getEntry('a')
+        self.assertEquals(ob.getId(), 'a')
+        self.assertEquals(ob.foo, 'spam')
+        self.assertEquals(ob.baz, None)
+        self.assertEquals(getattr(ob, 'bar', 'default'), 'default')
+        self.failIf(hasattr(ob, '__of__'))
+        ob.bar = ['x']
+        ob._p_changed = 1
+        self.assertEquals(store.getValues('a'),
+                          {'foo': 'spam', 'bar': ['x'], 'baz': None})
+        del ob.foo
+        self.assertRaises(AttributeError, getattr, ob, 'foo')
+        self.assertEquals(store.getEntry('c'), None)
+        self.assertEquals([id for id, ob in store.items()], ['a', 'b'])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(CompactEntryStoreTestCase),
+        ))
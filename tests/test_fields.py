@@ -0,0 +1,130 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Products.CPSDirectory import fields
+from Products.CPSDirectory.fields import attributes_to_dns
+from Products.CPSDirectory.fields import attributes_to_entries
+from Products.CPSDirectory.fields import dns_to_attributes
+from Products.CPSDirectory.fields import getResolutionCache
+
+
+class FakeDirectory:
+    """Directory of people, with exact match on sequences."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = []
+
+    def getId(self):
+        return 'people'
+
+    def _getFieldIds(self, search=False):
+        return ['dn', 'uid', 'cn', 'mail']
+
+    def _searchEntries(self, return_fields=None, **kw):
+        self.searches.append(kw)
+        res = []
+        for entry in self.entries:
+            for key, value in kw.items():
+                if isinstance(value, basestring):
+                    # substring behaviour
+                    if value not in entry[key]:
+                        break
+                elif entry[key] not in value:
+                    break
+            else:
+                res.append((entry['dn'], dict(
+                    (f, entry[f]) for f in return_fields)))
+        return res
+
+
+class FakeRequest:
+    def __init__(self):
+        self.other = {}
+
+
+class FakeField:
+    aux_directory = 'people'
+    ldap_attribute = 'uid'
+
+
+class FieldsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.entries = []
+        for i in range(250):
+            uid = 'user%d' % i
+            self.entries.append({
+                'dn': 'cn=User %d,ou=people,o=example' % i,
+                'uid': uid,
+                'cn': 'User %d' % i,
+                'mail': uid + '@example.com',
+                })
+        self.dir = FakeDirectory(self.entries)
+
+    def test_attributes_to_dns(self):
+        values = ['user%d' % i for i in range(250)] + ['user1', 'nobody']
+        res = attributes_to_dns(values, 'uid', directory=self.dir)
+        self.assertEquals(len(res), 250)
+        self.assertEquals(res['user12'], 'cn=User 12,ou=people,o=example')
+        self.failIf('nobody' in res)
+        # chunked searches
+        self.assertEquals(len(self.dir.searches), 3)
+        self.assertEquals(len(self.dir.searches[0]['uid']),
+                          fields.RESOLUTION_CHUNK_SIZE)
+
+    def test_attributes_to_entries_ambiguous(self):
+        self.entries.append({'dn': 'cn=Other,ou=people,o=example',
+                             'uid': 'user3', 'cn': 'Other',
+                             'mail': 'other@example.com'})
+        res = attributes_to_entries(['user3', 'user4'], 'uid',
+                                    directory=self.dir,
+                                    return_fields=['mail'])
+        self.assertEquals(res.keys(), ['user4'])
+        self.assertEquals(res['user4'], {'mail': 'user4@example.com',
+                                         'uid': 'user4'})
+
+    def test_dns_to_attributes(self):
+        dns = ['cn=User 3,ou=people,o=example',
+               'CN=User 5, ou=people, o=example',
+               'cn=User 7,ou=elsewhere,o=example',
+               'cn=Nobody,ou=people,o=example']
+        res = dns_to_attributes(dns, 'uid', directory=self.dir)
+        self.assertEquals(res, {
+            'cn=User 3,ou=people,o=example': 'user3',
+            'CN=User 5, ou=people, o=example': 'user5',
+            })
+        self.assertEquals(len(self.dir.searches), 1)
+
+    def test_getResolutionCache(self):
+        field = FakeField()
+        # no request
+        self.assertEquals(getResolutionCache(field, 'dn'), {})
+        field.REQUEST = FakeRequest()
+        cache = getResolutionCache(field, 'dn')
+        cache['user1'] = 'cn=User 1,ou=people,o=example'
+        self.assert_(getResolutionCache(field, 'dn') is cache)
+        self.failIf(getResolutionCache(field, 'attribute') is cache)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(FieldsTestCase),
+        ))
@@ -0,0 +1,117 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Testing.ZopeTestCase import doctest
+
+from Products.CPSDirectory.indexes import FieldIndex
+from Products.CPSDirectory.indexes import TrigramIndex
+
+class FieldIndexTestCase(unittest.TestCase):
+
+    def makeIndex(self):
+        index = FieldIndex('foo')
+        index.indexEntry('a', 'spam')
+        index.indexEntry('b', ['spam', 'eggs'])
+        index.indexEntry('c', None)
+        return index
+
+    def search(self, index, values):
+        ids, exact = index.search(values)
+        return list(ids), exact
+
+    def testSearch(self):
+        index = self.makeIndex()
+        self.assertEquals(len(index), 3)
+        self.assertEquals(self.search(index, ['spam']), (['a', 'b'], True))
+        self.assertEquals(self.search(index, ['eggs']), (['b'], True))
+        self.assertEquals(self.search(index, ['eggs', 'spam']),
+                          (['a', 'b'], True))
+        self.assertEquals(self.search(index, ['bacon']), ([], True))
+        self.assertEquals(self.search(index, [u'eggs']), (['b'], True))
+
+    def testReindex(self):
+        index = self.makeIndex()
+        index.indexEntry('b', 'bacon')
+        self.assertEquals(len(index), 3)
+        self.assertEquals(self.search(index, ['spam']), (['a'], True))
+        self.assertEquals(self.search(index, ['eggs']), ([], True))
+        self.assertEquals(self.search(index, ['bacon']), (['b'], True))
+        index.unindexEntry('a')
+        self.assertEquals(len(index), 2)
+        self.assertEquals(self.search(index, ['spam']), ([], True))
+        # unknown ids are ignored
+        index.unindexEntry('zzz')
+
+    def testUnindexable(self):
+        index = self.makeIndex()
+        index.indexEntry('d', {'x': 1})
+        self.assertEquals(self.search(index, ['eggs']), (['b', 'd'], False))
+        ids, exact = index.search([object()])
+        self.assertEquals(ids, None)
+        index.unindexEntry('d')
+        self.assertEquals(self.search(index, ['eggs']), (['b'], True))
+
+
+class TrigramIndexTestCase(unittest.TestCase):
+
+    def makeIndex(self):
+        index = TrigramIndex('foo')
+        index.indexEntry('a', 'Green')
+        index.indexEntry('b', ['Blue', 'gr'])
+        index.indexEntry('c', u'Gr\xe9en')
+        return index
+
+    def search(self, index, value):
+        ids, exact = index.search(value)
+        self.failIf(exact)
+        return list(ids)
+
+    def testSearch(self):
+        index = self.makeIndex()
+        self.assertEquals(self.search(index, 'green'), ['a', 'c'])
+        self.assertEquals(self.search(index, 'REE'), ['a', 'c'])
+        self.assertEquals(self.search(index, 'blu'), ['b'])
+        self.assertEquals(self.search(index, 'zzz'), [])
+        # short queries
+        self.assertEquals(self.search(index, 'gr'), ['a', 'b', 'c'])
+        self.assertEquals(self.search(index, 'u'), ['b'])
+
+    def testCandidatesOnly(self):
+        index = TrigramIndex('foo')
+        index.indexEntry('a', 'abcxbcd')
+        # has all the trigrams, doesn't contain the string
+        self.assertEquals(self.search(index, 'abcd'), ['a'])
+
+    def testReindex(self):
+        index = self.makeIndex()
+        index.indexEntry('a', 'Red')
+        self.assertEquals(self.search(index, 'green'), ['c'])
+        self.assertEquals(self.search(index, 'red'), ['a'])
+        index.unindexEntry('c')
+        self.assertEquals(self.search(index, 'green'), [])
+        self.assertEquals(len(index), 2)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(FieldIndexTestCase),
+        unittest.makeSuite(TrigramIndexTestCase),
+        doctest.DocTestSuite('Products.CPSDirectory.indexes'),
+        ))
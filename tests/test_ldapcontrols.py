@@ -0,0 +1,52 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Testing.ZopeTestCase import doctest
+
+from Products.CPSDirectory import ldapcontrols
+
+class ControlsTestCase(unittest.TestCase):
+
+    def testSortRequestEncoding(self):
+        # sn ascending, then cn descending
+        value = '0\x0f0\x04\x04\x02sn0\x07\x04\x02cn\x81\x01\xff'
+        self.assertEquals(ldapcontrols.encodeSortRequest([('sn', False),
+                                                          ('cn', True)]),
+                          value)
+
+    def testLongValues(self):
+        attr = 'x' * 300
+        value = ldapcontrols.encodeSortRequest([(attr, False)])
+        self.assertEquals(ldapcontrols.decodeSortRequest(value),
+                          [(attr, False)])
+        self.assertRaises(ValueError, ldapcontrols.decodeSortRequest,
+                          value[:-1])
+
+    def testVLVResponse(self):
+        value = ldapcontrols.encodeVLVResponse(1, 70000, 0)
+        self.assertEquals(ldapcontrols.decodeVLVResponse(value),
+                          (1, 70000, 0, None))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ControlsTestCase),
+        doctest.DocTestSuite('Products.CPSDirectory.ldapcontrols'),
+        ))
@@ -0,0 +1,47 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Testing.ZopeTestCase import doctest
+
+from Products.CPSDirectory.ldapfilter import parseFilter
+from Products.CPSDirectory.ldapfilter import FilterError
+
+
+class LDAPFilterTestCase(unittest.TestCase):
+
+    def testEscaping(self):
+        self.assertEquals(parseFilter('(cn=a\\2a\\28b\\29)'),
+                          ('=', 'cn', u'a*(b)'))
+        self.assertEquals(parseFilter('(cn=\\2a*)'),
+                          ('sub', 'cn', u'*', (), u''))
+        self.assertEquals(parseFilter(u'(cn=\xe9T\xe9)'),
+                          ('=', 'cn', u'\xe9t\xe9'))
+
+    def testErrors(self):
+        for filter in ('(cn=a', '(cn=a))', '(&(cn=a)', '(=a)',
+                       '(cn:1.2.3:=a)', '(cn=a(b)'):
+            self.assertRaises(FilterError, parseFilter, filter)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(LDAPFilterTestCase),
+        doctest.DocTestSuite('Products.CPSDirectory.ldapfilter'),
+        ))
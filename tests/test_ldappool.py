@@ -0,0 +1,153 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+import threading
+import time
+
+from Products.CPSDirectory import ldappool
+from Products.CPSDirectory.ldappool import ConnectionPool
+from Products.CPSDirectory.ldappool import PoolExhaustedError
+
+class FakeConnection(object):
+
+    broken = False
+    unbound = False
+
+    def unbind_s(self):
+        self.unbound = True
+
+def check(conn):
+    if conn.broken:
+        raise ValueError("broken")
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        ldappool.clearPools()
+
+    def makePool(self, **kw):
+        return ConnectionPool(FakeConnection, check, **kw)
+
+    def testBorrowRelease(self):
+        pool = self.makePool()
+        conn = pool.borrow()
+        self.assertEquals(pool.getStatistics()['in_use'], 1)
+        pool.release(conn)
+        self.assert_(pool.borrow() is conn)
+        other = pool.borrow()
+        self.failIf(other is conn)
+        pool.release(other, broken=True)
+        self.assert_(other.unbound)
+        stats = pool.getStatistics()
+        self.assertEquals(stats['created'], 2)
+        self.assertEquals(stats['reused'], 1)
+        self.assertEquals(stats['discarded'], 1)
+        self.assertEquals(stats['size'], 1)
+
+    def testHealthCheck(self):
+        pool = self.makePool()
+        conn = pool.borrow()
+        conn.broken = True
+        pool.release(conn)
+        # recently used connections aren't checked
+        self.assert_(pool.borrow() is conn)
+        pool.release(conn)
+        # but the others are
+        pool._idle = [(time.time() - 60, conn)]
+        other = pool.borrow()
+        self.failIf(other is conn)
+        self.assert_(conn.unbound)
+        stats = pool.getStatistics()
+        self.assertEquals(stats['discarded'], 1)
+        self.assertEquals(stats['size'], 1)
+
+    def testIdleTimeout(self):
+        pool = self.makePool(min_size=1, idle_timeout=60)
+        conns = [pool.borrow() for i in range(3)]
+        for conn in conns:
+            pool.release(conn)
+        pool._idle = [(0, conn) for t, conn in pool._idle]
+        conn = pool.borrow()
+        # the oldest connections are closed, keeping min_size of them
+        self.assert_(conns[0].unbound)
+        self.assert_(conns[1].unbound)
+        self.assert_(conn is conns[2])
+        stats = pool.getStatistics()
+        self.assertEquals(stats['expired'], 2)
+        self.assertEquals(stats['size'], 1)
+
+    def testMaxSize(self):
+        pool = self.makePool(max_size=1)
+        conn = pool.borrow()
+        self.assertRaises(PoolExhaustedError, pool.borrow, timeout=0.01)
+        def giveBack():
+            pool.release(conn)
+        thread = threading.Timer(0.05, giveBack)
+        thread.start()
+        self.assert_(pool.borrow(timeout=5) is conn)
+        thread.join()
+        stats = pool.getStatistics()
+        self.assertEquals(stats['waits'], 2)
+        self.assertEquals(stats['timeouts'], 1)
+
+    def testAbandon(self):
+        pool = self.makePool(max_size=1)
+        conn = pool.borrow()
+        pool.abandon(conn)
+        self.failIf(conn.unbound)
+        # closed and replaced by the next borrower
+        other = pool.borrow()
+        self.failIf(other is conn)
+        self.assert_(conn.unbound)
+        stats = pool.getStatistics()
+        self.assertEquals(stats['discarded'], 1)
+        self.assertEquals(stats['size'], 1)
+
+    def testFactoryError(self):
+        def factory():
+            raise ValueError("server down")
+        pool = ConnectionPool(factory, max_size=1)
+        self.assertRaises(ValueError, pool.borrow)
+        self.assertRaises(ValueError, pool.borrow)
+        self.assertEquals(pool.getStatistics()['size'], 0)
+
+    def testRegistry(self):
+        pool = ldappool.getPool('key', FakeConnection, max_size=3)
+        self.assert_(ldappool.getPool('key', None, max_size=5) is pool)
+        self.assertEquals(pool.max_size, 5)
+        self.assert_(ldappool.getExistingPool('key') is pool)
+        self.assertEquals(ldappool.getExistingPool('other'), None)
+        pool1 = ldappool.getPool(('url', 'dn', 1), FakeConnection)
+        pool2 = ldappool.getPool(('url', 'dn', 2), FakeConnection)
+        ldappool.getPool(('url', 'other', 1), FakeConnection)
+        pools = ldappool.listPools(('url', 'dn'))
+        self.assertEquals(len(pools), 2)
+        self.assert_(pool1 in pools and pool2 in pools)
+        conn = pool.borrow()
+        ldappool.clearPools()
+        self.assertEquals(ldappool.getExistingPool('key'), None)
+        # connections given back to a closed pool are closed
+        pool.release(conn)
+        self.assert_(conn.unbound)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ConnectionPoolTestCase),
+        ))
@@ -0,0 +1,157 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+from Testing.ZopeTestCase import doctest
+
+from Products.CPSDirectory.ldapfilter import parseFilter
+from Products.CPSDirectory.replica import LDAPReplica
+from Products.CPSDirectory.replica import beginSync
+from Products.CPSDirectory.replica import endSync
+from Products.CPSDirectory.replica import SCOPE_BASE
+from Products.CPSDirectory.replica import SCOPE_ONELEVEL
+from Products.CPSDirectory.replica import SCOPE_SUBTREE
+
+BASE = ('ou=people', 'o=org')
+
+def key(rdn, *parents):
+    return (rdn,) + parents + BASE
+
+
+class LDAPReplicaTestCase(unittest.TestCase):
+
+    def makeReplica(self, scope=SCOPE_SUBTREE):
+        replica = LDAPReplica('source', BASE, scope,
+                              ['objectClass', 'cn', 'uid', 'mail'],
+                              indexed_attrs=['uid'])
+        replica.setEntry(key('uid=john'), 'uid=john,ou=people,o=org',
+                         {'objectClass': ['person'], 'uid': ['john'],
+                          'cn': ['John Doe'], 'jpegPhoto': ['...']})
+        replica.setEntry(key('uid=jane'), 'uid=jane,ou=people,o=org',
+                         {'objectClass': ['person'], 'uid': ['jane'],
+                          'cn': ['Jane Doe'], 'mail': ['jane@example.com']})
+        replica.setEntry(key('uid=jim', 'ou=sales'),
+                         'uid=jim,ou=sales,ou=people,o=org',
+                         {'objectClass': ['person'], 'uid': ['jim'],
+                          'cn': ['Jim Beam']})
+        return replica
+
+    def search(self, replica, filter, base=BASE, scope=SCOPE_SUBTREE,
+               attrs=('uid',)):
+        return [dn for dn, e in replica.search(base, scope,
+                                               parseFilter(filter), attrs)]
+
+    def testEntries(self):
+        replica = self.makeReplica()
+        self.assertEquals(len(replica), 3)
+        # attributes that aren't replicated are not kept
+        self.assertEquals(replica.getEntry(key('uid=john')),
+                          ('uid=john,ou=people,o=org',
+                           {'objectClass': ['person'], 'uid': ['john'],
+                            'cn': ['John Doe']}))
+        self.assertEquals(replica.getEntry(key('uid=nobody')), None)
+        self.failIf(replica.setEntry(key('uid=john'),
+                                     'uid=john,ou=people,o=org',
+                                     {'objectClass': ['person'],
+                                      'uid': ['john'], 'cn': ['John Doe']}))
+        self.assert_(replica.setEntry(key('uid=john'),
+                                      'uid=john,ou=people,o=org',
+                                      {'objectClass': ['person'],
+                                       'uid': ['johnny'],
+                                       'cn': ['John Doe']}))
+        self.assertEquals(self.search(replica, '(uid=john)'), [])
+        self.assertEquals(self.search(replica, '(uid=johnny)'),
+                          ['uid=john,ou=people,o=org'])
+        self.assert_(replica.removeEntry(key('uid=john')))
+        self.failIf(replica.removeEntry(key('uid=john')))
+        self.assertEquals(len(replica), 2)
+        self.assertEquals(self.search(replica, '(uid=johnny)'), [])
+        self.assertEquals(sorted(replica.keys()),
+                          [key('uid=jane'), key('uid=jim', 'ou=sales')])
+
+    def testSearch(self):
+        replica = self.makeReplica()
+        # in tree order
+        self.assertEquals(self.search(replica, '(objectClass=person)'),
+                          ['uid=jim,ou=sales,ou=people,o=org',
+                           'uid=jane,ou=people,o=org',
+                           'uid=john,ou=people,o=org'])
+        # indexed
+        self.assertEquals(self.search(replica, '(|(uid=JOHN)(uid=jim))'),
+                          ['uid=jim,ou=sales,ou=people,o=org',
+                           'uid=john,ou=people,o=org'])
+        self.assertEquals(self.search(replica, '(&(cn=*doe)(!(mail=*)))'),
+                          ['uid=john,ou=people,o=org'])
+        # scopes
+        self.assertEquals(self.search(replica, '(cn=j*)',
+                                      scope=SCOPE_ONELEVEL),
+                          ['uid=jane,ou=people,o=org',
+                           'uid=john,ou=people,o=org'])
+        self.assertEquals(self.search(replica, '(uid=jim)',
+                                      scope=SCOPE_ONELEVEL), [])
+        self.assertEquals(self.search(replica, '(cn=*)',
+                                      base=('ou=sales',) + BASE),
+                          ['uid=jim,ou=sales,ou=people,o=org'])
+        self.assertEquals(self.search(replica, '(cn=*)',
+                                      base=key('uid=jane'),
+                                      scope=SCOPE_BASE),
+                          ['uid=jane,ou=people,o=org'])
+        # attributes
+        results = replica.search(key('uid=jane'), SCOPE_BASE, None,
+                                 ['CN', 'dn', 'mail'])
+        self.assertEquals(results, [('uid=jane,ou=people,o=org',
+                                     {'cn': ['Jane Doe'],
+                                      'mail': ['jane@example.com']})])
+        # values are copies
+        results[0][1]['cn'].append('x')
+        self.assertEquals(replica.getEntry(key('uid=jane'))[1]['cn'],
+                          ['Jane Doe'])
+
+    def testCoverage(self):
+        replica = self.makeReplica()
+        self.assert_(replica.covers(BASE, SCOPE_SUBTREE))
+        self.assert_(replica.covers(key('uid=jim', 'ou=sales'), SCOPE_BASE))
+        self.failIf(replica.covers(('o=org',), SCOPE_SUBTREE))
+        self.failIf(replica.covers(('ou=other', 'o=org'), SCOPE_BASE))
+        self.assert_(replica.hasAttributes(['CN', 'dn']))
+        self.failIf(replica.hasAttributes(['cn', 'jpegPhoto']))
+        self.failIf(replica.hasAttributes(None))
+
+        replica = self.makeReplica(scope=SCOPE_ONELEVEL)
+        self.assert_(replica.covers(BASE, SCOPE_ONELEVEL))
+        self.assert_(replica.covers(key('uid=john'), SCOPE_BASE))
+        self.failIf(replica.covers(BASE, SCOPE_SUBTREE))
+        self.failIf(replica.covers(BASE, SCOPE_BASE))
+        self.failIf(replica.covers(key('uid=jim', 'ou=sales'), SCOPE_BASE))
+
+    def testSyncGuard(self):
+        self.assert_(beginSync('a'))
+        self.failIf(beginSync('a'))
+        self.assert_(beginSync('b'))
+        endSync('a')
+        endSync('b')
+        self.assert_(beginSync('a'))
+        endSync('a')
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(LDAPReplicaTestCase),
+        doctest.DocTestSuite('Products.CPSDirectory.replica'),
+        ))
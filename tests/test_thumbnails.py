@@ -0,0 +1,149 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from Products.CPSDirectory import thumbnails
+from Products.CPSDirectory.thumbnails import ThumbnailCache
+from Products.CPSDirectory.thumbnails import makeThumbnail
+
+class ThumbnailCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ThumbnailCache(os.path.join(self.path, 'thumbs'),
+                                    size=10, max_age=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testGetSet(self):
+        cache = self.cache
+        key = ('/portal/members', 'john', 'photo', 48, 'd1')
+        self.assertEquals(cache.get(key), None)
+        cache.set(key, 'thumb')
+        self.assertEquals(cache.get(key), 'thumb')
+        self.assertEquals(cache.get(key[:3] + (64, 'd1')), None)
+        self.assertEquals(
+            cache.get(('/portal/members', 'jack', 'photo', 48, 'd1')), None)
+
+    def testOtherImage(self):
+        cache = self.cache
+        key = ('/portal/members', 'john', 'photo', 48, 'd1')
+        other_size = ('/portal/members', 'john', 'photo', 64, 'd1')
+        cache.set(key, 'thumb')
+        cache.set(other_size, 'big thumb')
+        # thumbnails are only used for the image they come from
+        new_key = key[:4] + ('d2',)
+        self.assertEquals(cache.get(new_key), None)
+        cache.set(new_key, 'new thumb')
+        self.assertEquals(cache.get(new_key), 'new thumb')
+        # the thumbnail of the previous image is removed
+        self.failIf(os.path.exists(cache._getFileName(key)))
+        self.assertEquals(cache.get(other_size), 'big thumb')
+
+    def testDigest(self):
+        cache = self.cache
+        self.assertEquals(cache.getDigest('/portal/members', 'john', 'photo'),
+                          None)
+        cache.setDigest('/portal/members', 'john', 'photo', 'd1')
+        self.assertEquals(cache.getDigest('/portal/members', 'john', 'photo'),
+                          'd1')
+        self.assertEquals(cache.getDigest('/portal/members', 'john', 'cv'),
+                          None)
+        # digests that are too old are not trusted
+        filename = cache._getDigestFileName('/portal/members', 'john',
+                                            'photo')
+        old = time.time() - 200
+        os.utime(filename, (old, old))
+        self.assertEquals(cache.getDigest('/portal/members', 'john', 'photo'),
+                          None)
+        cache.setDigest('/portal/members', 'john', 'photo', 'd2')
+        cache.invalidate('/portal/members', 'john')
+        self.assertEquals(cache.getDigest('/portal/members', 'john', 'photo'),
+                          None)
+
+    def testInvalidate(self):
+        cache = self.cache
+        cache.set(('/portal/members', 'john', 'photo', 48, 'd1'), 'a')
+        cache.set(('/portal/members', 'john', 'photo', 64, 'd1'), 'b')
+        cache.set(('/portal/members', 'jack', 'photo', 48, 'd2'), 'c')
+        cache.invalidate('/portal/members', 'john')
+        self.assertEquals(
+            cache.get(('/portal/members', 'john', 'photo', 48, 'd1')), None)
+        self.assertEquals(
+            cache.get(('/portal/members', 'john', 'photo', 64, 'd1')), None)
+        self.assertEquals(
+            cache.get(('/portal/members', 'jack', 'photo', 48, 'd2')), 'c')
+        # each entry has its own subdirectory
+        self.assertEquals(len(os.listdir(cache.path)), 1)
+        cache.invalidate('/portal/members', 'nobody')
+        # files of the older flat layout are removed too
+        f = open(os.path.join(cache.path, 'flat'), 'wb')
+        f.write('old')
+        f.close()
+        cache.clear()
+        self.assertEquals(os.listdir(cache.path), [])
+        self.assertEquals(
+            cache.get(('/portal/members', 'jack', 'photo', 48, 'd2')), None)
+
+    def testPruning(self):
+        cache = self.cache
+        now = time.time()
+        for i in range(10):
+            key = ('/portal/members', 'user%d' % i, 'photo', 48, 'd')
+            cache.set(key, 'thumb')
+            # user0 is the least recently used
+            os.utime(cache._getFileName(key), (now - 50 + i, now))
+        cache.set(('/portal/members', 'new', 'photo', 48, 'd'), 'thumb')
+        self.assertEquals(len(os.listdir(cache.path)), 9)
+        self.assertEquals(
+            cache.get(('/portal/members', 'user0', 'photo', 48, 'd')), None)
+        self.assertEquals(
+            cache.get(('/portal/members', 'user9', 'photo', 48, 'd')),
+            'thumb')
+        self.assertEquals(
+            cache.get(('/portal/members', 'new', 'photo', 48, 'd')), 'thumb')
+
+    def testMakeThumbnail(self):
+        if thumbnails.PILImage is None:
+            self.assertEquals(makeThumbnail('GIF89a', 48), None)
+            return
+        PILImage = thumbnails.PILImage
+        out = StringIO()
+        PILImage.new('RGB', (200, 100)).save(out, 'PNG')
+        data = makeThumbnail(out.getvalue(), 50)
+        image = PILImage.open(StringIO(data))
+        self.assertEquals(image.format, 'PNG')
+        self.assertEquals(image.size, (50, 25))
+        # small enough already
+        self.assertEquals(makeThumbnail(data, 50), data)
+        self.assertEquals(makeThumbnail('not an image', 50), None)
+        self.assertEquals(makeThumbnail(out.getvalue(), 0), None)
+        self.assertEquals(makeThumbnail(out.getvalue(), -5), None)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ThumbnailCacheTestCase),
+        ))
@@ -20,8 +20,18 @@
 import unittest
 
 from Testing.ZopeTestCase import doctest
+from DateTime import DateTime
 
 from Products.CPSDirectory.utils import QueryMatcher
+from Products.CPSDirectory.utils import isNotModified
+
+class FakeRequest:
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+    def get_header(self, name):
+        return self.headers.get(name)
 
 class DirectoryUtilsTestCase(unittest.TestCase):
 
@@ -43,6 +53,106 @@ class DirectoryUtilsTestCase(unittest.TestCase):
         self.assert_(matcher.match({'sn': 'c', 'givenName': '1'}))
         self.failIf(matcher.match({'sn': 'a', 'givenName': '2'}))
 
+    def testNegate_substring(self):
+        query = {'sn': {'query': 'tu', 'negate': True}}
+        matcher = QueryMatcher(query, substring_keys=['sn'])
+        self.assert_(matcher.match({'sn': 'blob'}))
+        self.failIf(matcher.match({'sn': 'TOTUTU'}))
+        self.failIf(matcher.match({'sn': None}))
+
+    def testNegate_empty(self):
+        matcher = QueryMatcher({'sn': {'query': '', 'negate': True}})
+        self.assert_(matcher.match({'sn': 'blob'}))
+        self.failIf(matcher.match({'sn': ''}))
+        matcher = QueryMatcher({'sn': {'query': None, 'negate': True}})
+        self.assert_(matcher.match({'sn': ''}))
+        self.failIf(matcher.match({'sn': None}))
+
+    def testStar(self):
+        matcher = QueryMatcher({'sn': '*'})
+        self.assert_(matcher.match({'sn': 'blob'}))
+        self.assert_(matcher.match({'sn': ['', 'blob']}))
+        self.failIf(matcher.match({'sn': ''}))
+        self.failIf(matcher.match({'sn': []}))
+        self.failIf(matcher.match({'sn': None}))
+        matcher = QueryMatcher({'sn': {'query': '*', 'negate': True}})
+        self.assert_(matcher.match({'sn': ''}))
+        self.assert_(matcher.match({'sn': []}))
+        self.failIf(matcher.match({'sn': 'blob'}))
+
+    def testRange(self):
+        query = {'sn': {'query': 'b', 'range': 'min'}}
+        matcher = QueryMatcher(query)
+        self.assert_(matcher.match({'sn': 'b'}))
+        self.assert_(matcher.match({'sn': ['a', 'c']}))
+        self.failIf(matcher.match({'sn': 'a'}))
+        query = {'sn': {'query': 'b', 'range': 'max'}}
+        matcher = QueryMatcher(query)
+        self.assert_(matcher.match({'sn': 'a'}))
+        self.failIf(matcher.match({'sn': 'c'}))
+        self.failIf(matcher.match({'sn': None}))
+
+    def testRange_falsyBound(self):
+        matcher = QueryMatcher({'n': {'query': 0, 'range': 'max'}})
+        self.assert_(matcher.match({'n': -5}))
+        self.assert_(matcher.match({'n': 0}))
+        self.failIf(matcher.match({'n': 3}))
+        self.failIf(matcher.match({'n': None}))
+        matcher = QueryMatcher({'sn': {'query': '', 'range': 'max'}})
+        self.assert_(matcher.match({'sn': ''}))
+        self.failIf(matcher.match({'sn': 'a'}))
+        self.failIf(matcher.match({'sn': None}))
+
+    def testRange_dates(self):
+        query = {'d': {'query': (DateTime('2000/01/01'),
+                                 DateTime('2000/12/31')),
+                       'range': 'min:max'}}
+        matcher = QueryMatcher(query)
+        self.assert_(matcher.match({'d': DateTime('2000/06/01')}))
+        self.failIf(matcher.match({'d': DateTime('2001/06/01')}))
+        query['d']['negate'] = True
+        matcher = QueryMatcher(query)
+        self.failIf(matcher.match({'d': DateTime('2000/06/01')}))
+        self.assert_(matcher.match({'d': DateTime('2001/06/01')}))
+
+    def testBadRange(self):
+        self.assertRaises(ValueError, QueryMatcher,
+                          {'sn': {'query': 'a', 'range': 'min:max'}})
+        self.assertRaises(ValueError, QueryMatcher,
+                          {'sn': {'query': 'a', 'range': 'middle'}})
+        self.assertRaises(ValueError, QueryMatcher,
+                          {'sn': {'query': ('a', 3), 'range': 'min:max'}})
+
+    def testIsNotModified_etag(self):
+        etag = '"abc"'
+        self.failIf(isNotModified(FakeRequest(), etag))
+        self.assert_(isNotModified(FakeRequest(**{'If-None-Match': etag}),
+                                   etag))
+        self.assert_(isNotModified(
+            FakeRequest(**{'If-None-Match': '"def", W/"abc"'}), etag))
+        self.failIf(isNotModified(FakeRequest(**{'If-None-Match': '"def"'}),
+                                  etag))
+        # If-None-Match wins over If-Modified-Since
+        request = FakeRequest(**{'If-None-Match': '"def"',
+                                 'If-Modified-Since': DateTime().rfc822()})
+        self.failIf(isNotModified(request, etag, mtime=0))
+
+    def testIsNotModified_date(self):
+        mtime = DateTime('2010/01/01 12:00 GMT').timeTime()
+        def request(date):
+            return FakeRequest(**{'If-Modified-Since': date})
+        self.assert_(isNotModified(
+            request('Fri, 01 Jan 2010 12:00:00 GMT'), '"x"', mtime))
+        self.assert_(isNotModified(
+            request('Fri, 01 Jan 2010 13:00:00 GMT; length=12'), '"x"',
+            mtime))
+        self.failIf(isNotModified(
+            request('Fri, 01 Jan 2010 11:00:00 GMT'), '"x"', mtime))
+        self.failIf(isNotModified(request('garbage'), '"x"', mtime))
+        # unknown modification time
+        self.failIf(isNotModified(
+            request('Fri, 01 Jan 2010 12:00:00 GMT'), '"x"'))
+
 
 def test_suite():
     return unittest.TestSuite((
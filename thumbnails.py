@@ -0,0 +1,321 @@
+# (C) Copyright 2010 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Thumbnails of the images stored in directory entries.
+
+Member listings typically display a small photo for each entry. Fetching
+the full entry from the backend and resizing the photo for each of them
+is expensive, so resized images are kept in a cache on disk, shared by
+all the threads and processes of the instance.
+
+The cache is a plain directory holding a subdirectory per entry, named
+after the directory and entry, in which each thumbnail is a file named
+after the field and size it comes from, and the digest of the original
+image: a thumbnail is only used for the image it was made from, even if
+the entry was changed by another process or directly in the backend.
+The least recently used thumbnails are removed when there are too many
+of them.
+
+The digests of the original images are kept there too, so that
+conditional requests can be answered without reading the image from
+the backend. They are removed when the entry is written, and trusted for
+at most an hour otherwise, like the browsers trust the image itself.
+
+Resizing needs PIL. Without it, no thumbnail is computed and the original
+image is served.
+"""
+
+import os
+import time
+import md5
+import logging
+import tempfile
+import threading
+from StringIO import StringIO
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    try:
+        import Image as PILImage
+    except ImportError:
+        PILImage = None
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of thumbnails kept on disk
+THUMBNAIL_CACHE_SIZE = 5000
+
+# Age (in seconds) after which the digest of an image isn't trusted
+DIGEST_MAX_AGE = 3600
+
+# Largest size of thumbnail that can be asked for
+MAX_THUMBNAIL_SIZE = 512
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def getThumbnailCache():
+    """Get the thumbnail cache of this instance.
+
+    It lives in the client home of the instance, or in the temporary
+    directory if there is none (unit tests).
+    """
+    global _cache
+    _cache_lock.acquire()
+    try:
+        if _cache is None:
+            path = None
+            try:
+                from App.config import getConfiguration
+                path = getConfiguration().clienthome
+            except (ImportError, AttributeError):
+                pass
+            if not path:
+                path = tempfile.gettempdir()
+            _cache = ThumbnailCache(os.path.join(path,
+                                                 'cpsdirectory_thumbnails'))
+        return _cache
+    finally:
+        _cache_lock.release()
+
+def _hash(*args):
+    return md5.new(repr(args)).hexdigest()
+
+def makeThumbnail(data, size):
+    """Resize image data so that it fits in a square of the given size.
+
+    The thumbnail is in the same format as the original. Images that
+    already fit are returned untouched. Returns None if PIL is not
+    available or can't read the image, or if size is not positive.
+    """
+    if PILImage is None or size <= 0:
+        return None
+    try:
+        image = PILImage.open(StringIO(data))
+        if image.size[0] <= size and image.size[1] <= size:
+            return data
+        format = image.format
+        image.thumbnail((size, size), PILImage.ANTIALIAS)
+        out = StringIO()
+        image.save(out, format)
+    except (IOError, ValueError, KeyError), e:
+        logger.debug("makeThumbnail: can't resize image: %s", e)
+        return None
+    return out.getvalue()
+
+
+class ThumbnailCache(object):
+    """On disk LRU cache of thumbnails.
+
+    Keys are (directory path, entry id, field id, size, digest) tuples,
+    where digest is the md5 hex digest of the original image. The last
+    access time of the files is used to find the least recently used
+    ones.
+
+    The digests of the images are kept for max_age seconds.
+
+    Files are written under a temporary name then renamed, so that
+    concurrent readers never see partial thumbnails.
+    """
+
+    def __init__(self, path, size=THUMBNAIL_CACHE_SIZE,
+                 max_age=DIGEST_MAX_AGE):
+        self.path = path
+        self.size = size
+        self.max_age = max_age
+        # Number of files written since the last pruning, with the
+        # number of files found then
+        self._count = 0
+
+    def _getEntryPath(self, dir_path, entry_id):
+        """Get the subdirectory holding the thumbnails of an entry."""
+        return os.path.join(self.path, _hash(dir_path, entry_id))
+
+    def _getFileName(self, key):
+        dir_path, entry_id, field_id, size, digest = key
+        return os.path.join(self._getEntryPath(dir_path, entry_id),
+                            '%s-%s' % (_hash(field_id, size), digest))
+
+    def _listFiles(self):
+        """List the thumbnail files of all the entries."""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        filenames = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                filenames.extend([os.path.join(path, filename)
+                                  for filename in os.listdir(path)])
+            except OSError:
+                # Not a subdirectory (older layout) or just removed
+                if os.path.isfile(path):
+                    filenames.append(path)
+        return filenames
+
+    def _removeFiles(self, filenames):
+        """Remove files, and the entry subdirectories left empty."""
+        paths = set()
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            path = os.path.dirname(filename)
+            if path != self.path:
+                paths.add(path)
+        for path in paths:
+            try:
+                os.rmdir(path)
+            except OSError: # not empty
+                pass
+
+    def _getDigestFileName(self, dir_path, entry_id, field_id):
+        return os.path.join(self._getEntryPath(dir_path, entry_id),
+                            '%s.digest' % _hash(field_id))
+
+    def _read(self, filename):
+        """Read a file, recording the access."""
+        mtime = os.path.getmtime(filename)
+        f = open(filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        # record the access, on file systems mounted with noatime too
+        os.utime(filename, (time.time(), mtime))
+        return data
+
+    def get(self, key):
+        """Get a thumbnail, or None if there is none."""
+        try:
+            return self._read(self._getFileName(key))
+        except (IOError, OSError):
+            return None
+
+    def getDigest(self, dir_path, entry_id, field_id):
+        """Get the digest of the image of an entry field.
+
+        Returns None if it isn't known, or if it is too old.
+        """
+        filename = self._getDigestFileName(dir_path, entry_id, field_id)
+        try:
+            if time.time() - os.path.getmtime(filename) >= self.max_age:
+                os.remove(filename)
+                return None
+            return self._read(filename)
+        except (IOError, OSError):
+            return None
+
+    def setDigest(self, dir_path, entry_id, field_id, digest):
+        """Store the digest of the image of an entry field."""
+        self._write(self._getDigestFileName(dir_path, entry_id, field_id),
+                    digest)
+
+    def set(self, key, data):
+        """Store a thumbnail.
+
+        The thumbnails of the same field and size made from other
+        versions of the image are removed.
+        """
+        filename = self._getFileName(key)
+        if not self._write(filename, data):
+            return
+        path = os.path.dirname(filename)
+        name = os.path.basename(filename)
+        prefix = name.split('-')[0] + '-'
+        try:
+            others = [other for other in os.listdir(path)
+                      if other.startswith(prefix) and other != name]
+        except OSError:
+            others = []
+        self._removeFiles([os.path.join(path, other) for other in others])
+
+    def _write(self, filename, data):
+        """Write a file of the cache.
+
+        Returns False if it couldn't be written.
+        """
+        try:
+            path = os.path.dirname(filename)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Created by another writer meanwhile
+                    if not os.path.isdir(path):
+                        raise
+            fd, tmpname = tempfile.mkstemp(dir=self.path, prefix='.')
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            try:
+                os.rename(tmpname, filename)
+            except OSError:
+                # The entry was invalidated meanwhile
+                os.remove(tmpname)
+                raise
+        except (IOError, OSError), e:
+            logger.warning("Can't write thumbnail in %s: %s", self.path, e)
+            return False
+        self._count += 1
+        if self._count > self.size:
+            self.prune()
+        return True
+
+    def prune(self):
+        """Remove the least recently used thumbnails if there are too many.
+
+        A tenth of the cache is freed, so that pruning doesn't happen on
+        each write.
+        """
+        filenames = self._listFiles()
+        if len(filenames) > self.size:
+            used = []
+            for filename in filenames:
+                try:
+                    used.append((os.stat(filename).st_atime, filename))
+                except OSError:
+                    pass
+            used.sort()
+            self._removeFiles([filename for atime, filename
+                               in used[:len(used) - self.size * 9 // 10]])
+            filenames = self._listFiles()
+        self._count = len(filenames)
+
+    def invalidate(self, dir_path, entry_id):
+        """Remove all the thumbnails of an entry.
+
+        Only the subdirectory of the entry is read, as this is done on
+        each write to the directory.
+        """
+        path = self._getEntryPath(dir_path, entry_id)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        self._removeFiles([os.path.join(path, name) for name in names])
+
+    def clear(self):
+        """Remove all the thumbnails."""
+        self._removeFiles(self._listFiles())
+        self._count = 0
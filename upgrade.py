@@ -115,13 +115,12 @@ def upgrade_zodb_dirs_unicode(portal):
     fieldStorageNamespace.register('dirCrossSetList', noop)
 
     for z in zdirs:
-        total = len(z)
+        total = z._countEntries()
         logger.info("Starting upgrade for %r (title: %s), with %d entries",
                     z.getId(), z.title, total)
-        # GR trying a memory efficient way to iterate on ids
-        # maybe dangerous ?
+        # Entries are loaded by chunks and deactivated once upgraded
         done = 0
-        for eid in z._tree.iterkeys():
+        for eid, ob in z._scanEntryItems():
             dm = z._getDataModel(eid, check_acls=0)
             upgrade_datamodel_unicode(dm)
             done += 1
@@ -137,3 +136,16 @@ def upgrade_zodb_dirs_unicode(portal):
     fieldStorageNamespace.register('dirCrossSetList',
                                    FieldNamespace.crossSetList)
 
+def upgrade_zodb_dirs_indexes(portal):
+    """Build the missing or stale indexes of the ZODB directories.
+
+    Otherwise the entry titles are listed by scanning all the entries
+    until the indexes are rebuilt from the ZMI.
+    """
+    dtool = portal.portal_directories
+
+    logger = logging.getLogger('CPSDirectory upgrade_zodb_dirs_indexes')
+    for z in dtool.objectValues(ZODBDirectory.meta_type):
+        logger.info("Updating the indexes of %r", z.getId())
+        z._updateIndexes()
+        transaction.commit()
@@ -20,13 +20,180 @@
 used by CPSDirectory classes. """
 
 from types import ListType, TupleType, StringType
-import re
 import operator
 from types import NoneType
 from DateTime import DateTime
 
 from Products.CPSUtil.text import toAscii
 
+def normalizeSubstring(value):
+    """Normalize a string for substring comparisons.
+
+    Accents are folded and the result is lowercased.
+    """
+    return toAscii(value).lower()
+
+def valueKind(value):
+    """Return the kind of a value, for ordering purposes.
+
+    Values of the same kind can be meaningfully compared: strings (unicode
+    and ASCII), non ASCII byte strings, numbers (including booleans) and
+    dates. Returns None for other values.
+
+    >>> valueKind('abc') == valueKind(u'def')
+    True
+    >>> valueKind(True) == valueKind(3.5)
+    True
+    >>> valueKind('abc') == valueKind(1)
+    False
+    >>> valueKind(None) is None
+    True
+    """
+    if isinstance(value, unicode):
+        return 's'
+    if isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeError:
+            return 'b'
+        return 's'
+    if isinstance(value, (int, long, float)):
+        # bool subclasses int
+        return 'n'
+    if isinstance(value, DateTime):
+        return 'd'
+    return None
+
+def titleSortKey(title):
+    """Get the key used to sort entries by title.
+
+    >>> titleSortKey('Foo') == titleSortKey('foo')
+    True
+    >>> titleSortKey(12)
+    '12'
+    """
+    if not isinstance(title, basestring):
+        title = str(title)
+    return normalizeSubstring(title)
+
+def iterBatches(iterable, size):
+    """Iterate over lists of at most size items taken from an iterable.
+
+    >>> list(iterBatches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(iterBatches([], 2))
+    []
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _loadedValue(value):
+    return value
+
+class LazyValue(object):
+    """Value of a field that is only read when it is used.
+
+    loader is called with args the first time the value is needed.
+    Attributes are those of the value.
+
+    >>> calls = []
+    >>> def load(s):
+    ...     calls.append(s)
+    ...     return s.upper()
+    >>> value = LazyValue(load, 'photo')
+    >>> value.isLoaded()
+    False
+    >>> value.lower()
+    'photo'
+    >>> str(value), len(value), value == 'PHOTO', calls
+    ('PHOTO', 5, True, ['photo'])
+    """
+
+    # Allow use from restricted code, the value having its own security
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, loader, *args):
+        self._loader = loader
+        self._args = args
+        self._loaded = False
+        self._value = None
+
+    def isLoaded(self):
+        """Has the value been read already?"""
+        return self._loaded
+
+    def getValue(self):
+        """Get the value, reading it if needed."""
+        if not self._loaded:
+            self._value = self._loader(*self._args)
+            self._loaded = True
+            self._loader = self._args = None
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.getValue(), name)
+
+    def __nonzero__(self):
+        return not not self.getValue()
+
+    def __len__(self):
+        return len(self.getValue())
+
+    def __str__(self):
+        return str(self.getValue())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyValue):
+            other = other.getValue()
+        return self.getValue() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # Pickle the value itself
+        return _loadedValue, (self.getValue(),)
+
+def isNotModified(REQUEST, etag, mtime=None):
+    """Tell if the client already has the current version of a resource.
+
+    Checks the If-None-Match header against etag and, if there is none,
+    the If-Modified-Since header against the mtime timestamp, if known.
+    """
+    if_none_match = REQUEST.get_header('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        for tag in tags:
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
+    if_modified_since = REQUEST.get_header('If-Modified-Since')
+    if if_modified_since is None or mtime is None:
+        return False
+    try:
+        # Some browsers add a ;length=xxx part
+        since = DateTime(if_modified_since.split(';')[0]).timeTime()
+    except (DateTime.SyntaxError, DateTime.DateError, DateTime.TimeError,
+            IndexError, ValueError):
+        return False
+    return int(mtime) <= int(since)
+
 def operator_in(a, b):
     # operator.contains with reversed operands
     return a in b
@@ -34,6 +201,12 @@ def operator_in(a, b):
 def operator_notin(a, b):
     return a not in b
 
+# Values wrapped into a tuple before matching
+_SCALAR_TYPES = (basestring, int, long, NoneType, DateTime)
+
+# Types for which hash lookups agree with equality
+_HASHABLE_TYPES = (basestring, int, long, float)
+
 
 class QueryMatcher(object):
     """ Hold/prepare a query and allow to match entries against it.
@@ -76,16 +249,50 @@ class QueryMatcher(object):
     >>> qm.match({'enabled': False})
     False
 
+    Several entries can be filtered at once
+    >>> qm.filter([{'enabled': False}, {'enabled': True}])
+    [{'enabled': True}]
+
     We don't fail if the entry lacks keys from the query
     >>> qm.match({})
     False
 
+    Negation:
+    >>> qm = QueryMatcher({'id': {'query': 'foo', 'negate': True}},
+    ...                   substring_keys=['id'])
+    >>> qm.match({'id': 'SpamFooEggs'}), qm.match({'id': 'Spam'})
+    (False, True)
+
+    Ranges, with the semantics of SQLDirectory:
+    >>> qm = QueryMatcher({'age': {'query': 18, 'range': 'min'}})
+    >>> qm.match({'age': 18}), qm.match({'age': 17})
+    (True, False)
+    >>> qm = QueryMatcher({'age': {'query': (18, 65), 'range': 'min:max',
+    ...                            'negate': True}})
+    >>> qm.match({'age': 70}), qm.match({'age': 20}), qm.match({'age': None})
+    (True, False, False)
+
+    Values of another kind are never in a range:
+    >>> qm = QueryMatcher({'age': {'query': 18, 'range': 'max'}})
+    >>> qm.match({'age': 10}), qm.match({'age': '10'})
+    (True, False)
+
+    Searching for '*' finds all non null values, and its negation empty
+    values:
+    >>> qm = QueryMatcher({'id': '*'})
+    >>> qm.match({'id': 'foo'}), qm.match({'id': None})
+    (True, False)
+    >>> qm = QueryMatcher({'id': {'query': '*', 'negate': True}})
+    >>> qm.match({'id': ''}), qm.match({'id': 'foo'})
+    (True, False)
+
     """
 
     def __init__(self, query, accepted_keys=None, substring_keys=None):
         self._substring_keys = substring_keys
         _query = {}
         ops = {}
+        predicates = []
         for key, value in query.items():
             if accepted_keys is not None and key not in accepted_keys:
                 continue
@@ -94,23 +301,48 @@ class QueryMatcher(object):
                 continue
             ops[key] = op
             _query[key] = value
+            predicates.append((key, self._compile(op, value)))
         self.query = _query
         self.ops = ops
+        self._predicates = tuple(predicates)
 
     def _findType(self, key, value, negate=False):
         """Find op and value.
+
+        The semantics are those of SQLDirectory._makeClause.
         """
-        if value in ('', None): # XXX
+        if isinstance(value, dict) and 'query' in value:
+            if negate and value.get('negate'):
+                raise ValueError("Cannot double negate")
+            negate = negate or bool(value.get('negate'))
+            query = value['query']
+            if 'range' not in value:
+                return self._findType(key, query, negate=negate)
+            return self._findRange(key, value, negate)
+        if value is None:
             if negate:
-                raise NotImplementedError
+                return value, 'present'
             # Ignore empty searches
             return value, None
         elif isinstance(value, basestring):
-            if (self._substring_keys is not None
+            if not value:
+                if negate:
+                    return value, 'not empty'
+                # Ignore empty searches, they likely come from unfilled
+                # html input fields.
+                return value, None
+            if value == '*':
+                if negate:
+                    # negate of '*' is empty ('') values
+                    op = 'empty'
+                else:
+                    op = 'not empty'
+            elif (self._substring_keys is not None
                 and key in self._substring_keys):
                 if negate:
-                    raise NotImplementedError
-                op = 'substring'
+                    op = 'not substring'
+                else:
+                    op = 'substring'
                 value = value.lower()
             else:
                 if negate:
@@ -127,11 +359,6 @@ class QueryMatcher(object):
                 op = operator_notin
             else:
                 op = operator_in
-        elif isinstance(value, dict) and 'query' in value:
-            if negate and value.get('negate'):
-                raise ValueError("Cannot double negate")
-            query = value['query']
-            return self._findType(key, query, negate=True)
         elif isinstance(value, DateTime):
             if negate:
                 op = operator.ne
@@ -141,43 +368,156 @@ class QueryMatcher(object):
             raise ValueError("Bad value %s for '%s'" % (`value`, key))
         return value, op
 
+    def _findRange(self, key, value, negate):
+        """Find op and value for a range query.
+
+        The value is a tuple (min, max) where None is an open bound.
+        """
+        query = value['query']
+        range = value['range']
+        if range == 'min':
+            bounds = (query, None)
+        elif range == 'max':
+            bounds = (None, query)
+        elif range == 'min:max':
+            if not isinstance(query, (list, tuple)) or len(query) != 2:
+                raise ValueError("Bad query %r for %r" % (value, key))
+            bounds = tuple(query)
+        else:
+            raise ValueError("Bad range %r for %r" % (value, key))
+        kinds = set([valueKind(b) for b in bounds if b is not None])
+        if len(kinds) != 1 or None in kinds:
+            raise ValueError("Bad query %r for %r" % (value, key))
+        if negate:
+            op = 'not range'
+        else:
+            op = 'range'
+        return bounds, op
+
     def getKeysSet(self):
         return set(self.query)
 
+    def _compile(self, op, value):
+        """Compile a predicate for a given op and value.
+
+        The predicate is called with the sequence of the items of the
+        entry value, and is true if one of them matches. For negated
+        queries, it is true if one of them doesn't match the positive
+        query; missing (None) values don't match ranges and substrings,
+        like NULL in SQL.
+        """
+        if op == 'substring' or op == 'not substring':
+            value = normalizeSubstring(value)
+            if op == 'substring':
+                def predicate(items):
+                    for item in items:
+                        if value in normalizeSubstring(item):
+                            return True
+                    return False
+            else:
+                def predicate(items):
+                    for item in items:
+                        if (item is not None
+                            and value not in normalizeSubstring(item)):
+                            return True
+                    return False
+        elif op == 'present':
+            def predicate(items):
+                for item in items:
+                    if item is not None:
+                        return True
+                return False
+        elif op == 'not empty':
+            def predicate(items):
+                for item in items:
+                    if item is not None and item != '':
+                        return True
+                return False
+        elif op == 'empty':
+            def predicate(items):
+                for item in items:
+                    if item is not None and item != '':
+                        return False
+                return True
+        elif op == 'range' or op == 'not range':
+            low, high = value
+            if low is not None:
+                kind = valueKind(low)
+            else:
+                kind = valueKind(high)
+            def in_range(item):
+                return ((low is None or item >= low)
+                        and (high is None or item <= high))
+            if op == 'range':
+                def predicate(items):
+                    for item in items:
+                        if valueKind(item) == kind and in_range(item):
+                            return True
+                    return False
+            else:
+                def predicate(items):
+                    for item in items:
+                        if valueKind(item) == kind and not in_range(item):
+                            return True
+                    return False
+        elif op is operator.eq:
+            def predicate(items):
+                for item in items:
+                    if item == value:
+                        return True
+                return False
+        elif op is operator_in or op is operator_notin:
+            values = value
+            for v in value:
+                if not isinstance(v, _HASHABLE_TYPES):
+                    break
+            else:
+                # hash lookups agree with equality for these types
+                values = frozenset(value)
+            if op is operator_in:
+                def predicate(items):
+                    for item in items:
+                        try:
+                            if item in values:
+                                return True
+                        except TypeError: # unhashable item
+                            if item in value:
+                                return True
+                    return False
+            else:
+                def predicate(items):
+                    for item in items:
+                        try:
+                            if item not in values:
+                                return True
+                        except TypeError: # unhashable item
+                            if item not in value:
+                                return True
+                    return False
+        else:
+            def predicate(items):
+                for item in items:
+                    if op(item, value):
+                        return True
+                return False
+        return predicate
+
     def match(self, entry):
         """ Does the entry match the query ? Boolean valued.
         """
-        ops = self.ops
-        ok = True
-        for key, value in self.query.items():
+        for key, predicate in self._predicates:
             if key not in entry:
-                ok = False
-                break
+                return False
             searched = entry[key]
-            if isinstance(searched, (basestring, int, long, NoneType, DateTime)):
+            if isinstance(searched, _SCALAR_TYPES):
                 # bool subclasses int
                 searched = (searched,)
-            matched = 0
-            value_re = None
-            op = ops[key]
-            if isinstance(value, basestring):
-                if op == 'substring':
-                    value = toAscii(value).lower()
-                if '*' in value or '?' in value:
-                    regexp = re.escape(value)
-                    regexp = regexp.replace('\\?', '.?')
-                    regexp = regexp.replace('\\*', '.*')
-                    value_re = re.compile(regexp)
-
-            for item in searched:
-                # Wild cards like * are currently accepted
-                if op == 'substring':
-                    matched = value in toAscii(item).lower() or value == '*'
-                else: # op is an operator
-                    matched = op(item, value)
-                if matched:
-                    break
-            if not matched:
-                ok = False
-                break
-        return ok
+            if not predicate(searched):
+                return False
+        return True
+
+    def filter(self, entries):
+        """Return the list of the entries that match the query.
+        """
+        match = self.match
+        return [entry for entry in entries if match(entry)]